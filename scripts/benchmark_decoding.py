@@ -0,0 +1,77 @@
+"""
+Per-call latency of greedy decoding with eager and compiled
+(compile=True) models at different batch sizes.
+"""
+
+import string
+import time
+
+import torch
+from torch.autograd import Variable
+
+from seqmod.modules.encoder_decoder import EncoderDecoder
+from seqmod.modules.lm import LM
+from seqmod.misc.dataset import Dict
+from seqmod import utils as u
+
+
+def latency(fn, runs):
+    fn()                        # warm up
+    start = time.time()
+    for _ in range(runs):
+        fn()
+    return (time.time() - start) / runs
+
+
+def make_models(cls, *args, **kwargs):
+    eager = cls(*args, **kwargs)
+    u.initialize_model(eager)
+    compiled = cls(*args, compile=True, **kwargs)
+    compiled.load_state_dict(eager.state_dict())
+    return {'eager': eager.eval(), 'compiled': compiled.eval()}
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', default='1,8,64', type=str)
+    parser.add_argument('--seq_len', default=20, type=int)
+    parser.add_argument('--layers', default=1, type=int)
+    parser.add_argument('--cell', default='LSTM', type=str)
+    parser.add_argument('--emb_dim', default=64, type=int)
+    parser.add_argument('--hid_dim', default=128, type=int)
+    parser.add_argument('--add_prev', action='store_true')
+    parser.add_argument('--runs', default=10, type=int)
+    args = parser.parse_args()
+
+    d = Dict(pad_token=u.PAD, eos_token=u.EOS, bos_token=u.BOS)
+    d.fit([list(string.ascii_letters)])
+    encdecs = make_models(
+        EncoderDecoder, args.layers, args.emb_dim, args.hid_dim,
+        args.hid_dim, d, cell=args.cell, add_prev=args.add_prev)
+    lms = make_models(
+        LM, len(d), args.emb_dim, args.hid_dim,
+        num_layers=args.layers, cell=args.cell)
+
+    print('{:>10} {:>8} {:>12} {:>12}'.format(
+        'model', 'batch', 'eager (ms)', 'compiled (ms)'))
+    for batch_size in map(int, args.batch_sizes.split(',')):
+        src = Variable(torch.LongTensor(args.seq_len, batch_size).random_(
+            len(d.reserved), len(d)), volatile=True)
+        row = {}
+        for name, model in encdecs.items():
+            row[name] = latency(
+                lambda: model.translate(
+                    src, max_decode_len=1, return_atts=False),
+                args.runs)
+        print('{:>10} {:>8} {:12.2f} {:12.2f}'.format(
+            'encdec', batch_size, row['eager'] * 1000,
+            row['compiled'] * 1000))
+        for name, model in lms.items():
+            row[name] = latency(
+                lambda: model.generate(
+                    d, max_seq_len=args.seq_len, batch_size=batch_size,
+                    method='argmax', ignore_eos=True),
+                args.runs)
+        print('{:>10} {:>8} {:12.2f} {:12.2f}'.format(
+            'lm', batch_size, row['eager'] * 1000, row['compiled'] * 1000))
@@ -0,0 +1,86 @@
+"""
+Compare the deep output (maxout) of the EncoderDecoder applied step by step
+against a single call over the stacked decoder outputs, on batches of the
+dummy tasks.
+"""
+
+import string
+import time
+
+import torch
+
+from seqmod.modules.encoder_decoder import EncoderDecoder
+from seqmod.misc.dataset import PairedDataset, Dict
+from seqmod import utils as u
+
+import dummy as d
+
+
+def decoder_outputs(model, src, trg):
+    """
+    Decoder outputs before the deep output and the target embeddings
+    """
+    enc_outs, enc_hidden, enc_att, mask = model.encode(src)
+    inp = model.trg_embeddings(trg)
+    outs, _ = model.decoder.rnn_step(
+        inp, model.decoder.init_hidden_for(enc_hidden))
+    outs, _ = model.decoder.attn(outs, enc_outs, enc_att=enc_att, mask=mask)
+    return outs.detach(), inp.detach()
+
+
+def stepwise(maxout, outs, inp):
+    return torch.stack([maxout(torch.cat([out, prev], 1))
+                        for out, prev in zip(outs, inp)])
+
+
+def sequence(maxout, outs, inp):
+    return maxout(torch.cat([outs, inp], 2))
+
+
+def benchmark(fn, maxout, batches, backward=True):
+    start = time.time()
+    for outs, inp in batches:
+        out = fn(maxout, outs, inp)
+        if backward:
+            out.sum().backward()
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', default='reverse,double,skip1reverse')
+    parser.add_argument('--train_len', default=2000, type=int)
+    parser.add_argument('--min_len', default=1, type=int)
+    parser.add_argument('--max_len', default=15, type=int)
+    parser.add_argument('--batch_size', default=50, type=int)
+    parser.add_argument('--emb_dim', default=24, type=int)
+    parser.add_argument('--hid_dim', default=64, type=int)
+    parser.add_argument('--maxout', default=2, type=int)
+    parser.add_argument('--forward_only', action='store_true')
+    args = parser.parse_args()
+
+    vocab = list(string.ascii_letters)
+    for task in args.tasks.split(','):
+        src, trg = zip(*d.generate_set(
+            args.train_len, vocab, args.min_len, args.max_len,
+            getattr(d, task)))
+        src, trg = list(map(list, src)), list(map(list, trg))
+        src_dict = Dict(pad_token=u.PAD, eos_token=u.EOS, bos_token=u.BOS)
+        src_dict.fit(src, trg)
+        dataset = PairedDataset(
+            src, trg, {'src': src_dict, 'trg': src_dict},
+            batch_size=args.batch_size)
+        model = EncoderDecoder(
+            1, args.emb_dim, args.hid_dim, args.hid_dim, src_dict,
+            maxout=args.maxout)
+        u.initialize_model(model)
+        batches = [decoder_outputs(model, *dataset[i])
+                   for i in range(len(dataset))]
+        tokens = sum(outs.size(0) * outs.size(1) for outs, _ in batches)
+
+        for name, fn in [('stepwise', stepwise), ('sequence', sequence)]:
+            seconds = benchmark(fn, model.decoder.maxout, batches,
+                                backward=not args.forward_only)
+            print('{:>14} {:>9}: {:8.2f} ms; {:10.1f} tokens/sec'.format(
+                task, name, seconds * 1000, tokens / seconds))
@@ -0,0 +1,143 @@
+import time
+
+import torch
+import torch.nn as nn
+from torch.autograd import Variable
+
+from seqmod.modules import custom
+from seqmod import utils as u
+
+
+class OldNormalizedGRUCell(nn.GRUCell):
+    """
+    Copy of NormalizedGRUCell before its gates were computed with single
+    GEMMs: four mm calls on narrowed and transposed weight slices per step.
+    Statistics are taken with keepdim so that it runs for any batch size
+    (the original `mean(1).expand_as(x)` broadcast them along the feature
+    dimension). Its outputs are therefore comparable, but not identical,
+    to those of the original cell.
+    """
+    def __init__(self, input_size, hidden_size, bias=True):
+        super(OldNormalizedGRUCell, self).__init__(
+            input_size, hidden_size, bias)
+        self.gamma_ih = nn.Parameter(torch.ones(3 * self.hidden_size))
+        self.gamma_hh = nn.Parameter(torch.ones(3 * self.hidden_size))
+        self.eps = 0
+
+    def _layer_norm_x(self, x, g, bias=None):
+        mean = x.mean(1, keepdim=True).expand_as(x)
+        std = x.std(1, keepdim=True).expand_as(x)
+        output = g.expand_as(x) * ((x - mean) / (std + self.eps))
+        if bias is not None:
+            output += bias.expand_as(x)
+        return output
+
+    def _layer_norm_h(self, x, g, bias=None):
+        mean = x.mean(1, keepdim=True).expand_as(x)
+        output = g.expand_as(x) * (x - mean)
+        if bias is not None:
+            output += bias.expand_as(x)
+        return output
+
+    def forward(self, x, h):
+        H = self.hidden_size
+
+        def bias(b, start, size):
+            return None if not self.bias else b.narrow(0, start, size)
+
+        weight_ih_rz = self.weight_ih.narrow(0, 0, 2 * H).transpose(0, 1)
+        ih_rz = self._layer_norm_x(
+            torch.mm(x, weight_ih_rz), self.gamma_ih.narrow(0, 0, 2 * H),
+            bias(self.bias_ih, 0, 2 * H))
+        weight_hh_rz = self.weight_hh.narrow(0, 0, 2 * H).transpose(0, 1)
+        hh_rz = self._layer_norm_h(
+            torch.mm(h, weight_hh_rz), self.gamma_hh.narrow(0, 0, 2 * H),
+            bias(self.bias_hh, 0, 2 * H))
+        rz = torch.sigmoid(ih_rz + hh_rz)
+        r, z = rz.narrow(1, 0, H), rz.narrow(1, H, H)
+
+        weight_ih_n = self.weight_ih.narrow(0, 2 * H, H).transpose(0, 1)
+        ih_n = self._layer_norm_x(
+            torch.mm(x, weight_ih_n), self.gamma_ih.narrow(0, 2 * H, H),
+            bias(self.bias_ih, 2 * H, H))
+        weight_hh_n = self.weight_hh.narrow(0, 2 * H, H).transpose(0, 1)
+        hh_n = self._layer_norm_h(
+            torch.mm(h, weight_hh_n), self.gamma_hh.narrow(0, 2 * H, H),
+            bias(self.bias_hh, 2 * H, H))
+        n = torch.tanh(ih_n + r * hh_n)
+        return (1 - z) * n + z * h
+
+
+def old_stepwise(rnn):
+    """
+    Run the old cells (with the weights of a NormalizedGRU) time-major,
+    as the old StackedNormalizedGRU did
+    """
+    cells = []
+    for layer in rnn.layers:
+        cell = OldNormalizedGRUCell(layer.input_size, layer.hidden_size)
+        cell.load_state_dict(layer.state_dict())
+        if layer.weight_ih.is_cuda:
+            cell.cuda()
+        cells.append(cell)
+
+    def run(inp, hidden):
+        outs = []
+        for x_t in inp:
+            h_t = []
+            for i, cell in enumerate(cells):
+                x_t = cell(x_t, hidden[i])
+                h_t.append(x_t)
+            hidden = torch.stack(h_t)
+            outs.append(x_t)
+        return torch.stack(outs), hidden
+    return run
+
+
+def benchmark(rnn, inp, hidden, runs, backward=True):
+    """
+    Average seconds per forward (and backward) pass over a sequence
+    """
+    rnn(inp, hidden)            # warm up
+    start = time.time()
+    for _ in range(runs):
+        outs, _ = rnn(inp, hidden)
+        if backward:
+            outs.sum().backward()
+    if inp.is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start) / runs
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seq_len', default=35, type=int)
+    parser.add_argument('--batch_size', default=20, type=int)
+    parser.add_argument('--emb_dim', default=200, type=int)
+    parser.add_argument('--hid_dim', default=200, type=int)
+    parser.add_argument('--layers', default=2, type=int)
+    parser.add_argument('--runs', default=20, type=int)
+    parser.add_argument('--forward_only', action='store_true')
+    parser.add_argument('--gpu', action='store_true')
+    args = parser.parse_args()
+
+    inp = Variable(torch.randn(args.seq_len, args.batch_size, args.emb_dim))
+    hidden = Variable(torch.zeros(args.layers, args.batch_size, args.hid_dim))
+    gru = torch.nn.GRU(args.emb_dim, args.hid_dim, num_layers=args.layers)
+    rnn = custom.NormalizedGRU(args.emb_dim, args.hid_dim, args.layers)
+    u.initialize_model(rnn)
+    if args.gpu:
+        inp, hidden, gru, rnn = inp.cuda(), hidden.cuda(), gru.cuda(), \
+            rnn.cuda()
+
+    def report(name, rnn):
+        seconds = benchmark(rnn, inp, hidden, args.runs,
+                            backward=not args.forward_only)
+        print('{:>16}: {:8.2f} ms/seq; {:10.1f} tokens/sec'.format(
+            name, seconds * 1000, args.seq_len * args.batch_size / seconds))
+
+    report('GRU', gru)
+    report('NormalizedGRU*', old_stepwise(rnn))
+    report('NormalizedGRU', rnn)
+    print('* old cell (per-gate GEMMs), time-major; see OldNormalizedGRUCell')
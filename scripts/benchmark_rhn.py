@@ -0,0 +1,67 @@
+
+import time
+
+import torch
+from torch.autograd import Variable
+
+from seqmod.modules import custom
+from seqmod import utils as u
+
+
+def benchmark(rnn, inp, hidden, runs, backward=True):
+    """
+    Average seconds per forward (and backward) pass over a sequence
+    """
+    rnn(inp, hidden)            # warm up
+    start = time.time()
+    for _ in range(runs):
+        outs, _ = rnn(inp, hidden)
+        if backward:
+            outs.sum().backward()
+    if inp.is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start) / runs
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seq_len', default=35, type=int)
+    parser.add_argument('--batch_size', default=20, type=int)
+    parser.add_argument('--emb_dim', default=200, type=int)
+    parser.add_argument('--hid_dim', default=200, type=int)
+    parser.add_argument('--depth', default=3, type=int)
+    parser.add_argument('--runs', default=20, type=int)
+    parser.add_argument('--untied_noise', action='store_true')
+    parser.add_argument('--forward_only', action='store_true')
+    parser.add_argument('--gpu', action='store_true')
+    args = parser.parse_args()
+
+    inp = Variable(torch.randn(args.seq_len, args.batch_size, args.emb_dim))
+    hidden = Variable(torch.zeros(1, args.batch_size, args.hid_dim))
+    lstm = torch.nn.LSTM(args.emb_dim, args.hid_dim)
+    lstm_hidden = (hidden, hidden)
+    if args.gpu:
+        inp, hidden, lstm = inp.cuda(), hidden.cuda(), lstm.cuda()
+        lstm_hidden = (hidden, hidden)
+
+    def report(name, rnn, hidden):
+        seconds = benchmark(rnn, inp, hidden, args.runs,
+                            backward=not args.forward_only)
+        print('{:>16}: {:8.2f} ms/seq; {:10.1f} tokens/sec'.format(
+            name, seconds * 1000, args.seq_len * args.batch_size / seconds))
+
+    report('LSTM', lstm, lstm_hidden)
+    for cls, fused_cls in [(custom.RHN, custom.RHNFused),
+                           (custom.RHNCoupled, custom.RHNCoupledFused)]:
+        rhn = cls(args.emb_dim, args.hid_dim, num_layers=args.depth,
+                  tied_noise=not args.untied_noise)
+        u.initialize_model(rhn)
+        fused = fused_cls.from_rhn(rhn)
+        lowmem = fused_cls.from_rhn(rhn, precompute_inputs=False)
+        if args.gpu:
+            rhn, fused, lowmem = rhn.cuda(), fused.cuda(), lowmem.cuda()
+        report(cls.__name__, rhn, hidden)
+        report(fused_cls.__name__, fused, hidden)
+        report(fused_cls.__name__ + '*', lowmem, hidden)
+    print('* input projected at each step')
@@ -0,0 +1,43 @@
+
+from seqmod.misc.shortlist import Shortlist
+from seqmod import utils as u
+
+
+def read_lines(path, level='word'):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            yield line.split() if level == 'word' else list(line)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Build a decoding shortlist from parallel training data')
+    parser.add_argument('model', help='EncoderDecoder saved by u.save_model '
+                        'or checkpoint saved by u.save_checkpoint')
+    parser.add_argument('src', help='source training file')
+    parser.add_argument('trg', help='target training file (parallel to src)')
+    parser.add_argument('output', help='path to save the shortlist')
+    parser.add_argument('--level', default='word')
+    parser.add_argument('--top_n', default=1000, type=int)
+    parser.add_argument('--num_candidates', default=50, type=int)
+    parser.add_argument('--min_count', default=2, type=int)
+    args = parser.parse_args()
+
+    model = u.load_model(args.model)
+    if isinstance(model, dict):
+        model = model['model']
+
+    shortlist = Shortlist.fit(
+        read_lines(args.src, args.level), read_lines(args.trg, args.level),
+        model.src_dict, model.trg_dict, top_n=args.top_n,
+        num_candidates=args.num_candidates, min_count=args.min_count)
+    shortlist.to_disk(args.output)
+
+    sizes = [len(c) for c in shortlist.candidates.values()]
+    print(' * frequent symbols: %d' % len(shortlist))
+    print(' * source symbols with candidates: %d' % len(sizes))
+    print(' * average candidates per symbol: %.2f' %
+          (sum(sizes) / max(1, len(sizes))))
+    print(' * target vocabulary size: %d' % len(model.trg_dict))
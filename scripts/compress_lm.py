@@ -0,0 +1,77 @@
+"""
+Compress the output projection of a trained LM to a low-rank factorization
+(see LM.compress_projection) and optionally fine-tune it.
+
+    python scripts/compress_lm.py models/lm.pt --rank 128 --path data/ \
+        --epochs 1 --output models/lm-r128
+"""
+
+from seqmod.misc.dataset import BlockDataset
+from seqmod.misc.optimizer import Optimizer, sparse_parameters
+from seqmod.misc.trainer import Trainer
+from seqmod.misc.loggers import StdLogger
+from seqmod.misc.preprocess import text_processor
+from seqmod import utils as u
+
+from train_lm import load_lines
+
+
+def perplexity(trainer):
+    return trainer.validate_model().pack(labels=True)['loss']
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', help='checkpoint saved by u.save_checkpoint')
+    parser.add_argument('--rank', required=True, type=int)
+    parser.add_argument('--output', required=True, help='output prefix')
+    # fine-tuning
+    parser.add_argument('--path', help='text to evaluate and fine-tune on')
+    parser.add_argument('--level', default='token')
+    parser.add_argument('--dev_split', default=0.1, type=float)
+    parser.add_argument('--epochs', default=0, type=int)
+    parser.add_argument('--batch_size', default=20, type=int)
+    parser.add_argument('--bptt', default=35, type=int)
+    parser.add_argument('--optim', default='Adam')
+    parser.add_argument('--lr', default=0.001, type=float)
+    parser.add_argument('--max_norm', default=5., type=float)
+    parser.add_argument('--checkpoint', default=200, type=int)
+    parser.add_argument('--gpu', action='store_true')
+    args = parser.parse_args()
+
+    checkpoint = u.load_model(args.model)
+    model, d = checkpoint['model'], checkpoint['d']
+    model.cuda() if args.gpu else model.cpu()
+
+    trainer = None
+    if args.path is not None:
+        lines = load_lines(
+            args.path, processor=text_processor(level=args.level))
+        train, valid = BlockDataset(
+            lines, d, args.batch_size, args.bptt, gpu=args.gpu
+        ).splits(test=args.dev_split, dev=None)
+        trainer = Trainer(model, {'train': train, 'valid': valid}, None)
+        trainer.add_loggers(StdLogger())
+        print(' * perplexity before compression: %.3f' % perplexity(trainer))
+
+    n_params = model.n_params()
+    model.compress_projection(args.rank)
+    print(' * number of parameters: %d -> %d' % (n_params, model.n_params()))
+
+    if trainer is not None:
+        print(' * perplexity after compression: %.3f' % perplexity(trainer))
+        if args.epochs > 0:
+            trainer.optimizer = Optimizer(
+                model.parameters(), args.optim, lr=args.lr,
+                max_norm=args.max_norm,
+                sparse_params=sparse_parameters(model))
+            (model, _), _ = trainer.train(args.epochs, args.checkpoint)
+            # train returns the best model on the cpu
+            if args.gpu:
+                model.cuda()
+            trainer.model = model
+            print(' * perplexity after fine-tuning: %.3f' %
+                  perplexity(trainer))
+
+    u.save_model(model, args.output, d=d)
@@ -0,0 +1,157 @@
+"""
+Compare a trained LM or EncoderDecoder against its int8 version
+(u.quantize_for_inference) on held-out data.
+
+    python scripts/quantize_report.py lm.pt --src test.txt --dict lm.dict.pt
+    python scripts/quantize_report.py encdec.pt --src test.src --trg test.trg
+
+For an LM, it reports perplexity and how often both models agree on the
+most likely next symbol. For an EncoderDecoder, it reports the perplexity
+of the references and the BLEU of the int8 greedy translations against
+the float translations (a proxy for how much output quality changes). It
+also reports timings of both models.
+"""
+
+import math
+import time
+from collections import Counter
+
+import torch
+import torch.nn.functional as F
+from torch.autograd import Variable
+
+from seqmod.modules.lm import LM
+from seqmod.misc.dataset import BlockDataset, pad_pack_batch
+from seqmod import utils as u
+
+
+def read_lines(path, level='word', max_lines=None):
+    with open(path) as f:
+        for idx, line in enumerate(f):
+            if max_lines is not None and idx >= max_lines:
+                break
+            line = line.strip()
+            yield line.split() if level == 'word' else list(line)
+
+
+def ngrams(seq, n):
+    return Counter(tuple(seq[i:i+n]) for i in range(len(seq) - n + 1))
+
+
+def bleu(hyps, refs, max_n=4):
+    """
+    Corpus-level BLEU of hyps against single refs (lists of symbols)
+    """
+    matches, totals = [0] * max_n, [0] * max_n
+    hyp_len, ref_len = 0, 0
+    for hyp, ref in zip(hyps, refs):
+        hyp_len, ref_len = hyp_len + len(hyp), ref_len + len(ref)
+        for n in range(1, max_n + 1):
+            hyp_ngrams, ref_ngrams = ngrams(hyp, n), ngrams(ref, n)
+            matches[n-1] += sum((hyp_ngrams & ref_ngrams).values())
+            totals[n-1] += max(0, len(hyp) - n + 1)
+    if min(matches) == 0:
+        return 0.
+    log_prec = sum(math.log(m / t) for m, t in zip(matches, totals)) / max_n
+    brevity = min(0., 1 - ref_len / max(hyp_len, 1))
+    return 100 * math.exp(log_prec + brevity)
+
+
+def timed(fn):
+    start = time.time()
+    result = fn()
+    return result, time.time() - start
+
+
+def lm_report(models, dataset):
+    def evaluate(model):
+        hidden, loss, preds = None, 0, []
+        for batch_num in range(len(dataset)):
+            source, targets = dataset[batch_num]
+            outs, hidden, _ = model(source, hidden=hidden, project=False)
+            logprobs = model.logprobs(outs)
+            loss += F.nll_loss(logprobs, targets.view(-1)).data[0]
+            preds.append(logprobs.max(1)[1].data)
+        return math.exp(loss / len(dataset)), torch.cat(preds)
+
+    results = {name: timed(lambda: evaluate(model))
+               for name, model in models.items()}
+    for name, ((ppl, _), seconds) in results.items():
+        print(' * {}: perplexity {:.3f}; {:.2f} secs'.format(
+            name, ppl, seconds))
+    float_preds, int8_preds = results['float'][0][1], results['int8'][0][1]
+    print(' * next symbol agreement: {:.2f}%'.format(
+        100 * float_preds.eq(int8_preds).float().mean()))
+
+
+def encdec_report(models, src, trg, batch_size):
+    pairs = list(zip(src, trg))
+    eos, pad = models['float'].trg_dict.get_eos(), \
+        models['float'].trg_dict.get_pad()
+
+    def strip(hyp):
+        return [c for c in hyp[:hyp.index(eos) if eos in hyp else None]
+                if c != pad]
+
+    def translate(model):
+        hyps = []
+        for start in range(0, len(src), batch_size):
+            batch = pad_pack_batch(
+                src[start:start + batch_size], model.src_dict.get_pad())
+            _, batch_hyps, _ = model.translate(
+                Variable(batch, volatile=True), return_atts=False)
+            hyps.extend(strip(hyp) for hyp in batch_hyps)
+        return hyps
+
+    translations = {}
+    for name, model in models.items():
+        (scores, _), score_secs = timed(lambda: model.score_pairs(pairs))
+        ntokens = sum(len(t) - 1 for t in trg)
+        ppl = math.exp(-sum(scores) / ntokens)
+        translations[name], secs = timed(lambda: translate(model))
+        print(' * {}: perplexity {:.3f} ({:.2f} secs); '
+              'translation {:.2f} secs'.format(name, ppl, score_secs, secs))
+    print(' * BLEU of int8 against float translations: {:.2f}'.format(
+        bleu(translations['int8'], translations['float'])))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', help='model saved by u.save_model or '
+                        'checkpoint saved by u.save_checkpoint')
+    parser.add_argument('--src', required=True, help='held-out text')
+    parser.add_argument('--trg', help='held-out references (EncoderDecoder)')
+    parser.add_argument('--dict', help='Dict of the LM if the model '
+                        'is not a checkpoint')
+    parser.add_argument('--level', default='word')
+    parser.add_argument('--max_lines', default=1000, type=int)
+    parser.add_argument('--batch_size', default=20, type=int)
+    parser.add_argument('--bptt', default=35, type=int)
+    args = parser.parse_args()
+
+    model, d = u.load_model(args.model), None
+    if isinstance(model, dict):
+        model, d = model['model'], model['d']
+    model = model.cpu()
+    model.eval()
+    models = {'float': model, 'int8': u.quantize_for_inference(model)}
+    print(' * int8 weights computed by {}'.format(
+        'torch.quantization' if hasattr(torch, 'quantization') else
+        'rounding (no speed-up)'))
+
+    src = list(read_lines(args.src, args.level, args.max_lines))
+    if isinstance(model, LM):
+        d = u.load_model(args.dict) if args.dict else d
+        if d is None:
+            raise ValueError("LM report requires a Dict (--dict)")
+        dataset = BlockDataset(
+            src, d, args.batch_size, args.bptt, evaluation=True)
+        lm_report(models, dataset)
+    else:
+        if args.trg is None:
+            raise ValueError("EncoderDecoder report requires --trg")
+        trg = list(read_lines(args.trg, args.level, args.max_lines))
+        encdec_report(
+            models, list(model.src_dict.transform(src)),
+            list(model.trg_dict.transform(trg)), args.batch_size)
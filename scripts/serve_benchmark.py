@@ -0,0 +1,129 @@
+import time
+import random; random.seed(1001)
+import asyncio
+
+import torch
+try:
+    torch.cuda.manual_seed(1001)
+    torch.manual_seed(1001)
+except:
+    print('no NVIDIA driver found')
+
+from seqmod.modules.lm import LM
+from seqmod.misc.dataset import Dict
+from seqmod.serving import ContinuousBatcher
+from seqmod import utils as u
+
+
+def make_random_lm(vocab, emb_dim, hid_dim, num_layers, cell):
+    """
+    Build an untrained LM over a synthetic vocabulary. Good enough to measure
+    throughput, since the cost of a decoding step doesn't depend on training.
+    """
+    words = ['w%d' % i for i in range(vocab)]
+    d = Dict(eos_token=u.EOS, force_unk=True).fit([words])
+    m = LM(len(d), emb_dim, hid_dim, num_layers=num_layers, cell=cell)
+    u.initialize_model(m)
+    return m, d
+
+
+def make_requests(n, max_seq_len):
+    requests = []
+    for _ in range(n):
+        requests.append({
+            'method': random.choice(['sample', 'argmax']),
+            'temperature': random.choice([0.5, 0.8, 1.0, 1.2]),
+            'max_seq_len': random.randint(max_seq_len // 4, max_seq_len)})
+    return requests
+
+
+def run_sequential(m, d, requests, gpu=False):
+    """
+    Baseline: one LM.generate call per request
+    """
+    latencies, start = [], time.time()
+    for request in requests:
+        # requests arrive all at once, so latency includes queueing time
+        m.generate(d, batch_size=1, gpu=gpu, ignore_eos=True, **request)
+        latencies.append(time.time() - start)
+    return time.time() - start, latencies
+
+
+def run_batched(m, d, requests, max_batch_size, rate=None, gpu=False):
+    """
+    Continuous batching. If `rate` is given, requests arrive following a
+    poisson process with `rate` requests per second, otherwise all at once.
+    """
+    batcher = ContinuousBatcher(m, d, max_batch_size=max_batch_size, gpu=gpu)
+    batcher.eos = None          # ignore_eos for comparable output lengths
+    latencies = []
+
+    async def client(request, delay):
+        await asyncio.sleep(delay)
+        start = time.time()
+        await batcher.generate(**request)
+        latencies.append(time.time() - start)
+
+    async def main():
+        server = asyncio.ensure_future(batcher.run())
+        delay, clients = 0, []
+        for request in requests:
+            clients.append(client(request, delay))
+            if rate is not None:
+                delay += random.expovariate(rate)
+        await asyncio.gather(*clients)
+        server.cancel()
+
+    start = time.time()
+    asyncio.get_event_loop().run_until_complete(main())
+    return time.time() - start, latencies, batcher.steps
+
+
+def report(name, duration, latencies, requests):
+    latencies = sorted(latencies)
+    tokens = sum(r['max_seq_len'] for r in requests)
+    print('{:>12}: {:7.3f} sec; {:8.2f} req/sec; {:9.2f} tokens/sec; '
+          'latency p50 {:.3f} p95 {:.3f}'.format(
+              name, duration, len(requests) / duration, tokens / duration,
+              latencies[len(latencies) // 2],
+              latencies[int(len(latencies) * 0.95)]))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', help='checkpoint saved by save_checkpoint, '
+                        'a random LM will be used if not given')
+    parser.add_argument('--vocab', default=10000, type=int)
+    parser.add_argument('--emb_dim', default=200, type=int)
+    parser.add_argument('--hid_dim', default=200, type=int)
+    parser.add_argument('--num_layers', default=2, type=int)
+    parser.add_argument('--cell', default='LSTM')
+    parser.add_argument('--num_requests', default=200, type=int)
+    parser.add_argument('--max_seq_len', default=50, type=int)
+    parser.add_argument('--max_batch_size', default=32, type=int)
+    parser.add_argument('--rate', default=None, type=float)
+    parser.add_argument('--skip_sequential', action='store_true')
+    parser.add_argument('--gpu', action='store_true')
+    args = parser.parse_args()
+
+    if args.model is not None:
+        checkpoint = u.load_model(args.model)
+        m, d = checkpoint['model'], checkpoint['d']
+    else:
+        m, d = make_random_lm(
+            args.vocab, args.emb_dim, args.hid_dim, args.num_layers, args.cell)
+    m.eval()
+    if args.gpu:
+        m.cuda()
+
+    requests = make_requests(args.num_requests, args.max_seq_len)
+
+    if not args.skip_sequential:
+        duration, latencies = run_sequential(m, d, requests, gpu=args.gpu)
+        report('sequential', duration, latencies, requests)
+
+    duration, latencies, steps = run_batched(
+        m, d, requests, args.max_batch_size, rate=args.rate, gpu=args.gpu)
+    report('continuous', duration, latencies, requests)
+    print(' * batched decoding steps: %d' % steps)
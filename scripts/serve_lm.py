@@ -0,0 +1,24 @@
+from seqmod.serving import ContinuousBatcher, serve
+from seqmod import utils as u
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', help='checkpoint saved by u.save_checkpoint')
+    parser.add_argument('--mode', default='stdio', help='stdio or http')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default=8080, type=int)
+    parser.add_argument('--max_batch_size', default=32, type=int)
+    parser.add_argument('--gpu', action='store_true')
+    args = parser.parse_args()
+
+    checkpoint = u.load_model(args.model)
+    model, d = checkpoint['model'], checkpoint['d']
+    model.eval()
+    if args.gpu:
+        model.cuda()
+
+    batcher = ContinuousBatcher(
+        model, d, max_batch_size=args.max_batch_size, gpu=args.gpu)
+    serve(batcher, mode=args.mode, host=args.host, port=args.port)
@@ -18,7 +18,7 @@ from torch.autograd import Variable
 from seqmod.modules.encoder_decoder import EncoderDecoder
 from seqmod import utils as u
 
-from seqmod.misc.optimizer import Optimizer
+from seqmod.misc.optimizer import Optimizer, sparse_parameters
 from seqmod.misc.early_stopping import EarlyStopping
 from seqmod.misc.trainer import Trainer
 from seqmod.misc.loggers import StdLogger, VisdomLogger
@@ -93,12 +93,16 @@ if __name__ == '__main__':
     # model
     parser.add_argument('--layers', default=1, type=int)
     parser.add_argument('--cell', default='LSTM', type=str)
+    parser.add_argument('--encoder', default='rnn', type=str)
+    parser.add_argument('--max_src_len', default=1024, type=int)
     parser.add_argument('--emb_dim', default=24, type=int)
     parser.add_argument('--hid_dim', default=64, type=int)
     parser.add_argument('--att_dim', default=64, type=int)
     parser.add_argument('--att_type', default='Global', type=str)
+    parser.add_argument('--att_window', default=10, type=int)
     parser.add_argument('--maxout', default=0, type=int)
     parser.add_argument('--tie_weights', action='store_true')
+    parser.add_argument('--sparse', action='store_true')
     # training
     parser.add_argument('--epochs', default=5, type=int)
     parser.add_argument('--batch_size', default=20, type=int)
@@ -151,7 +155,11 @@ if __name__ == '__main__':
         args.att_dim, src_dict, att_type=args.att_type, dropout=args.dropout,
         word_dropout=args.word_dropout,
         bidi=True, cell=args.cell, maxout=args.maxout,
-        tie_weights=args.tie_weights)
+        tie_weights=args.tie_weights, att_window=args.att_window,
+        encoder=args.encoder, max_src_len=args.max_src_len,
+        sparse=args.sparse)
+    # hooks translate the same target (only encode it once per checkpoint)
+    model.enable_encoder_cache(size=8)
 
     # model.freeze_submodule('encoder')
     # model.encoder.register_backward_hook(u.log_grad)
@@ -161,7 +169,8 @@ if __name__ == '__main__':
         model, rnn={'type': 'orthogonal', 'args': {'gain': 1.0}})
 
     optimizer = Optimizer(
-        model.parameters(), args.optim, lr=args.lr, max_norm=args.max_norm)
+        model.parameters(), args.optim, lr=args.lr, max_norm=args.max_norm,
+        sparse_params=sparse_parameters(model))
 
     criterion = make_criterion(len(src_dict), src_dict.get_pad())
 
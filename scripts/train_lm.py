@@ -12,11 +12,12 @@ except:
     torch.manual_seed(1001)
 
 from seqmod.modules.lm import LM
+from seqmod.modules.softmax import frequency_cutoffs, unigram_freqs
 from seqmod import utils as u
 
 from seqmod.misc.trainer import Trainer
 from seqmod.misc.loggers import StdLogger, VisdomLogger
-from seqmod.misc.optimizer import Optimizer
+from seqmod.misc.optimizer import Optimizer, sparse_parameters
 from seqmod.misc.dataset import Dict, BlockDataset
 from seqmod.misc.preprocess import text_processor
 from seqmod.misc.early_stopping import EarlyStopping
@@ -64,10 +65,16 @@ if __name__ == '__main__':
     parser.add_argument('--dropout', default=0.3, type=float)
     parser.add_argument('--word_dropout', default=0.0, type=float)
     parser.add_argument('--tie_weights', action='store_true')
+    parser.add_argument('--sparse', action='store_true')
+    parser.add_argument('--project_rank', default=0, type=int)
     parser.add_argument('--deepout_layers', default=0, type=int)
     parser.add_argument('--deepout_act', default='MaxOut')
     parser.add_argument('--maxouts', default=2, type=int)
     parser.add_argument('--train_init', action='store_true')
+    parser.add_argument('--softmax', default='full')
+    parser.add_argument('--coverage', nargs='+', type=float,
+                        default=(0.8, 0.9, 0.95))
+    parser.add_argument('--num_sampled', default=1024, type=int)
     # dataset
     parser.add_argument('--path', required=True)
     parser.add_argument('--processed', action='store_true')
@@ -83,6 +90,7 @@ if __name__ == '__main__':
     parser.add_argument('--epochs', default=10, type=int)
     parser.add_argument('--batch_size', default=20, type=int)
     parser.add_argument('--bptt', default=20, type=int)
+    parser.add_argument('--shard_size', default=None, type=int)
     parser.add_argument('--gpu', action='store_true')
     # - optimizer
     parser.add_argument('--optim', default='Adam', type=str)
@@ -154,12 +162,21 @@ if __name__ == '__main__':
     print(' * number of train batches. %d' % len(train))
 
     print('Building model...')
+    cutoffs, freqs = None, None
+    if args.softmax == 'adaptive':
+        cutoffs = frequency_cutoffs(d, coverage=args.coverage)
+        print(' * adaptive softmax cutoffs. %s' % str(cutoffs))
+    elif args.softmax == 'sampled':
+        freqs = unigram_freqs(d)
     m = LM(len(d), args.emb_dim, args.hid_dim,
            num_layers=args.num_layers, cell=args.cell, dropout=args.dropout,
            att_dim=args.att_dim, tie_weights=args.tie_weights,
            deepout_layers=args.deepout_layers, train_init=args.train_init,
            deepout_act=args.deepout_act, maxouts=args.maxouts,
-           word_dropout=args.word_dropout, target_code=d.get_unk())
+           word_dropout=args.word_dropout, target_code=d.get_unk(),
+           softmax=args.softmax, cutoffs=cutoffs, freqs=freqs,
+           num_sampled=args.num_sampled, sparse=args.sparse,
+           project_rank=args.project_rank)
 
     u.initialize_model(m)
 
@@ -172,7 +189,7 @@ if __name__ == '__main__':
     optim = Optimizer(
         m.parameters(), args.optim, lr=args.lr, max_norm=args.max_norm,
         lr_decay=args.lr_decay, start_decay_at=args.start_decay_at,
-        decay_every=args.decay_every)
+        decay_every=args.decay_every, sparse_params=sparse_parameters(m))
 
     # create trainer
     trainer = Trainer(m, {"train": train, "test": test, "valid": valid}, optim)
@@ -196,7 +213,7 @@ if __name__ == '__main__':
         trainer.add_loggers(visdom_logger)
 
     (best_model, valid_loss), test_loss = trainer.train(
-        args.epochs, args.checkpoint)
+        args.epochs, args.checkpoint, split=args.shard_size)
 
     if args.save:
         u.save_checkpoint(args.save_path, best_model, d, vars(args), ppl=test_loss)
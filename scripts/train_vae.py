@@ -7,7 +7,7 @@ from torch.autograd import Variable
 
 from seqmod import utils as u
 from seqmod.misc.loggers import StdLogger, VisdomLogger
-from seqmod.misc.optimizer import Optimizer
+from seqmod.misc.optimizer import Optimizer, sparse_parameters
 from seqmod.misc.preprocess import text_processor
 from seqmod.misc.dataset import PairedDataset, Dict
 from seqmod.misc.trainer import Trainer
@@ -88,6 +88,7 @@ if __name__ == '__main__':
     parser.add_argument('--z_dim', default=50, type=int)
     parser.add_argument('--cell', default='LSTM')
     parser.add_argument('--tie_weights', action='store_true')
+    parser.add_argument('--sparse', action='store_true')
     parser.add_argument('--project_init', action='store_true')
     parser.add_argument('--dropout', default=0.0, type=float)
     parser.add_argument('--word_dropout', default=0.0, type=float)
@@ -169,7 +170,7 @@ if __name__ == '__main__':
         num_layers=args.num_layers, cell=args.cell, dropout=args.dropout,
         add_z=args.add_z, word_dropout=args.word_dropout,
         tie_weights=args.tie_weights, project_init=args.project_init,
-        inflection_point=args.inflection_point)
+        inflection_point=args.inflection_point, sparse=args.sparse)
     print(model)
 
     u.initialize_model(model)
@@ -193,7 +194,7 @@ if __name__ == '__main__':
         max_norm=args.max_norm, weight_decay=args.weight_decay,
         # SGD-only
         start_decay_at=args.start_decay_at, lr_decay=args.lr_decay,
-        on_lr_update=on_lr_update)
+        on_lr_update=on_lr_update, sparse_params=sparse_parameters(model))
 
     class VAETrainer(Trainer):
         def on_batch_end(self, epoch, batch, loss):
@@ -4,4 +4,5 @@ from seqmod.misc.early_stopping import EarlyStopping, EarlyStoppingException
 from seqmod.misc.loggers import StdLogger, VisdomLogger
 from seqmod.misc.optimizer import Optimizer
 from seqmod.misc.preprocess import text_processor
+from seqmod.misc.shortlist import Shortlist
 from seqmod.misc.trainer import Trainer
@@ -41,7 +41,7 @@ class Beam(object):
         """
         return len(self.source_beams)
 
-    def _new_beam(self, outs):
+    def _new_beam(self, outs, ids=None):
         """
         Computes a new beam based on the current model output and the hist.
         """
@@ -59,6 +59,9 @@ class Beam(object):
         source_beams = flatten_ids / vocab
         beam_first_ids = source_beams * vocab
         beam = flatten_ids - beam_first_ids
+        if ids is not None:
+            # map output columns back to vocabulary indices
+            beam = ids.index_select(0, beam)
         return scores, source_beams, beam
 
     def get_source_beam(self, step=-1):
@@ -81,11 +84,18 @@ class Beam(object):
         """
         return beam[0] == self.eos
 
-    def advance(self, outs):
+    def advance(self, outs, ids=None):
         """
         Runs a decoder step accumulating the path and the ids.
-        """
-        scores, source_beams, beam = self._new_beam(outs)
+
+        Parameters:
+        -----------
+        outs: torch.Tensor (width x vocab), output scores
+        ids: None or torch.LongTensor (vocab), vocabulary index of each
+            column in outs, in case they only cover part of the vocabulary
+            (e.g. a shortlist).
+        """
+        scores, source_beams, beam = self._new_beam(outs, ids=ids)
         if self.finished(beam):
             self.active = False
         self.scores = scores
@@ -1,14 +1,66 @@
-
+import torch.nn as nn
 import torch.optim as optim
-from torch.nn.utils import clip_grad_norm
+
+
+# Optimizers for sparse gradients matching a dense optimizer
+SPARSE_METHODS = {'Adam': 'SparseAdam', 'SGD': 'SGD', 'Adagrad': 'Adagrad'}
+
+
+def sparse_parameters(model):
+    """
+    Trainable parameters of a model that receive sparse gradients
+    (i.e. weights of nn.Embedding layers with sparse=True)
+    """
+    return [m.weight for m in model.modules()
+            if isinstance(m, nn.Embedding) and m.sparse and
+            m.weight.requires_grad]
+
+
+def clip_grad_norm(params, max_norm, norm_type=2):
+    """
+    Like torch.nn.utils.clip_grad_norm but with support for sparse
+    gradients. The total norm is computed over all gradients together.
+
+    Returns: float, total norm of the gradients (before clipping)
+    """
+    params = [p for p in params if p.grad is not None]
+    norms = []
+    for p in params:
+        grad = p.grad.data
+        if grad.is_sparse:
+            # sum duplicate indices before taking the norm
+            grad = grad.coalesce()._values()
+        norms.append(float(grad.norm(norm_type)))
+    if norm_type == float('inf'):
+        total_norm = max(norms, default=0.)
+    else:
+        total_norm = sum(n ** norm_type for n in norms) ** (1. / norm_type)
+    clip_coef = max_norm / (total_norm + 1e-6)
+    if clip_coef < 1:
+        for p in params:
+            p.grad.data.mul_(clip_coef)
+    return total_norm
 
 
 class Optimizer(object):
+    """
+    Parameters:
+    -----------
+    sparse_params: iterable of parameters with sparse gradients (see
+        sparse_parameters). They are updated by the sparse counterpart of
+        `method` (see SPARSE_METHODS) without weight decay, while the rest
+        of `params` are updated by `method`.
+    """
     def __init__(self, params, method, lr=1., max_norm=5., weight_decay=0,
                  lr_decay=1, start_decay_at=None, decay_every=1,
-                 on_lr_update=None):
-        self.params = list(params)
+                 on_lr_update=None, sparse_params=()):
+        sparse = {id(p) for p in sparse_params}
+        self.params, self.sparse_params = [], []
+        for p in params:
+            (self.sparse_params if id(p) in sparse else self.params).append(p)
         self.method = method
+        if self.sparse_params and method not in SPARSE_METHODS:
+            raise ValueError("No sparse optimizer for [%s]" % method)
         self.lr = lr
         self.max_norm = max_norm if max_norm > 0 else None
         self.weight_decay = weight_decay
@@ -20,19 +72,34 @@ class Optimizer(object):
         # attributes
         self.last_loss = None
         self.start_decay = False
-        self.optim = getattr(optim, self.method)(
-            self.params, lr=self.lr, weight_decay=self.weight_decay)
+        self.optim, self.sparse_optim = self._make_optims()
+
+    def _make_optims(self):
+        dense, sparse = None, None
+        if self.params:
+            dense = getattr(optim, self.method)(
+                self.params, lr=self.lr, weight_decay=self.weight_decay)
+        if self.sparse_params:
+            sparse = getattr(optim, SPARSE_METHODS[self.method])(
+                self.sparse_params, lr=self.lr)
+        return dense, sparse
+
+    def _optims(self):
+        return [o for o in (self.optim, self.sparse_optim) if o is not None]
 
     def step(self, norm_type=2):
         """
         Run an update eventually clipping the gradients
         """
         if self.max_norm is not None:
-            clip_grad_norm(self.params, self.max_norm, norm_type=norm_type)
-        self.optim.step()
+            clip_grad_norm(self.params + self.sparse_params, self.max_norm,
+                           norm_type=norm_type)
+        for o in self._optims():
+            o.step()
 
     def zero_grad(self):
-        self.optim.zero_grad()
+        for o in self._optims():
+            o.zero_grad()
 
     def maybe_update_lr(self, epoch, loss):
         """
@@ -50,8 +117,7 @@ class Optimizer(object):
                 if self.on_lr_update is not None:
                     self.on_lr_update(self.lr, new_lr)
                 self.lr = new_lr
-                self.optim = getattr(optim, self.method)(
-                    self.params, lr=self.lr, weight_decay=self.weight_decay)
+                self.optim, self.sparse_optim = self._make_optims()
                 return {'last_lr': last_lr, 'new_lr': self.lr}
             self.last_loss = loss
         return {}
@@ -0,0 +1,93 @@
+from collections import Counter, defaultdict
+
+import torch
+
+
+class Shortlist(object):
+    """
+    Candidate output vocabulary for decoding with a restricted softmax.
+    For a given source batch, the shortlist is the union of the `top_n`
+    most frequent target symbols, the reserved symbols and the lexical
+    translation candidates of every source symbol in the batch.
+
+    Parameters:
+    -----------
+    trg_dict: Dict, fitted target dictionary
+    candidates: dict from source symbol index to list of target symbol
+        indices (see Shortlist.fit)
+    top_n: int, number of most frequent target symbols always included
+    """
+    def __init__(self, trg_dict, candidates=None, top_n=1000):
+        self.candidates = candidates or {}
+        self.top_n = top_n
+        frequent = {trg_dict.s2i[s] for s in trg_dict.reserved
+                    if s in trg_dict.s2i}
+        for s, _ in trg_dict.counter.most_common(top_n):
+            if s in trg_dict.s2i:
+                frequent.add(trg_dict.s2i[s])
+        self.frequent = frequent
+
+    @classmethod
+    def fit(cls, src, trg, src_dict, trg_dict, top_n=1000,
+            num_candidates=50, min_count=2):
+        """
+        Build a lexical candidate table from parallel data. Source and
+        target symbols are scored by their Dice coefficient of sentence
+        co-occurrence and each source symbol keeps its `num_candidates`
+        best scoring target symbols.
+
+        Parameters:
+        -----------
+        src: list of lists of source symbols
+        trg: list of lists of target symbols (parallel to src)
+        min_count: int, minimum number of co-occurrences of a pair
+        """
+        src_counts, trg_counts = Counter(), Counter()
+        pair_counts = defaultdict(Counter)
+        for src_sent, trg_sent in zip(src, trg):
+            src_ids = {src_dict.index(s) for s in src_sent}
+            trg_ids = {trg_dict.index(s) for s in trg_sent}
+            src_counts.update(src_ids)
+            trg_counts.update(trg_ids)
+            for s in src_ids:
+                pair_counts[s].update(trg_ids)
+
+        candidates = {}
+        for s, counts in pair_counts.items():
+            scored = [(2 * count / (src_counts[s] + trg_counts[t]), t)
+                      for t, count in counts.items() if count >= min_count]
+            scored.sort(reverse=True)
+            candidates[s] = [t for _, t in scored[:num_candidates]]
+
+        return cls(trg_dict, candidates=candidates, top_n=top_n)
+
+    def __len__(self):
+        "Number of symbols that are always in the shortlist"
+        return len(self.frequent)
+
+    def ids_for(self, src):
+        """
+        Compute the shortlist for a source batch.
+
+        Parameters:
+        -----------
+        src: torch.LongTensor (seq_len x batch)
+
+        Returns:
+        --------
+        torch.LongTensor (shortlist_size), sorted target symbol indices,
+            on the same device as src
+        """
+        ids = set(self.frequent)
+        for s in set(src.contiguous().view(-1).tolist()):
+            ids.update(self.candidates.get(s, ()))
+        return src.new(sorted(ids))
+
+    @classmethod
+    def from_disk(cls, path):
+        with open(path, 'rb') as f:
+            return torch.load(f)
+
+    def to_disk(self, path):
+        with open(path, 'wb') as f:
+            torch.save(self, f)
@@ -2,3 +2,4 @@ from seqmod.modules.attention import *
 from seqmod.modules.custom import *
 from seqmod.modules.encoder_decoder import *
 from seqmod.modules.lm import *
+from seqmod.modules.softmax import *
@@ -4,6 +4,7 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.autograd import Variable
 
 import seqmod.utils as u
 
@@ -18,24 +19,47 @@ class GlobalAttention(nn.Module):
         """
         Parameters:
         -----------
-        dec_out: (batch x hid_dim)
+        dec_out: (batch x hid_dim) or (trg_len x batch x hid_dim) to attend
+            for all decoder steps at once
 
         enc_outs: (seq_len x batch x hid_dim (== att_dim))
+
+        mask: None or torch.ByteTensor (batch x seq_len), padding positions
+
+        Returns: output, weights
+        --------
+        output: (batch x hid_dim) or (trg_len x batch x hid_dim)
+
+        weights: (batch x seq_len) or (trg_len x batch x seq_len)
         """
-        # (batch x att x 1)
-        dec_att = self.linear_in(dec_out).unsqueeze(2)
-        # (batch x seq_len x att_dim) * (batch x att x 1) -> (batch x seq_len)
-        weights = torch.bmm(enc_outs.transpose(0, 1), dec_att).squeeze(2)
-        weights = F.softmax(weights)
+        single = dec_out.dim() == 2
+        if single:
+            dec_out = dec_out.unsqueeze(0)
+        trg_len, batch, _ = dec_out.size()
+        seq_len = enc_outs.size(0)
+        # (batch x seq_len x att_dim)
+        enc_outs = enc_outs.transpose(0, 1)
+        # (batch x trg_len x att_dim)
+        dec_out = dec_out.transpose(0, 1)
+        dec_att = self.linear_in(dec_out)
+        # (batch x trg_len x att) * (batch x att x seq_len)
+        #   -> (batch x trg_len x seq_len)
+        weights = torch.bmm(dec_att, enc_outs.transpose(1, 2))
         if mask is not None:
-            weights.data.masked_fill_(mask, -math.inf)
-        # (batch x 1 x seq_len) * (batch x seq_len x att) -> (batch x att)
-        weighted = weights.unsqueeze(1).bmm(
-            enc_outs.transpose(0, 1)
-        ).squeeze(1)
-        # (batch x att_dim * 2)
-        combined = torch.cat([weighted, dec_out], 1)
-        output = F.tanh(self.linear_out(combined))
+            # mask padding before normalizing
+            weights.data.masked_fill_(
+                mask.unsqueeze(1).expand_as(weights), -math.inf)
+        weights = F.softmax(weights.view(-1, seq_len))
+        weights = weights.view(batch, trg_len, seq_len)
+        # (batch x trg_len x seq_len) * (batch x seq_len x att)
+        #   -> (batch x trg_len x att)
+        weighted = torch.bmm(weights, enc_outs)
+        # (batch x trg_len x att_dim * 2)
+        combined = torch.cat([weighted, dec_out], 2)
+        output = F.tanh(self.linear_out(combined)).transpose(0, 1)
+        weights = weights.transpose(0, 1)
+        if single:
+            output, weights = output.squeeze(0), weights.squeeze(0)
         return output, weights
 
 
@@ -62,48 +86,195 @@ class BahdanauAttention(nn.Module):
         enc_att: torch.Tensor (seq_len x batch x att_dim),
             Projection of encoder output onto attention space
         """
-        return torch.stack([self.enc2att(i) for i in enc_outs])
+        seq_len, batch, hid_dim = enc_outs.size()
+        # single (seq_len * batch x hid_dim) projection instead of per-step
+        enc_att = self.enc2att(enc_outs.contiguous().view(-1, hid_dim))
+        return enc_att.view(seq_len, batch, -1)
 
     def forward(self, dec_out, enc_outs, enc_att=None, mask=None, **kwargs):
         """
         Parameters:
         -----------
         dec_out: torch.Tensor (batch x hid_dim)
-            Output of decoder at current step
+            Output of decoder at current step, or (trg_len x batch x hid_dim)
+            to attend for all decoder steps at once
 
         enc_outs: torch.Tensor (seq_len x batch x hid_dim)
             Output of encoder over the entire sequence
 
         enc_att: see self.project_enc_outs(self, enc_outs)
 
+        mask: None or torch.ByteTensor (batch x seq_len), padding positions
+
         Returns: contexts, weights
         --------
         context: torch.Tensor (batch x hid_dim)
             Matrix of context vectors, which are then combined in the
             computation of the model output at the present timestep
+            ((trg_len x batch x hid_dim) for 3-D dec_out)
 
         weights: torch.Tensor (batch x seq_len)
             Attention weights in range [0, 1] for each input term
+            ((trg_len x batch x seq_len) for 3-D dec_out)
         """
+        single = dec_out.dim() == 2
+        if single:
+            dec_out = dec_out.unsqueeze(0)
         if enc_att is None:
             enc_att = self.project_enc_outs(enc_outs)
         # enc_outputs * weights
         # weights: softmax(E) (seq_len x batch)
         # E: att_v (att_dim x 1) * tanh(dec_att + enc_att) -> (seq_len x batch)
         # tanh(dec_out_att + enc_output_att) -> (seq_len x batch x att_dim)
-        seq_len, batch, hid_dim = enc_att.size()
-        # project current decoder output onto attention (batch_size x att_dim)
+        seq_len, batch, _ = enc_att.size()
+        trg_len = dec_out.size(0)
+        # project decoder output onto attention (trg_len x batch x att_dim)
         dec_att = self.dec2att(dec_out)
         # elemwise addition of dec_out over enc_att
-        # dec_enc_att: (batch x seq_len x att_dim)
-        dec_enc_att = F.tanh(enc_att + dec_att[None, :, :])
-        # dec_enc_att (seq_len x batch x att_dim) * att_v (att_dim x 1)
-        #   -> weights (batch x seq_len)
-        weights = F.softmax(
-            (dec_enc_att.transpose(0, 1) @ self.att_v[None, :, :]).squeeze(2))
+        # dec_enc_att: (trg_len x seq_len x batch x att_dim)
+        dec_enc_att = F.tanh(enc_att.unsqueeze(0) + dec_att.unsqueeze(1))
+        # dec_enc_att (trg_len x seq_len x batch x att_dim) * att_v (att x 1)
+        #   -> weights (batch x trg_len x seq_len)
+        weights = (dec_enc_att @ self.att_v).squeeze(3).permute(2, 0, 1)
         if mask is not None:
-            weights.masked_fill_(mask, -math.inf)
-        # enc_outs: (seq_len x batch x hid_dim) * weights (batch x seq_len)
-        #   -> context: (batch x hid_dim)
-        context = weights.unsqueeze(1).bmm(enc_outs.transpose(0, 1)).squeeze(1)
+            # mask padding before normalizing
+            weights.data.masked_fill_(
+                mask.unsqueeze(1).expand_as(weights), -math.inf)
+        weights = F.softmax(weights.contiguous().view(-1, seq_len))
+        weights = weights.view(batch, trg_len, seq_len)
+        # enc_outs: (seq_len x batch x hid_dim) * weights
+        #   (batch x trg_len x seq_len) -> context: (trg_len x batch x hid_dim)
+        context = weights.bmm(enc_outs.transpose(0, 1)).transpose(0, 1)
+        weights = weights.transpose(0, 1)
+        if single:
+            context, weights = context.squeeze(0), weights.squeeze(0)
         return context, weights
+
+
+class LocalAttention(nn.Module):
+    """
+    Local attention with predictive alignment (local-p, see
+    https://arxiv.org/abs/1508.04025). For every decoder step an aligned
+    source position p_t is predicted and only the 2 * window + 1 encoder
+    outputs around it are attended, with scores weighted by a gaussian
+    centered at p_t. The cost per decoder step is thus O(window) instead
+    of O(seq_len).
+
+    Parameters:
+    -----------
+    dim: int, hidden dimension of encoder and decoder
+    window: int, half size of the attended window
+    """
+    def __init__(self, dim, window=10):
+        if window < 1:
+            raise ValueError("window must be a positive integer")
+        super(LocalAttention, self).__init__()
+        self.window = window
+        self.linear_in = nn.Linear(dim, dim, bias=False)
+        self.linear_out = nn.Linear(dim * 2, dim, bias=False)
+        # position prediction network
+        self.pos_hid = nn.Linear(dim, dim, bias=False)
+        self.pos_v = nn.Linear(dim, 1, bias=False)
+
+    def forward(self, dec_out, enc_outs, mask=None, full_weights=False,
+                **kwargs):
+        """
+        Parameters:
+        -----------
+        dec_out: (batch x hid_dim) or (trg_len x batch x hid_dim) to attend
+            for all decoder steps at once
+
+        enc_outs: (seq_len x batch x hid_dim)
+
+        mask: None or torch.ByteTensor (batch x seq_len), padding positions
+
+        full_weights: bool, whether to scatter the window weights over the
+            full source (see scatter_weights), e.g. for inspection.
+
+        Returns: output, weights
+        --------
+        output: (batch x hid_dim) or (trg_len x batch x hid_dim)
+
+        weights: if `full_weights`, (batch x seq_len) or
+            (trg_len x batch x seq_len), zero outside the window. Otherwise
+            a tuple (window_weights, positions), both of size
+            (batch x width) or (trg_len x batch x width), with the weights
+            of the attended window and their source positions.
+        """
+        single = dec_out.dim() == 2
+        if single:
+            dec_out = dec_out.unsqueeze(0)
+        trg_len, batch, hid_dim = dec_out.size()
+        seq_len, width = enc_outs.size(0), 2 * self.window + 1
+        rows = trg_len * batch
+        # fold decoder steps into the batch (trg_len * batch x hid_dim)
+        dec_out = dec_out.contiguous().view(rows, hid_dim)
+        # example in the batch corresponding to each row
+        ids = torch.LongTensor(list(range(batch))).repeat(trg_len)
+        if dec_out.is_cuda:
+            ids = ids.cuda()
+
+        # source lengths for each row
+        lengths = dec_out.data.new(batch).fill_(seq_len)
+        if mask is not None:
+            lengths -= mask.float().sum(1)
+        lengths = lengths.index_select(0, ids)
+
+        # predicted position (rows) in [0, length - 1]
+        pos_t = F.sigmoid(self.pos_v(F.tanh(self.pos_hid(dec_out))))
+        pos_t = pos_t.squeeze(1) * Variable(lengths - 1)
+
+        # window positions (rows x width)
+        offsets = dec_out.data.new(list(range(-self.window, self.window + 1)))
+        pos = pos_t.data.round().unsqueeze(1).expand(rows, width) + \
+            offsets.unsqueeze(0).expand(rows, width)
+        valid = pos.ge(0) * pos.lt(lengths.unsqueeze(1).expand_as(pos))
+        pos = pos.clamp(0, seq_len - 1).long()
+
+        # gather window encoder outputs (rows x width x hid_dim), indexing
+        # the time-major encoder outputs in place (no copy if contiguous)
+        enc_flat = enc_outs.contiguous().view(seq_len * batch, hid_dim)
+        flat_pos = pos * batch + ids.unsqueeze(1).expand_as(pos)
+        window_outs = enc_flat.index_select(0, Variable(flat_pos.view(-1)))
+        window_outs = window_outs.view(rows, width, hid_dim)
+
+        # (rows x width x hid_dim) * (rows x hid_dim x 1) -> (rows x width)
+        scores = torch.bmm(
+            window_outs, self.linear_in(dec_out).unsqueeze(2)).squeeze(2)
+        scores.data.masked_fill_(1 - valid, -math.inf)
+        weights = F.softmax(scores)
+        # favour positions close to the predicted one (sigma = window / 2)
+        dist = Variable(pos.float()) - pos_t.unsqueeze(1).expand(rows, width)
+        weights = weights * torch.exp(-dist ** 2 / (self.window ** 2 / 2))
+
+        # (rows x 1 x width) * (rows x width x hid_dim) -> (rows x hid_dim)
+        context = weights.unsqueeze(1).bmm(window_outs).squeeze(1)
+        output = F.tanh(self.linear_out(torch.cat([context, dec_out], 1)))
+        output = output.view(trg_len, batch, hid_dim)
+
+        weights = weights.view(trg_len, batch, width)
+        pos = pos.view(trg_len, batch, width)
+        if single:
+            output, weights, pos = \
+                output.squeeze(0), weights.squeeze(0), pos.squeeze(0)
+        if full_weights:
+            return output, self.scatter_weights(weights, pos, seq_len)
+        return output, (weights, pos)
+
+    @staticmethod
+    def scatter_weights(weights, pos, seq_len):
+        """
+        Scatter window weights over the full source.
+
+        Parameters:
+        -----------
+        weights: (... x width), window weights (see forward)
+        pos: torch.LongTensor (... x width), window source positions
+
+        Returns: (... x seq_len), zero outside the window
+        """
+        size = pos.size()
+        pos = pos.view(-1, size[-1])
+        full = weights.data.new(pos.size(0), seq_len).zero_()
+        full.scatter_add_(1, pos, weights.data.view(-1, size[-1]))
+        return Variable(full.view(*size[:-1], seq_len))
@@ -1,4 +1,6 @@
 
+from typing import Tuple
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -57,6 +59,10 @@ class MLP(nn.Module):
 
 
 class BaseStackedRNN(nn.Module):
+    # constants let TorchScript drop the dropout branch when there is none
+    # (see utils.compile_module)
+    __constants__ = ['num_layers', 'has_dropout']
+
     def __init__(self, cell, num_layers, in_dim, hid_dim,
                  dropout=0.0, **kwargs):
         """
@@ -102,17 +108,18 @@ class StackedLSTM(BaseStackedRNN):
     def __init__(self, *args, **kwargs):
         super(StackedLSTM, self).__init__('LSTMCell', *args, **kwargs)
 
-    def forward(self, inp, hidden):
+    def forward(self, inp, hidden: Tuple[torch.Tensor, torch.Tensor]):
+        # (the annotation is needed by TorchScript)
         h_0, c_0 = hidden
         h_1, c_1 = [], []
         for i, layer in enumerate(self.layers):
             h_1_i, c_1_i = layer(inp, (h_0[i], c_0[i]))
             inp = h_1_i
             # dropout on all but last layer
-            if i + 1 != self.num_layers and self.has_dropout:
+            if self.has_dropout and i + 1 != self.num_layers:
                 inp = self.dropout(inp)
-            h_1 += [h_1_i]
-            c_1 += [c_1_i]
+            h_1.append(h_1_i)
+            c_1.append(c_1_i)
 
         return inp, (torch.stack(h_1), torch.stack(c_1))
 
@@ -127,9 +134,9 @@ class StackedGRU(BaseStackedRNN):
             h_1_i = layer(inp, hidden[i])
             inp = h_1_i
             # dropout on all but last layer
-            if i + 1 != self.num_layers and self.has_dropout:
+            if self.has_dropout and i + 1 != self.num_layers:
                 inp = self.dropout(inp)
-            h_1 += [h_1_i]
+            h_1.append(h_1_i)
 
         return inp, torch.stack(h_1)
 
@@ -157,6 +164,19 @@ class NormalizedGRUCell(nn.GRUCell):
     Layer-normalized GRUCell
 
     kindly taken from here [https://github.com/pytorch/pytorch/issues/1959]
+
+    Gates for all three blocks (reset, update, input) are computed by a single
+    GEMM. Layer norm is applied jointly over the reset and update blocks and
+    separately over the input block. The input-to-hidden part only depends
+    on the input, so it can be precomputed for a full sequence with
+    `project_input` and fed to `step` (see NormalizedGRU).
+
+    Note that layer norm statistics are computed per example. Previous
+    versions of this cell took `x.mean(1).expand_as(x)` (and likewise for
+    the std), which broadcasts the statistics along the feature dimension
+    instead (and only runs if batch size is 1 or equal to hidden_size).
+    Outputs are therefore not numerically equivalent to those of the old
+    cell for batches larger than one.
     """
     def __init__(self, input_size, hidden_size, bias=True):
         super(NormalizedGRUCell, self).__init__(input_size, hidden_size, bias)
@@ -166,69 +186,78 @@ class NormalizedGRUCell(nn.GRUCell):
         self.gamma_ih.custom, self.gamma_hh.custom = True, True
         self.eps = 0
 
-    def _layer_norm_x(self, x, g, bias=None):
-        mean = x.mean(1).expand_as(x)
-        std = x.std(1).expand_as(x)
-        output = g.expand_as(x) * ((x - mean) / (std + self.eps))
+    def _layer_norm(self, x, g, bias=None, scale=True):
+        """
+        Normalize over the last dimension of x (hidden-to-hidden gates are
+        only centered)
+        """
+        output = x - x.mean(-1, keepdim=True)
+        if scale:
+            output = output / (x.std(-1, keepdim=True) + self.eps)
+        output = g * output
         if bias is not None:
-            output += bias.expand_as(x)
+            output = output + bias
         return output
 
-    def _layer_norm_h(self, x, g, bias=None):
-        mean = x.mean(1).expand_as(x)
-        output = g.expand_as(x) * (x - mean)
-        if bias is not None:
-            output += bias.expand_as(x)
+    def _normalize_gates(self, gates, g, bias=None, scale=True):
+        """
+        Split gates (... x 3 * hidden_size) into layer-normalized
+        (reset & update, input) blocks.
+        """
+        rz_size, n_size = 2 * self.hidden_size, self.hidden_size
+        rz = self._layer_norm(
+            gates.narrow(-1, 0, rz_size), g.narrow(0, 0, rz_size),
+            None if bias is None else bias.narrow(0, 0, rz_size),
+            scale=scale)
+        n = self._layer_norm(
+            gates.narrow(-1, rz_size, n_size), g.narrow(0, rz_size, n_size),
+            None if bias is None else bias.narrow(0, rz_size, n_size),
+            scale=scale)
+        return rz, n
+
+    def project_input(self, x):
+        """
+        Compute the normalized input-to-hidden gates with a single GEMM.
 
-        return output
+        Parameters:
+        -----------
+        x: (batch x input_size) or (seq_len x batch x input_size)
 
-    def forward(self, x, h):
+        Returns: (ih_rz, ih_n), with the leading dimensions of x and
+        --------
+            2 * hidden_size and hidden_size features respectively
         """
-        x: (batch x input_size)
+        size = x.size()
+        gates = torch.mm(x.contiguous().view(-1, size[-1]),
+                         self.weight_ih.t())
+        gates = gates.view(*size[:-1], 3 * self.hidden_size)
+        return self._normalize_gates(
+            gates, self.gamma_ih, self.bias_ih if self.bias else None)
+
+    def step(self, ih, h):
+        """
+        Parameters:
+        -----------
+        ih: tuple (ih_rz, ih_n), output of project_input for this step
         h: (batch x hidden_size)
         """
-        # 1. GATES
-        # 1.1. input to hidden gates
-        weight_ih_rz = self.weight_ih.narrow(  # update & reset gate params
-            0, 0, 2 * self.hidden_size).transpose(0, 1)
-        ih_rz = self._layer_norm_x(
-            torch.mm(x, weight_ih_rz),
-            self.gamma_ih.narrow(0, 0, 2 * self.hidden_size),
-            None if not self.bias else self.bias_ih.narrow(0, 0, 2 * self.hidden_size))
-
-        # 1.2 hidden to hidden gates
-        weight_hh_rz = self.weight_hh.narrow(
-            0, 0, 2 * self.hidden_size).transpose(0, 1)
-        hh_rz = self._layer_norm_h(
-            torch.mm(h, weight_hh_rz),
-            self.gamma_hh.narrow(0, 0, 2 * self.hidden_size),
-            None if not self.bias else self.bias_hh.narrow(0, 0, 2 * self.hidden_size))
-
+        ih_rz, ih_n = ih
+        hh_rz, hh_n = self._normalize_gates(
+            torch.mm(h, self.weight_hh.t()), self.gamma_hh,
+            self.bias_hh if self.bias else None, scale=False)
         rz = torch.sigmoid(ih_rz + hh_rz)
         r = rz.narrow(1, 0, self.hidden_size)
         z = rz.narrow(1, self.hidden_size, self.hidden_size)
-
-        # 1. PROJECTIONS
-        # 1.1. input to hidden projection
-        weight_ih_n = self.weight_ih.narrow(
-            0, 2 * self.hidden_size, self.hidden_size).transpose(0, 1)
-        ih_n = self._layer_norm_x(
-            torch.mm(x, weight_ih_n),
-            self.gamma_ih.narrow(0, 2 * self.hidden_size, self.hidden_size),
-            None if not self.bias else self.bias_ih.narrow(0, 2*self.hidden_size, self.hidden_size))
-
-        # 1.2. hidden to hidden projection
-        weight_hh_n = self.weight_hh.narrow(
-            0, 2 * self.hidden_size, self.hidden_size).transpose(0, 1)
-        hh_n = self._layer_norm_h(
-            torch.mm(h, weight_hh_n),
-            self.gamma_hh.narrow(0, 2 * self.hidden_size, self.hidden_size),
-            None if not self.bias else self.bias_hh.narrow(0, 2*self.hidden_size, self.hidden_size))
-
         # h' = (1 - z) * n + (z * h)
         n = torch.tanh(ih_n + r * hh_n)
-        h = (1 - z) * n + z * h
-        return h
+        return (1 - z) * n + z * h
+
+    def forward(self, x, h):
+        """
+        x: (batch x input_size)
+        h: (batch x hidden_size)
+        """
+        return self.step(self.project_input(x), h)
 
 
 class NormalizedGRU(StackedNormalizedGRU):
@@ -241,14 +270,25 @@ class NormalizedGRU(StackedNormalizedGRU):
 
     def forward(self, xs, h_0):
         """
+        Run the layers one after the other over the full sequence, so that
+        each layer projects its whole input with a single GEMM.
+
         xs: (seq_len x batch x input_size)
         h_0: (num_layers * 1 x batch x hidden_size)
         """
-        outputs, h_t = [], h_0
-        for x_t in xs:
-            output, h_t = super(NormalizedGRU, self).forward(x_t, h_t)
-            outputs.append(output)
-        return torch.stack(outputs), h_t
+        h_n = []
+        for i, layer in enumerate(self.layers):
+            ih_rz, ih_n = layer.project_input(xs)
+            h_t, outputs = h_0[i], []
+            for t in range(len(xs)):
+                h_t = layer.step((ih_rz[t], ih_n[t]), h_t)
+                outputs.append(h_t)
+            xs = torch.stack(outputs)
+            # dropout on all but last layer
+            if i + 1 != self.num_layers and self.has_dropout:
+                xs = self.dropout(xs)
+            h_n.append(h_t)
+        return xs, torch.stack(h_n)
 
 
 def _custom_rhn_init(module):
@@ -491,6 +531,414 @@ class RHNCoupled(_RHNCoupled):
         return out, hidden.unsqueeze(0)
 
 
+class _RHNFusedBase(nn.Module):
+    """
+    Base class for RHN variants with fused gates. The input projections of
+    all gates are concatenated into a single (in_dim x num_gates * hid_dim)
+    matrix and the recurrent projections of each micro-layer into a single
+    (hid_dim x num_gates * hid_dim) matrix, so that each micro-layer is one
+    GEMM (or one batched GEMM over the gates in case of untied noise).
+    Gate order is (H, T[, C]).
+
+    Parameters: (See _RHN)
+    -----------
+    precompute_inputs: bool, whether to project the (masked) input for the
+        entire sequence at once before running the recurrence (faster)
+        or at each step (less memory).
+    """
+    num_gates = None
+    # gate weights are read directly from the linears (see _gate_weight),
+    # so they can't be replaced by int8 layers (see u.quantize_for_inference)
+    quantize_linears = False
+
+    def __init__(self, in_dim, hid_dim, num_layers=1, tied_noise=True,
+                 input_dropout=0.75, hidden_dropout=0.25,
+                 precompute_inputs=True, **kwargs):
+        self.in_dim = in_dim
+        self.hid_dim = hid_dim
+        self.depth = num_layers
+        self.input_dropout = input_dropout
+        self.hidden_dropout = hidden_dropout
+        self.tied_noise = tied_noise
+        self.precompute_inputs = precompute_inputs
+        super(_RHNFusedBase, self).__init__()
+        self.input_proj = nn.Linear(in_dim, self.num_gates * hid_dim)
+        self.rnns = []
+        for layer in range(self.depth):
+            bias = False if layer == 0 else True
+            rnn = nn.Linear(hid_dim, self.num_gates * hid_dim, bias=bias)
+            self.add_module('rnn_{}'.format(layer + 1), rnn)
+            self.rnns.append(rnn)
+
+    def custom_init(self):
+        # initialize transform gates bias to -3
+        for m in [self.input_proj] + self.rnns:
+            if m.bias is not None:
+                m.bias.data[self.hid_dim:2 * self.hid_dim].fill_(-3)
+
+    @classmethod
+    def _source_layers(cls, rhn):
+        raise NotImplementedError
+
+    @classmethod
+    def from_rhn(cls, rhn, **kwargs):
+        """
+        Build a fused module with the same parameters as a given (unfused)
+        RHN module.
+        """
+        fused = cls(rhn.in_dim, rhn.hid_dim, num_layers=rhn.depth,
+                    tied_noise=rhn.tied_noise, input_dropout=rhn.input_dropout,
+                    hidden_dropout=rhn.hidden_dropout, **kwargs)
+        inputs, rnns = cls._source_layers(rhn)
+        for target, source in zip([fused.input_proj] + fused.rnns,
+                                  [inputs] + rnns):
+            target.weight.data.copy_(
+                torch.cat([m.weight.data for m in source]))
+            if target.bias is not None:
+                target.bias.data.copy_(
+                    torch.cat([m.bias.data for m in source]))
+        return fused
+
+    def _highway(self, gates, s_lm1):
+        raise NotImplementedError
+
+    def _project(self, inp, masks, linear, weight=None):
+        """
+        Project masked input with all gates at once
+
+        inp: (batch x dim)
+        masks: mask (batch x dim) if tied noise, otherwise stacked masks
+            (num_gates x batch x dim)
+        weight: (num_gates x dim x hid_dim), transposed weight per gate
+            (only needed for untied noise)
+
+        Returns: (batch x num_gates * hid_dim)
+        """
+        if self.tied_noise:
+            return linear(masks * inp)
+        # (num_gates x batch x dim) * (num_gates x dim x hid_dim)
+        out = torch.bmm(masks * inp.unsqueeze(0).expand_as(masks), weight)
+        if linear.bias is not None:
+            out = out + linear.bias.view(self.num_gates, 1, self.hid_dim) \
+                              .expand_as(out)
+        return out.transpose(0, 1).contiguous().view(inp.size(0), -1)
+
+    def _gate_weight(self, linear):
+        if self.tied_noise:
+            return None
+        dim = linear.weight.size(1)
+        return linear.weight.view(self.num_gates, self.hid_dim, dim) \
+                            .transpose(1, 2)
+
+    def _make_masks(self, inp, p, size):
+        if self.tied_noise:
+            return make_mask(inp, p, size)
+        return torch.stack(
+            [make_mask(inp, p, size) for _ in range(self.num_gates)])
+
+    def forward(self, inp, hidden):
+        """
+        Parameters:
+        -----------
+
+        inp: FloatTensor (seq_len x batch_size x in_dim)
+        hidden: FloatTensor (batch_size x hidden_size)
+        """
+        seq_len, batch_size, _ = inp.size()
+        in_masks = self._make_masks(
+            inp, self.input_dropout, (batch_size, self.in_dim))
+        s_masks = self._make_masks(
+            inp, self.hidden_dropout, (batch_size, self.hid_dim))
+        in_weight = self._gate_weight(self.input_proj)
+        rnn_weights = [self._gate_weight(rnn) for rnn in self.rnns]
+
+        if self.precompute_inputs:
+            # repeat masks over time and project the full sequence at once
+            if self.tied_noise:
+                seq_masks = in_masks.repeat(seq_len, 1)
+            else:
+                seq_masks = in_masks.repeat(1, seq_len, 1)
+            inputs = self._project(
+                inp.view(seq_len * batch_size, -1), seq_masks,
+                self.input_proj, weight=in_weight)
+            inputs = inputs.view(seq_len, batch_size, -1)
+        else:
+            inputs = inp
+
+        outs = []
+        for x_t in inputs:
+            if not self.precompute_inputs:
+                x_t = self._project(
+                    x_t, in_masks, self.input_proj, weight=in_weight)
+            s_lm1 = hidden
+            for l, (rnn, weight) in enumerate(zip(self.rnns, rnn_weights)):
+                gates = self._project(s_lm1, s_masks, rnn, weight=weight)
+                if l == 0:
+                    gates = gates + x_t
+                s_lm1 = self._highway(gates, s_lm1)
+            outs.append(s_lm1)
+            hidden = s_lm1
+
+        return torch.stack(outs), outs[-1]
+
+
+class _RHNFused(_RHNFusedBase):
+    """
+    Fused-gate version of _RHN. Unlike _RHN, the carry gate has its own
+    recurrent weights (_RHN reuses the transform gate projection). A model
+    converted with `from_rhn` copies them to reproduce the _RHN output.
+    """
+    num_gates = 3
+
+    @classmethod
+    def _source_layers(cls, rhn):
+        inputs = [rhn.input_H, rhn.input_T, rhn.input_C]
+        # _RHN computes the carry gate with the transform gate projection
+        rnns = [[h, t, t] for h, t in zip(rhn.rnn_h, rhn.rnn_t)]
+        return inputs, rnns
+
+    def _highway(self, gates, s_lm1):
+        H_t = F.tanh(gates[:, :self.hid_dim])
+        # (transform & carry gates)
+        TC_t = F.sigmoid(gates[:, self.hid_dim:])
+        T_t, C_t = TC_t[:, :self.hid_dim], TC_t[:, self.hid_dim:]
+        return H_t * T_t + s_lm1 * C_t
+
+
+class _RHNCoupledFused(_RHNFusedBase):
+    """
+    Fused-gate version of _RHNCoupled
+    """
+    num_gates = 2
+
+    @classmethod
+    def _source_layers(cls, rhn):
+        inputs = [rhn.input_H, rhn.input_T]
+        rnns = [[h, t] for h, t in zip(rhn.rnn_h, rhn.rnn_t)]
+        return inputs, rnns
+
+    def _highway(self, gates, s_lm1):
+        H_t = F.tanh(gates[:, :self.hid_dim])
+        T_t = F.sigmoid(gates[:, self.hid_dim:])
+        return (H_t - s_lm1) * T_t + s_lm1
+
+
+class RHNFused(_RHNFused):
+    """
+    Wrapper class for a stacked RHNFused (see RHN).
+    """
+    def forward(self, inp, hidden):
+        out, hidden = super(RHNFused, self).forward(inp, hidden.squeeze(0))
+        return out, hidden.unsqueeze(0)
+
+
+class RHNCoupledFused(_RHNCoupledFused):
+    """
+    Wrapper class for a stacked RHNCoupledFused (see RHNCoupled).
+    """
+    def forward(self, inp, hidden):
+        out, hidden = super(RHNCoupledFused, self).forward(
+            inp, hidden.squeeze(0))
+        return out, hidden.unsqueeze(0)
+
+
+class _ElementwiseRNN(nn.Module):
+    """
+    Base class for multi-layer (bidirectional) RNNs whose gates only depend
+    on the input. Gates are computed for the full sequence with a single
+    matmul per layer and direction, leaving only the elementwise recurrence
+        c_t = f_t * c_{t-1} + (1 - f_t) * z_t
+    in the time loop. The hidden state is the cell state c of each layer
+    and direction, following the layout of nn.RNN
+    ((num_layers * num_dirs) x batch x hid_dim).
+
+    Parameters:
+    -----------
+    in_dim: int, number of features in the input
+    hid_dim: int, number of features in the output
+    num_layers: int, number of stacked layers
+    bias: bool, whether to use bias in the gate projections
+    dropout: float, dropout applied to the output of all but the last layer
+    bidirectional: bool
+    kwargs: extra arguments to general RNN cells that are ignored
+    """
+    def __init__(self, in_dim, hid_dim, num_layers=1, bias=True,
+                 dropout=0.0, bidirectional=False, **kwargs):
+        self.in_dim = in_dim
+        self.hid_dim = hid_dim
+        self.num_layers = num_layers
+        self.dropout = dropout
+        self.num_dirs = 2 if bidirectional else 1
+        super(_ElementwiseRNN, self).__init__()
+        self.layers = []
+        for layer in range(num_layers):
+            layer_in_dim = in_dim if layer == 0 else hid_dim * self.num_dirs
+            for direction in range(self.num_dirs):
+                proj = self._make_layer(layer_in_dim, bias)
+                suffix = '_reverse' if direction == 1 else ''
+                self.add_module('layer_{}{}'.format(layer, suffix), proj)
+                self.layers.append(proj)
+
+    def _make_layer(self, in_dim, bias):
+        raise NotImplementedError
+
+    def _run_layer(self, proj, inp, c_0, mask=None):
+        raise NotImplementedError
+
+    @staticmethod
+    def recurrence(f, z, c_0, mask=None):
+        """
+        Compute c_t = f_t * c_{t-1} + (1 - f_t) * z_t along the first dim
+
+        f, z: (seq_len x batch x hid_dim)
+        c_0: (batch x hid_dim)
+        mask: None or (seq_len x batch x 1), 0s at padding steps, where the
+            state is carried over unchanged (f_t = 1)
+
+        Returns: (seq_len x batch x hid_dim)
+        """
+        if mask is not None:
+            mask = mask.expand_as(f)
+            f = f * mask + (1 - mask)
+        fz = (1 - f) * z        # input term for all steps at once
+        cs, c_t = [], c_0
+        for f_t, fz_t in zip(f, fz):
+            c_t = f_t * c_t + fz_t
+            cs.append(c_t)
+        return torch.stack(cs)
+
+    @staticmethod
+    def _flip(inp):
+        index = torch.LongTensor(list(range(inp.size(0) - 1, -1, -1)))
+        if inp.is_cuda:
+            index = index.cuda()
+        return inp.index_select(0, Variable(index))
+
+    @staticmethod
+    def _flip_index(lengths, seq_len):
+        """
+        Index (seq_len x batch) that reverses the first `lengths` steps of
+        each example, leaving the padding steps in place.
+        """
+        steps = lengths.new(list(range(seq_len)))
+        steps = steps.unsqueeze(1).expand(seq_len, len(lengths))
+        lengths = lengths.unsqueeze(0).expand_as(steps)
+        valid = steps.lt(lengths).long()
+        return (lengths - 1 - steps) * valid + steps * (1 - valid)
+
+    def forward(self, inp, hidden=None, lengths=None):
+        """
+        Parameters:
+        -----------
+
+        inp: FloatTensor (seq_len x batch_size x in_dim)
+        hidden: FloatTensor ((num_layers * num_dirs) x batch x hid_dim)
+        lengths: None or LongTensor (batch), number of non-padding steps of
+            each example. If given, padding steps don't update the state,
+            their outputs are zero and the reverse direction starts at the
+            last non-padding step (as with packed sequences in nn.RNN).
+
+        Returns: outs, hidden
+        --------
+        outs: (seq_len x batch x hid_dim * num_dirs)
+        hidden: ((num_layers * num_dirs) x batch x hid_dim)
+        """
+        seq_len, batch, _ = inp.size()
+        if hidden is None:
+            size = (self.num_layers * self.num_dirs, batch, self.hid_dim)
+            hidden = Variable(inp.data.new(*size).zero_())
+
+        mask, flip = None, self._flip
+        if lengths is not None:
+            steps = lengths.new(list(range(seq_len)))
+            steps = steps.unsqueeze(1).expand(seq_len, batch)
+            mask = steps.lt(lengths.unsqueeze(0).expand_as(steps))
+            mask = Variable(mask.unsqueeze(2).type_as(inp.data))
+            index = self._flip_index(lengths, seq_len).unsqueeze(2)
+
+            def flip(var):
+                return var.gather(0, Variable(index.expand_as(var.data)))
+
+        hiddens = []
+        for layer in range(self.num_layers):
+            outs = []
+            for direction in range(self.num_dirs):
+                idx = layer * self.num_dirs + direction
+                layer_inp = inp if direction == 0 else flip(inp)
+                out, c_t = self._run_layer(
+                    self.layers[idx], layer_inp, hidden[idx], mask=mask)
+                if mask is not None:
+                    out = out * mask.expand_as(out)
+                outs.append(out if direction == 0 else flip(out))
+                hiddens.append(c_t)
+            inp = torch.cat(outs, 2) if self.num_dirs > 1 else outs[0]
+            if self.dropout > 0 and layer + 1 < self.num_layers:
+                inp = F.dropout(inp, p=self.dropout, training=self.training)
+
+        return inp, torch.stack(hiddens)
+
+
+class QRNN(_ElementwiseRNN):
+    """
+    Quasi-Recurrent Neural Network with fo-pooling
+    (https://arxiv.org/abs/1611.01576). Candidate, forget and output gates
+    are computed with a convolution of width `window` over the input, done
+    as a single matmul over the concatenation of the shifted inputs.
+    Note that the convolution doesn't look into inputs from a previous
+    batch (they are zero padded).
+
+    Parameters: (See _ElementwiseRNN)
+    -----------
+    window: int, width of the convolution over the input
+    """
+    def __init__(self, in_dim, hid_dim, window=2, **kwargs):
+        self.window = window
+        super(QRNN, self).__init__(in_dim, hid_dim, **kwargs)
+
+    def _make_layer(self, in_dim, bias):
+        return nn.Linear(in_dim * self.window, 3 * self.hid_dim, bias=bias)
+
+    def _run_layer(self, proj, inp, c_0, mask=None):
+        seq_len, batch, in_dim = inp.size()
+        if self.window > 1:
+            # (seq_len x batch x in_dim * window) oldest input first
+            pad = inp.data.new(self.window - 1, batch, in_dim).zero_()
+            pad = Variable(pad)
+            padded = torch.cat([pad, inp])
+            inp = torch.cat([padded[k:k + seq_len]
+                             for k in range(self.window)], 2)
+        gates = proj(inp.view(seq_len * batch, -1)).view(seq_len, batch, -1)
+        z = F.tanh(gates[:, :, :self.hid_dim])
+        fo = F.sigmoid(gates[:, :, self.hid_dim:])
+        f, o = fo[:, :, :self.hid_dim], fo[:, :, self.hid_dim:]
+        c = self.recurrence(f, z, c_0, mask=mask)
+        return o * c, c[-1]
+
+
+class SRU(_ElementwiseRNN):
+    """
+    Simple Recurrent Unit (https://arxiv.org/abs/1709.02755). Candidate,
+    forget and reset gates (and the highway projection, if input and hidden
+    dimensions differ) are computed with a single matmul over the input.
+
+    Parameters: (See _ElementwiseRNN)
+    """
+    def _make_layer(self, in_dim, bias):
+        num_gates = 3 if in_dim == self.hid_dim else 4
+        return nn.Linear(in_dim, num_gates * self.hid_dim, bias=bias)
+
+    def _run_layer(self, proj, inp, c_0, mask=None):
+        seq_len, batch, in_dim = inp.size()
+        hid_dim = self.hid_dim
+        gates = proj(inp.view(seq_len * batch, -1)).view(seq_len, batch, -1)
+        x_tilde = gates[:, :, :hid_dim]
+        fr = F.sigmoid(gates[:, :, hid_dim:3 * hid_dim])
+        f, r = fr[:, :, :hid_dim], fr[:, :, hid_dim:]
+        skip = inp if in_dim == hid_dim else gates[:, :, 3 * hid_dim:]
+        c = self.recurrence(f, x_tilde, c_0, mask=mask)
+        return r * F.tanh(c) + (1 - r) * skip, c[-1]
+
+
 class MaxOut(nn.Module):
     def __init__(self, in_dim, out_dim, k):
         """
@@ -508,7 +956,7 @@ class MaxOut(nn.Module):
 
         Returns:
         --------
-        out: torch.Tensor (batch x k)
+        out: torch.Tensor (... x out_dim)
         """
         self.in_dim, self.out_dim, self.k = in_dim, out_dim, k
         super(MaxOut, self).__init__()
@@ -516,31 +964,119 @@ class MaxOut(nn.Module):
 
     def forward(self, inp):
         """
-        Because of the linear projection we are bound to 1-d input
-        (excluding batch-dim), therefore there is no need to generalize
-        the implementation to n-dimensional input.
+        inp: torch.Tensor (... x in_dim). Leading dimensions are flattened
+            so that, e.g., a full (seq_len x batch x in_dim) sequence is
+            projected with a single GEMM.
         """
-        batch, in_dim = inp.size()
-        # (batch x self.k * self.out_dim) -> (batch x self.out_dim x self.k)
-        out = self.projection(inp).view(batch, self.out_dim, self.k)
-        out, _ = out.max(2)
-        return out
+        size = inp.size()
+        out = self.projection(inp.contiguous().view(-1, self.in_dim))
+        # (N x self.k * self.out_dim) -> (N x self.out_dim x self.k)
+        out, _ = out.view(-1, self.out_dim, self.k).max(2)
+        return out.view(*size[:-1], self.out_dim)
+
+
+class LowRankLinear(nn.Module):
+    """
+    Linear layer with a factorized weight W = up.weight @ down.weight of rank
+    `rank`, which needs rank * (in_dim + out_dim) instead of in_dim * out_dim
+    parameters (e.g. for output projections onto large vocabularies).
+
+    Parameters:
+    -----------
+    in_dim: int, Input dimension
+    out_dim: int, Output dimension
+    rank: int, inner dimension of the factorization
+    bias: bool
+    """
+    def __init__(self, in_dim, out_dim, rank, bias=True):
+        self.in_dim, self.out_dim, self.rank = in_dim, out_dim, rank
+        super(LowRankLinear, self).__init__()
+        self.down = nn.Linear(in_dim, rank, bias=False)
+        self.up = nn.Linear(rank, out_dim, bias=bias)
+
+    @classmethod
+    def from_linear(cls, linear, rank):
+        """
+        Compress a (trained) nn.Linear by truncated SVD of its weight, which
+        gives the best rank `rank` approximation in Frobenius norm. The
+        singular values are split evenly over both factors.
+        """
+        out_dim, in_dim = linear.weight.size()
+        if rank >= min(in_dim, out_dim):
+            raise ValueError("rank must be smaller than the layer dimensions")
+        inst = cls(in_dim, out_dim, rank, bias=linear.bias is not None)
+        if linear.weight.is_cuda:
+            inst.cuda()
+        # weight (out_dim x in_dim) = U (out_dim x k) S (k) V^T (k x in_dim)
+        U, S, V = torch.svd(linear.weight.data)
+        S = S[:rank].sqrt()
+        inst.up.weight.data.copy_(U[:, :rank] * S.unsqueeze(0).expand(
+            out_dim, rank))
+        inst.down.weight.data.copy_(V[:, :rank].t() * S.unsqueeze(1).expand(
+            rank, in_dim))
+        if linear.bias is not None:
+            inst.up.bias.data.copy_(linear.bias.data)
+        return inst
+
+    def forward(self, inp):
+        return self.up(self.down(inp))
 
 
 # Stateless modules
-def _word_dropout_mask(X, dropout_rate, reserved_codes=()):
+def droppable_table(vocab_size, reserved_codes=()):
+    """
+    Lookup table (vocab_size) with 1 for symbols that can be dropped by
+    word_dropout and 0 for reserved symbols.
+    """
+    table = torch.ones(vocab_size)
+    for code in reserved_codes:
+        if code is not None:
+            table[code] = 0
+    return table
+
+
+class DroppableTable(object):
+    """
+    Lazily built droppable_table, cached on the device of the last input
+    it was requested for. Models keep it as a plain attribute, so that it
+    is built only once per device and stays out of their state_dict.
+    """
+    def __init__(self, vocab_size, reserved_codes=()):
+        self.vocab_size = vocab_size
+        self.reserved_codes = reserved_codes
+        self.table, self.device = None, None
+
+    def __call__(self, inp):
+        """
+        inp: torch.LongTensor, input the table will be used for
+        """
+        device = inp.get_device() if inp.is_cuda else -1
+        if self.table is None or self.device != device:
+            table = droppable_table(self.vocab_size, self.reserved_codes)
+            if inp.is_cuda:
+                table = table.cuda(device)
+            self.table, self.device = table, device
+        return self.table
+
+    def __getstate__(self):
+        # don't pickle the (device bound) table
+        return dict(self.__dict__, table=None, device=None)
+
+
+def _word_dropout_mask(X, dropout_rate, droppable):
     """
     Computes a binary mask across batch examples based on a
-    bernoulli distribution with mean equal to dropout.
+    bernoulli distribution with mean equal to dropout. Probabilities
+    are looked up by symbol in a single buffer which is then sampled
+    in place.
     """
-    probs = X.new(*X.size()).zero_().float() + dropout_rate
-    # zero reserved_codes
-    probs[sum((X == x) for x in reserved_codes)] = 0
-    return probs.bernoulli_().byte()
+    probs = droppable.index_select(0, X.contiguous().view(-1))
+    probs.mul_(dropout_rate)
+    return probs.bernoulli_(probs).byte().view_as(X)
 
 
 def word_dropout(inp, target_code, p=0.0, training=True,
-                 reserved_codes=(), lengths=None):
+                 reserved_codes=(), lengths=None, droppable=None):
     """
     Applies word dropout to an input Variable. Dropout isn't constant
     across batch examples. This is only to be used to drop input symbols
@@ -554,12 +1090,21 @@ def word_dropout(inp, target_code, p=0.0, training=True,
     - reserved_codes: tuple of ints, ints in the input that should never
         be dropped
     - training: bool
+    - droppable: None, torch.Tensor (vocab) or DroppableTable, precomputed
+        lookup table (see droppable_table). If given, reserved_codes are
+        ignored.
     """
     if not training or p == 0:
         return inp
 
-    mask = _word_dropout_mask(
-        inp.data, dropout_rate=p, reserved_codes=reserved_codes)
+    if isinstance(droppable, DroppableTable):
+        droppable = droppable(inp.data)
+    elif droppable is None:
+        droppable = droppable_table(
+            int(inp.data.max()) + 1, reserved_codes)
+        if inp.data.is_cuda:
+            droppable = droppable.cuda()
+    mask = _word_dropout_mask(inp.data, p, droppable)
 
     return inp.masked_fill(mask, target_code)
 
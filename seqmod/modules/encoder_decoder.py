@@ -1,6 +1,8 @@
 
 import logging
+import math
 import re
+from collections import OrderedDict, namedtuple
 
 import numpy as np
 
@@ -8,50 +10,79 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
+from seqmod.modules import custom
 from seqmod.modules.custom import word_dropout, grad_reverse
 from seqmod.modules.custom import StackedLSTM, StackedGRU, MaxOut, MLP
 from seqmod.modules import attention as attn
 from seqmod.misc.beam_search import Beam
+from seqmod.misc.dataset import pad_pack_batch
 from seqmod import utils as u
+from seqmod.utils import shards
 
 
-def detach_vars(data):
-    """Split variables from the tree to allow for memory efficient computation
-    of softmax losses over a whole sequence."""
-    for k, v in data.items():
-        if v.requires_grad:
-            v = Variable(v.data, requires_grad=True, volatile=False)
-        yield k, v
+# Reusable output of EncoderDecoder.encode (see EncoderDecoder.encode)
+EncoderState = namedtuple(
+    'EncoderState', ['enc_outs', 'enc_hidden', 'enc_att', 'mask'])
 
 
-def shards(data, size=25, test=False):
+def convert_stacked_rnn_keys(state_dict, prefix='decoder.rnn_step.'):
     """
-    Generator over variables that will be involved in a costly loss computation
-    such as the softmax. It yields dictionaries of the same form as the input,
-    where the variables have been splitted in smaller shards and detach from
-    the graph. It expects the consumer to back propagate through them in shards
-    of given a size. After all shards are consumed, the generator will take
-    care of backprop further from the input using the accumulated gradients.
-    """
-    # Inspired by www.github.com/OpenNMT/OpenNMT-py/blob/master/onmt/Loss.py
-    if test:
-        yield data
-        return
-
-    detached = dict(detach_vars(data))
-    splits = ((key, torch.split(v, size)) for key, v in detached.items())
-    keys, splits = zip(*splits)
-
-    for split in zip(*splits):
-        yield dict(zip(keys, split))  # go and accumulate some loss
+    Rename the parameters of a StackedLSTM/StackedGRU decoder rnn to those
+    of the equivalent fused nn.LSTM/nn.GRU, so that checkpoints saved
+    before decoders without input feeding became fused can still be
+    loaded (e.g. `decoder.rnn_step.layers.0.weight_ih` becomes
+    `decoder.rnn_step.weight_ih_l0`). Other keys are left untouched.
 
-    inputs, grads = [], []
-    for key, var in detached.items():
-        if var.grad is not None:
-            inputs.append(data[key]), grads.append(var.grad.data)
-
-    torch.autograd.backward(inputs, grads, retain_graph=True)
+    Returns: OrderedDict, the converted state_dict
+    """
+    pattern = re.compile(
+        '^' + re.escape(prefix) + r'layers\.(\d+)\.((weight|bias)_(ih|hh))$')
+    converted = OrderedDict()
+    for key, val in state_dict.items():
+        match = pattern.match(key)
+        if match is not None:
+            layer, param = match.group(1), match.group(2)
+            key = '{}{}_l{}'.format(prefix, param, layer)
+        converted[key] = val
+    return converted
+
+
+def pair_batches(pairs, max_tokens):
+    """
+    Group (src, trg) pairs into batches for scoring. Pairs sharing the same
+    source are put together so that each source is encoded once per batch,
+    and batches are filled up to `max_tokens` padded target tokens.
+
+    Yields: sources, rows, idxs
+    -------
+    sources: list of unique sources in the batch
+    rows: list of ints, position in `sources` of the source of each target
+    idxs: list of ints, position in `pairs` of each target
+    """
+    groups = OrderedDict()
+    for idx, (src, _) in enumerate(pairs):
+        groups.setdefault(tuple(src), []).append(idx)
+
+    sources, rows, idxs, max_len = [], [], [], 0
+    # sort sources by length to minimize padding
+    for src in sorted(groups, key=len):
+        added = False
+        for idx in groups[src]:
+            trg_len = len(pairs[idx][1])
+            if idxs and max(max_len, trg_len) * (len(idxs) + 1) > max_tokens:
+                yield sources, rows, idxs
+                sources, rows, idxs, max_len, added = [], [], [], 0, False
+            if not added:
+                sources.append(list(src))
+                added = True
+            rows.append(len(sources) - 1)
+            idxs.append(idx)
+            max_len = max(max_len, trg_len)
+
+    if idxs:
+        yield sources, rows, idxs
 
 
 class Encoder(nn.Module):
@@ -67,10 +98,14 @@ class Encoder(nn.Module):
             raise ValueError("Hidden dimension must be even for BiRNNs")
         self.hid_dim, self.num_layers = hid_dim // self.num_dirs, num_layers
         super(Encoder, self).__init__()
-        self.rnn = getattr(nn, cell)(self.in_dim, self.hid_dim,
-                                     num_layers=self.num_layers,
-                                     dropout=dropout,
-                                     bidirectional=self.bidi)
+        if hasattr(nn, cell):
+            rnn = getattr(nn, cell)
+        else:                   # assume custom cell (e.g. QRNN, SRU)
+            rnn = getattr(custom, cell)
+        self.rnn = rnn(self.in_dim, self.hid_dim,
+                       num_layers=self.num_layers,
+                       dropout=dropout,
+                       bidirectional=self.bidi)
 
     def init_hidden_for(self, inp):
         batch = inp.size(1)
@@ -82,7 +117,45 @@ class Encoder(nn.Module):
         else:
             return h_0
 
-    def forward(self, inp, hidden=None):
+    def packed_forward(self, inp, hidden, lengths):
+        """
+        Run the rnn over a padded batch skipping the padding positions.
+        Outputs at padding positions are zero and the returned hidden state
+        corresponds to the last non-padding step of each example.
+        """
+        seq_len = inp.size(0)
+        if lengths.min() < 1:
+            raise ValueError("Can't pack empty examples (zero length)")
+        # pack_padded_sequence expects examples sorted by decreasing length
+        lengths, sort = torch.sort(lengths, dim=0, descending=True)
+        _, unsort = torch.sort(sort, dim=0)
+        sort, unsort = Variable(sort), Variable(unsort)
+        inp = inp.index_select(1, sort)
+        if self.cell.startswith('LSTM'):
+            hidden = (hidden[0].index_select(1, sort),
+                      hidden[1].index_select(1, sort))
+        else:
+            hidden = hidden.index_select(1, sort)
+
+        outs, hidden = self.rnn(
+            pack_padded_sequence(inp, lengths.tolist()), hidden)
+        outs, _ = pad_packed_sequence(outs)
+
+        # restore original batch order
+        outs = outs.index_select(1, unsort)
+        if self.cell.startswith('LSTM'):
+            hidden = (hidden[0].index_select(1, unsort),
+                      hidden[1].index_select(1, unsort))
+        else:
+            hidden = hidden.index_select(1, unsort)
+        if outs.size(0) < seq_len:
+            # no example spans the full input length
+            size = (seq_len - outs.size(0), *outs.size()[1:])
+            outs = torch.cat([outs, Variable(outs.data.new(*size).zero_())])
+
+        return outs, hidden
+
+    def forward(self, inp, hidden=None, lengths=None):
         """
         Paremeters:
         -----------
@@ -93,6 +166,11 @@ class Encoder(nn.Module):
             h_0: ((num_layers * num_dirs) x batch x hid_dim)
             n_0: ((num_layers * num_dirs) x batch x hid_dim)
 
+        - lengths: None or torch.LongTensor (batch), number of non-padding
+            steps of each example. If given, padding steps are skipped
+            (packing the input for nn.RNN cells, masking it for custom
+            cells such as QRNN or SRU).
+
         Returns: output, (h_t, c_t)
         --------
 
@@ -101,7 +179,12 @@ class Encoder(nn.Module):
         - c_t: (num_layers x batch x hidden_size * num_directions)
         """
         hidden = hidden if hidden is not None else self.init_hidden_for(inp)
-        outs, hidden = self.rnn(inp, hidden)
+        if lengths is None:
+            outs, hidden = self.rnn(inp, hidden)
+        elif isinstance(self.rnn, nn.RNNBase):
+            outs, hidden = self.packed_forward(inp, hidden, lengths)
+        else:
+            outs, hidden = self.rnn(inp, hidden, lengths=lengths)
         if self.bidi:
             # BiRNN encoder outputs (num_layers * 2 x batch x hid_dim)
             # but decoder expects   (num_layers x batch x hid_dim * 2)
@@ -113,6 +196,102 @@ class Encoder(nn.Module):
         return outs, hidden
 
 
+class ConvEncoder(nn.Module):
+    """
+    Gated convolutional encoder (Gehring et al. 2017) as a parallel
+    alternative to the RNN Encoder. Each layer is a convolution over the
+    full source followed by a gated linear unit and a residual connection.
+    Since convolutions are order-agnostic, learned position embeddings are
+    added to the input.
+
+    Parameters:
+    -----------
+    - kernel_size: int, odd width of the convolutions
+    - max_len: int, maximum source length (number of position embeddings)
+    """
+    def __init__(self, in_dim, hid_dim, num_layers, cell,
+                 dropout=0.0, kernel_size=3, max_len=1024):
+        if kernel_size % 2 != 1:
+            raise ValueError("kernel_size must be odd")
+        self.in_dim, self.hid_dim, self.cell = in_dim, hid_dim, cell
+        self.num_layers, self.dropout = num_layers, dropout
+        super(ConvEncoder, self).__init__()
+        self.positions = nn.Embedding(max_len, in_dim)
+        self.inp2hid = nn.Linear(in_dim, hid_dim)
+        self.convs = nn.ModuleList(
+            [nn.Conv1d(hid_dim, 2 * hid_dim, kernel_size,
+                       padding=kernel_size // 2)
+             for _ in range(num_layers)])
+        self.hid2summary = nn.Linear(hid_dim, hid_dim)
+
+    def forward(self, inp, hidden=None, lengths=None):
+        """
+        Paremeters:
+        -----------
+
+        - inp: torch.Tensor (seq_len x batch x emb_dim)
+        - hidden: ignored (for compatibility with Encoder)
+        - lengths: None or torch.LongTensor (batch), number of non-padding
+            steps of each example. If given, outputs at padding positions
+            are zeroed at every layer so that they don't leak into the
+            convolutions.
+
+        Returns: output, hidden
+        --------
+
+        - output: (seq_len x batch x hid_dim)
+        - hidden: (num_layers x batch x hid_dim) or tuple (h_t, c_t) for
+            LSTM decoders, with the average of the outputs (as a summary)
+            in h_t and zeros in c_t. Same shape as the repackaged hidden
+            state of a bidirectional Encoder.
+        """
+        seq_len, batch, _ = inp.size()
+        max_len = self.positions.num_embeddings
+        if seq_len > max_len:
+            raise ValueError("Source of length {} exceeds the maximum "
+                             "source length {}".format(seq_len, max_len))
+        pos = Variable(inp.data.new(seq_len).copy_(
+            torch.arange(0, seq_len)).long())
+        inp = inp + self.positions(pos).unsqueeze(1).expand_as(inp)
+
+        keep = None
+        if lengths is not None:
+            # (batch x 1 x seq_len) with 1s at non-padding positions
+            steps = lengths.new(seq_len).copy_(torch.arange(0, seq_len))
+            keep = steps.unsqueeze(0).expand(batch, seq_len) \
+                        .lt(lengths.unsqueeze(1).expand(batch, seq_len))
+            keep = Variable(keep.unsqueeze(1).float())
+
+        # (batch x hid_dim x seq_len)
+        outs = self.inp2hid(F.dropout(
+            inp.view(-1, self.in_dim), p=self.dropout,
+            training=self.training))
+        outs = outs.view(seq_len, batch, self.hid_dim).permute(1, 2, 0)
+        for conv in self.convs:
+            if keep is not None:
+                outs = outs * keep.expand_as(outs)
+            residual = outs
+            outs = conv(F.dropout(outs, p=self.dropout,
+                                  training=self.training))
+            # gated linear unit
+            outs, gate = outs.chunk(2, 1)
+            outs = (outs * F.sigmoid(gate) + residual) * math.sqrt(0.5)
+
+        if keep is not None:
+            outs = outs * keep.expand_as(outs)
+            summary = outs.sum(2) / keep.sum(2).expand(batch, self.hid_dim)
+        else:
+            summary = outs.mean(2)
+        outs = outs.permute(2, 0, 1).contiguous()
+
+        h_t = F.tanh(self.hid2summary(summary))
+        h_t = h_t.unsqueeze(0).repeat(self.num_layers, 1, 1)
+        if self.cell.startswith('LSTM'):
+            c_t = Variable(h_t.data.new(*h_t.size()).zero_())
+            return outs, (h_t, c_t)
+        return outs, h_t
+
+
 class Decoder(nn.Module):
     """
     Attentional decoder for the EncoderDecoder architecture.
@@ -120,11 +299,16 @@ class Decoder(nn.Module):
     Parameters:
     -----------
 
-    - add_prev: bool, whether to append last hidden state.
+    - add_prev: bool, whether to append last hidden state. Without it,
+        the decoder rnn is a fused nn.LSTM/nn.GRU that can also be run over
+        the full target sequence at once (see forward_sequence).
+    - compile: bool, whether to run the rnn compiled with TorchScript in
+        evaluation mode (see u.CompiledModule).
     """
     def __init__(self, emb_dim, hid_dim, num_layers, cell,
                  att_dim, att_type='Bahdanau', maxout=2, dropout=0.0,
-                 add_prev=False, cond_dim=None):
+                 add_prev=False, cond_dim=None, att_window=10,
+                 compile=False):
         self.num_layers = num_layers
         self.hid_dim = hid_dim
         self.cell = cell
@@ -140,9 +324,15 @@ class Decoder(nn.Module):
             # TODO: implement FactorCell
 
         # rnn layers
-        stacked = StackedLSTM if cell == 'LSTM' else StackedGRU
-        self.rnn_step = stacked(
-            self.num_layers, in_dim, hid_dim, dropout=dropout)
+        if add_prev:
+            # input feeding requires step-wise decoding
+            stacked = StackedLSTM if cell == 'LSTM' else StackedGRU
+            self.rnn_step = stacked(
+                self.num_layers, in_dim, hid_dim, dropout=dropout)
+        else:
+            self.rnn_step = getattr(nn, cell)(
+                in_dim, hid_dim, num_layers=self.num_layers, dropout=dropout)
+        self.compiled_step = u.CompiledModule() if compile else None
 
         # attention network
         self.att_type = att_type
@@ -154,6 +344,11 @@ class Decoder(nn.Module):
                 raise ValueError(
                     "Global attention requires same size Encoder and Decoder")
             self.attn = attn.GlobalAttention(hid_dim)
+        elif att_type == 'Local':
+            if att_dim != hid_dim:
+                raise ValueError(
+                    "Local attention requires same size Encoder and Decoder")
+            self.attn = attn.LocalAttention(hid_dim, window=att_window)
         else:
             raise ValueError("Unknown attention network [%s]" % att_type)
 
@@ -162,6 +357,20 @@ class Decoder(nn.Module):
         if self.has_maxout:
             self.maxout = MaxOut(att_dim + emb_dim, att_dim, maxout)
 
+    @property
+    def fused(self):
+        "Whether the decoder can be run over a full target sequence at once"
+        # models pickled before the fused decoder hold a StackedLSTM/GRU
+        return isinstance(self.rnn_step, nn.RNNBase)
+
+    def get_rnn(self, inp):
+        "Compiled rnn in evaluation mode if requested, otherwise eager rnn"
+        # (models pickled before the compile option have no compiled_step)
+        compiled = getattr(self, 'compiled_step', None)
+        if compiled is None or self.training:
+            return self.rnn_step
+        return compiled(self.rnn_step, inp)
+
     def init_hidden_for(self, enc_hidden):
         """
         Creates a variable at decoding step 0 to be fed as init hidden step.
@@ -205,7 +414,7 @@ class Decoder(nn.Module):
         return Variable(data, requires_grad=False)
 
     def forward(self, prev, hidden, enc_outs, conds=None,
-                prev_out=None, enc_att=None, mask=None):
+                prev_out=None, enc_att=None, mask=None, full_weights=False):
         """
         Parameters:
         -----------
@@ -218,6 +427,10 @@ class Decoder(nn.Module):
         enc_outs: torch.Tensor (seq_len x batch x hid_dim),
             Output of the encoder at the last layer for all encoding steps.
         prev_out: torch.Tensor (batch x hid_dim), previous hidden output
+        mask: None or torch.ByteTensor (batch x seq_len), source padding
+            positions to be excluded from the attention.
+        full_weights: bool, whether Local attention should return its
+            weights over the full source (see LocalAttention.forward).
         """
         if self.add_prev:
             # include last out as input for the prediction of the next item
@@ -230,10 +443,16 @@ class Decoder(nn.Module):
             prev = torch.cat([prev, conds], 1)
 
         # step
-        out, hidden = self.rnn_step(prev, hidden)
+        rnn_step = self.get_rnn(prev)
+        if self.fused:
+            out, hidden = rnn_step(prev.unsqueeze(0), hidden)
+            out = out.squeeze(0)
+        else:
+            out, hidden = rnn_step(prev, hidden)
 
         # attention (batch x hid_dim), att_weight (batch x seq_len)
-        out, att_weight = self.attn(out, enc_outs, enc_att=enc_att, mask=mask)
+        out, att_weight = self.attn(out, enc_outs, enc_att=enc_att, mask=mask,
+                                    full_weights=full_weights)
 
         # deep output
         if self.has_maxout:
@@ -242,6 +461,49 @@ class Decoder(nn.Module):
 
         return out, hidden, att_weight
 
+    def forward_sequence(self, inp, hidden, enc_outs, conds=None,
+                         enc_att=None, mask=None):
+        """
+        Teacher-forced decoding of a full target sequence in one pass. Only
+        available for fused decoders (i.e. without input feeding), since
+        no step depends on the output of the previous one.
+
+        Parameters:
+        -----------
+
+        inp: torch.Tensor (trg_len x batch x emb_dim), target embeddings
+        hidden: see forward
+        enc_outs: see forward
+        conds: torch.Tensor (batch x cond_dim), condition embeddings
+
+        Returns: outs, hidden, att_weights
+        --------
+        outs: torch.Tensor (trg_len x batch x hid_dim)
+        att_weights: torch.Tensor (trg_len x batch x seq_len), or window
+            weights and positions for Local attention (see LocalAttention)
+        """
+        if not self.fused:
+            raise ValueError("Sequence decoding requires a fused decoder")
+        trg_len, batch, _ = inp.size()
+
+        # handle conditions
+        if conds is not None:
+            conds = conds.unsqueeze(0).expand(trg_len, *conds.size())
+            inp = torch.cat([inp, conds], 2)
+
+        outs, hidden = self.get_rnn(inp)(inp, hidden)
+
+        # attention (trg_len x batch x hid_dim)
+        outs, att_weights = self.attn(
+            outs, enc_outs, enc_att=enc_att, mask=mask)
+
+        # deep output
+        if self.has_maxout:
+            outs = F.dropout(outs, p=self.dropout, training=self.training)
+            outs = self.maxout(torch.cat([outs, inp], 2))
+
+        return outs, hidden, att_weights
+
 
 class EncoderDecoder(nn.Module):
     """
@@ -260,14 +522,27 @@ class EncoderDecoder(nn.Module):
     - src_dict: Dict, A fitted Dict used to encode the data into integers.
     - trg_dict: Dict, Same as src_dict in case of bilingual training.
     - cell: string, Cell type to use. One of (LSTM, GRU).
-    - att_type: string, Attention mechanism to use. One of (Global, Bahdanau).
+    - att_type: string, Attention mechanism to use. One of (Global, Bahdanau,
+        Local).
+    - att_window: int, half size of the attended source window for Local
+        attention.
     - dropout: float
     - word_dropout: float
     - bidi: bool, Whether to use bidirectional.
+    - sparse: bool, whether embeddings produce sparse gradients (see
+        misc.optimizer.sparse_parameters). Can't be used with tie_weights.
+    - encoder: str, one of ('rnn', 'conv'). 'conv' replaces the RNN
+        encoder by a ConvEncoder (cell and bidi only apply to the decoder)
+    - max_src_len: int, maximum source length for the conv encoder (number
+        of position embeddings).
     - add_prev: bool,
         Whether to feed back the last decoder state as input to
         the decoder for the next step together with the last
         predicted word embedding.
+    - compile: bool, whether to run the decoder rnn compiled with
+        TorchScript in evaluation mode, which mostly pays off when
+        decoding small batches. Falls back to the eager rnn if it can't
+        be scripted (see u.CompiledModule).
     """
     def __init__(self,
                  num_layers,
@@ -285,9 +560,17 @@ class EncoderDecoder(nn.Module):
                  add_prev=False,
                  tie_weights=False,
                  cond_vocabs=None,
-                 cond_dims=None):
+                 cond_dims=None,
+                 att_window=10,
+                 encoder='rnn',
+                 sparse=False,
+                 compile=False,
+                 max_src_len=1024):
+        if sparse and tie_weights:
+            raise ValueError("Sparse embeddings can't be tied")
         super(EncoderDecoder, self).__init__()
         self.cell = cell
+        self.encoder_cache, self.encoder_cache_size = None, 0
         self.add_prev = add_prev
         self.src_dict = src_dict
         self.trg_dict = trg_dict or src_dict
@@ -302,6 +585,8 @@ class EncoderDecoder(nn.Module):
                  self.src_dict.get_bos(),
                  self.src_dict.get_pad()]
         self.reserved_codes = tuple(code for code in codes if code is not None)
+        self.droppable = custom.DroppableTable(
+            src_vocab_size, self.reserved_codes)
 
         # NLLLoss weight (downweight loss on pad)
         self.nll_weight = torch.ones(len(self.trg_dict))
@@ -309,17 +594,26 @@ class EncoderDecoder(nn.Module):
 
         # Embedding layer(s)
         self.src_embeddings = nn.Embedding(
-            src_vocab_size, emb_dim, padding_idx=self.src_dict.get_pad())
+            src_vocab_size, emb_dim, padding_idx=self.src_dict.get_pad(),
+            sparse=sparse)
         if self.bilingual:
             self.trg_embeddings = nn.Embedding(
-                trg_vocab_size, emb_dim, padding_idx=self.trg_dict.get_pad())
+                trg_vocab_size, emb_dim, padding_idx=self.trg_dict.get_pad(),
+                sparse=sparse)
         else:
             self.trg_embeddings = self.src_embeddings
 
         # Encoder
-        self.encoder = Encoder(
-            emb_dim, hid_dim, num_layers,
-            cell=cell, bidi=bidi, dropout=dropout)
+        if encoder == 'rnn':
+            self.encoder = Encoder(
+                emb_dim, hid_dim, num_layers,
+                cell=cell, bidi=bidi, dropout=dropout)
+        elif encoder == 'conv':
+            self.encoder = ConvEncoder(
+                emb_dim, hid_dim, num_layers, cell, dropout=dropout,
+                max_len=max_src_len)
+        else:
+            raise ValueError("Unknown encoder [%s]" % encoder)
 
         # Decoder
         # (handle conditions)
@@ -343,7 +637,8 @@ class EncoderDecoder(nn.Module):
         self.decoder = Decoder(
             emb_dim, hid_dim, num_layers, cell, att_dim,
             dropout=dropout, maxout=maxout, add_prev=add_prev,
-            att_type=att_type, cond_dim=self.cond_dim)
+            att_type=att_type, cond_dim=self.cond_dim, att_window=att_window,
+            compile=compile)
 
         # Output projection
         output_size = trg_vocab_size if self.bilingual else src_vocab_size
@@ -374,6 +669,45 @@ class EncoderDecoder(nn.Module):
         "Whether the model is on a gpu. We assume no device sharing."
         return next(self.parameters()).is_cuda
 
+    def __setstate__(self, state):
+        # models pickled before the word dropout table was added
+        if 'droppable' not in state:
+            state['droppable'] = custom.DroppableTable(
+                len(state['src_dict']), state['reserved_codes'])
+        super(EncoderDecoder, self).__setstate__(state)
+
+    def train(self, mode=True):
+        # cached encoder states are stale after (or during) training
+        if getattr(self, 'encoder_cache', None) is not None:
+            self.encoder_cache.clear()
+        return super(EncoderDecoder, self).train(mode)
+
+    def enable_encoder_cache(self, size=128):
+        """
+        Keep the encoder states of the last `size` source sentences, keyed
+        by their (unpadded) token ids, so that repeated greedy, beam or
+        scoring passes over the same sentences only encode them once, even
+        if they are batched differently. The cache is only used by the
+        decoding and scoring entry points (translate, translate_beam_batch
+        and score_pairs) in evaluation mode and is cleared whenever the
+        mode changes or new weights are loaded.
+        """
+        self.encoder_cache_size = size
+        self.encoder_cache = OrderedDict()
+
+    def disable_encoder_cache(self):
+        self.encoder_cache = None
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        # cached encoder states were computed with the old weights
+        if getattr(self, 'encoder_cache', None) is not None:
+            self.encoder_cache.clear()
+        if self.decoder.fused:
+            # checkpoints from before the fused decoder
+            state_dict = convert_stacked_rnn_keys(state_dict)
+        return super(EncoderDecoder, self).load_state_dict(
+            state_dict, *args, **kwargs)
+
     def parameters(self):
         for p in super(EncoderDecoder, self).parameters():
             if p.requires_grad is True:
@@ -404,6 +738,11 @@ class EncoderDecoder(nn.Module):
         source_rnn = self.decoder.rnn_step.state_dict().keys()
         merge_map = {}
         for param in source_rnn:
+            if self.decoder.fused:
+                # fused decoder shares the LM rnn format "weight_ih_l0"
+                if param in target_rnn:
+                    merge_map[param] = "decoder.rnn_step." + param
+                continue
             try:
                 # Decoder has format "LSTMCell_0.weight_ih"
                 num, suffix = re.findall(r".*([0-9]+)\.(.*)", param)[0]
@@ -465,6 +804,160 @@ class EncoderDecoder(nn.Module):
         for p in getattr(self, module).parameters():
             p.requires_grad = False
 
+    def source_mask(self, src):
+        """
+        Compute source lengths and attention mask from a padded source batch.
+
+        Returns: lengths, mask
+        --------
+        lengths: torch.LongTensor (batch) or None if there is no padding
+        mask: torch.ByteTensor (batch x seq_len) or None if there is no
+            padding, with 1s at padding positions
+
+        Empty (all-padding) sources are treated as a single padding token,
+        so that they can still be packed and attended to.
+        """
+        pad = self.src_dict.get_pad()
+        if pad is None:
+            return None, None
+        pad_mask = src.data.eq(pad)
+        if pad_mask.sum() == 0:
+            return None, None
+        lengths = src.data.ne(pad).long().sum(0)
+        # unmask the first step of empty sources
+        pad_mask[0].masked_fill_(lengths.eq(0), 0)
+        return lengths.clamp(min=1), pad_mask.t().contiguous()
+
+    def encode(self, src, cache=False):
+        """
+        Run the encoder over a source batch. In case of Bahdanau attention,
+        the attention projection of the encoder outputs is computed as well,
+        so that callers can reuse it across decoding steps, beam expansions
+        or reranking passes over the same source. Padding positions are
+        skipped by the encoder and masked out for the attention.
+
+        Parameters:
+        -----------
+        src: torch.LongTensor (seq_len x batch)
+        cache: bool, whether to look up the states of each sentence in the
+            encoder cache first (see enable_encoder_cache). Ignored during
+            training or if the cache isn't enabled.
+
+        Returns: EncoderState(enc_outs, enc_hidden, enc_att, mask)
+        --------
+        enc_outs: torch.Tensor (seq_len x batch x hid_dim)
+        enc_hidden: see Encoder.forward
+        enc_att: torch.Tensor (seq_len x batch x att_dim) or None
+        mask: torch.ByteTensor (batch x seq_len) or None, see source_mask
+        """
+        enabled = getattr(self, 'encoder_cache', None) is not None
+        if not cache or not enabled or self.training:
+            return self._encode(src)
+        return self._cached_encode(src)
+
+    def _cached_encode(self, src):
+        cache, pad = self.encoder_cache, self.src_dict.get_pad()
+        keys = []
+        for sent in src.data.t().tolist():
+            if pad is not None:
+                sent = [idx for idx in sent if idx != pad]
+            keys.append((src.is_cuda, tuple(sent)))
+
+        # encode missing sentences together (once each)
+        states, missing = {}, OrderedDict()
+        for col, key in enumerate(keys):
+            if key in cache:
+                cache.move_to_end(key)
+                states[key] = cache[key]
+            elif key not in missing:
+                missing[key] = col
+        if missing:
+            cols = src.data.new(list(missing.values()))
+            enc_outs, enc_hidden, enc_att, _ = self._encode(
+                src.index_select(1, Variable(cols, volatile=True)))
+            for col, key in enumerate(missing):
+                length = max(len(key[1]), 1)  # see source_mask
+                if self.cell.startswith('LSTM'):
+                    hidden = (enc_hidden[0][:, col:col+1],
+                              enc_hidden[1][:, col:col+1])
+                else:
+                    hidden = enc_hidden[:, col:col+1]
+                states[key] = cache[key] = EncoderState(
+                    enc_outs[:length, col:col+1], hidden,
+                    enc_att[:length, col:col+1] if enc_att is not None
+                    else None, None)
+            while len(cache) > self.encoder_cache_size:
+                cache.popitem(last=False)  # drop least recently used
+
+        # gather (and re-pad) the sentence states into a batch
+        seq_len = src.size(0)
+
+        def pad_steps(var):
+            if var.size(0) == seq_len:
+                return var
+            size = (seq_len - var.size(0), *var.size()[1:])
+            return torch.cat([var, Variable(var.data.new(*size).zero_())])
+
+        states = [states[key] for key in keys]
+        enc_outs = torch.cat([pad_steps(s.enc_outs) for s in states], 1)
+        enc_att = None
+        if states[0].enc_att is not None:
+            enc_att = torch.cat([pad_steps(s.enc_att) for s in states], 1)
+        if self.cell.startswith('LSTM'):
+            enc_hidden = (torch.cat([s.enc_hidden[0] for s in states], 1),
+                          torch.cat([s.enc_hidden[1] for s in states], 1))
+        else:
+            enc_hidden = torch.cat([s.enc_hidden for s in states], 1)
+        _, mask = self.source_mask(src)
+        return EncoderState(enc_outs, enc_hidden, enc_att, mask)
+
+    def _encode(self, src):
+        lengths, mask = self.source_mask(src)
+        enc_outs, enc_hidden = self.encoder(
+            self.src_embeddings(src), lengths=lengths)
+        enc_att = None
+        if self.decoder.att_type == 'Bahdanau':
+            enc_att = self.decoder.attn.project_enc_outs(enc_outs)
+        return EncoderState(enc_outs, enc_hidden, enc_att, mask)
+
+    def decode(self, trg, enc_state, conds=None):
+        """
+        Teacher-forced decoding of a target batch given the encoder state.
+
+        Parameters:
+        -----------
+        trg: torch.Tensor (seq_len x batch), decoder input
+        enc_state: EncoderState, output of encode (with matching batch)
+        conds: torch.Tensor (batch x cond_dim) or None, cond embeddings
+
+        Returns:
+        --------
+        dec_outs: torch.Tensor (seq_len x batch x hid_dim)
+        """
+        enc_outs, enc_hidden, enc_att, mask = enc_state
+        dec_hidden = self.decoder.init_hidden_for(enc_hidden)
+
+        if self.decoder.fused:
+            # no input feeding: decode the whole target at once
+            dec_outs, _, _ = self.decoder.forward_sequence(
+                self.trg_embeddings(trg), dec_hidden, enc_outs,
+                enc_att=enc_att, conds=conds, mask=mask)
+            return dec_outs
+
+        dec_outs, dec_out = [], None
+
+        for prev in trg:
+            # (seq_len x batch x emb_dim)
+            prev_emb = self.trg_embeddings(prev)
+            # (batch x emb_dim)
+            prev_emb = prev_emb.squeeze(0)
+            dec_out, dec_hidden, att_weight = self.decoder(
+                prev_emb, dec_hidden, enc_outs, enc_att=enc_att,
+                prev_out=dec_out, conds=conds, mask=mask)
+            dec_outs.append(dec_out)
+
+        return torch.stack(dec_outs)
+
     def forward(self, inp, trg, conds=None):
         """
         Parameters:
@@ -485,38 +978,23 @@ class EncoderDecoder(nn.Module):
 
         # encoder
         inp = word_dropout(
-            inp, self.target_code, reserved_codes=self.reserved_codes,
+            inp, self.target_code, droppable=self.droppable,
             p=self.word_dropout, training=self.training)
 
-        enc_outs, enc_hidden = self.encoder(self.src_embeddings(inp))
+        enc_state = self.encode(inp)
         cond_out = []
         if self.cond_dim is not None:
             # use last step as summary vector
             # enc_out = grad_reverse(enc_outs[-1]) # keep this for experiments
             # use average step as summary vector
-            enc_out = grad_reverse(enc_outs.mean(dim=0))
+            enc_out = grad_reverse(enc_state.enc_outs.mean(dim=0))
             for grl in self.grls:
                 cond_out.append(F.log_softmax(grl(enc_out)))
 
         # decoder
-        dec_hidden = self.decoder.init_hidden_for(enc_hidden)
-        dec_outs, dec_out, enc_att = [], None, None
+        dec_outs = self.decode(trg, enc_state, conds=conds)
 
-        if self.decoder.att_type == 'Bahdanau':
-            # cache encoder att projection for bahdanau
-            enc_att = self.decoder.attn.project_enc_outs(enc_outs)
-
-        for prev in trg:
-            # (seq_len x batch x emb_dim)
-            prev_emb = self.trg_embeddings(prev)
-            # (batch x emb_dim)
-            prev_emb = prev_emb.squeeze(0)
-            dec_out, dec_hidden, att_weight = self.decoder(
-                prev_emb, dec_hidden, enc_outs, enc_att=enc_att,
-                prev_out=dec_out, conds=conds)
-            dec_outs.append(dec_out)
-
-        return torch.stack(dec_outs), tuple(cond_out)
+        return dec_outs, tuple(cond_out)
 
     def loss(self, batch_data, test=False, split=25):
         """
@@ -572,31 +1050,137 @@ class EncoderDecoder(nn.Module):
 
         return (loss.data[0], *[l.data[0] for l in cond_loss]), num_examples
 
-    def translate(self, src, max_decode_len=2, conds=None):
+    def score_pairs(self, pairs, max_tokens=4096, split=25):
+        """
+        Compute the log-probability of given targets conditioned on their
+        sources (e.g. for n-best reranking or MBR) with teacher-forced
+        decoding. Targets of the same source share a single encoding and
+        the output projection is computed in shards of `split` steps to
+        bound memory. The model should be in evaluation mode.
+
+        Parameters:
+        -----------
+        pairs: list of (src, trg), where src and trg are lists of ints
+            transformed by the model dicts (i.e. including <bos>/<eos>)
+        max_tokens: int, maximum number of padded target tokens per batch
+        split: int, number of decoding steps projected at once
+
+        Returns: scores, normalized
+        --------
+        scores: list of floats, summed target log-probabilities per pair
+        normalized: list of floats, scores divided by number of target
+            symbols (excluding <bos>), in the same order as `pairs`
+        """
+        if self.cond_dim is not None:
+            raise ValueError("score_pairs doesn't support conditional models")
+        eos, pad = self.src_dict.get_eos(), self.trg_dict.get_pad()
+        scores, normalized = [0.] * len(pairs), [0.] * len(pairs)
+
+        for sources, rows, idxs in pair_batches(pairs, max_tokens):
+            src = pad_pack_batch(sources, self.src_dict.get_pad())
+            trg = pad_pack_batch([pairs[idx][1] for idx in idxs], pad)
+            rows = torch.LongTensor(rows)
+            if self.is_cuda():
+                src, trg, rows = src.cuda(), trg.cuda(), rows.cuda()
+
+            # encode sources once and expand them to their targets
+            enc_outs, enc_hidden, enc_att, mask = self.encode(
+                Variable(src, volatile=True), cache=True)
+            index = Variable(rows, volatile=True)
+            enc_outs = enc_outs.index_select(1, index)
+            if enc_att is not None:
+                enc_att = enc_att.index_select(1, index)
+            if mask is not None:
+                mask = mask.index_select(0, rows)
+            if self.cell.startswith('LSTM'):
+                enc_hidden = (enc_hidden[0].index_select(1, index),
+                              enc_hidden[1].index_select(1, index))
+            else:
+                enc_hidden = enc_hidden.index_select(1, index)
+            enc_state = EncoderState(enc_outs, enc_hidden, enc_att, mask)
+
+            # remove <eos> from decoder input and <bos> from targets
+            dec_trg = Variable(
+                u.map_index(trg[:-1].clone(), eos, pad), volatile=True)
+            loss_trg = trg[1:]
+            dec_outs = self.decode(dec_trg, enc_state)
+
+            batch_scores = dec_outs.data.new(len(idxs)).zero_()
+            for out, target in zip(torch.split(dec_outs, split),
+                                   torch.split(loss_trg, split)):
+                seq_len, batch, hid_dim = out.size()
+                logprobs = self.project(out.view(-1, hid_dim)).data
+                logprobs = logprobs.gather(1, target.contiguous().view(-1, 1))
+                logprobs = logprobs.view(seq_len, batch)
+                if pad is not None:
+                    logprobs.masked_fill_(target.eq(pad), 0)
+                batch_scores += logprobs.sum(0)
+
+            if pad is not None:
+                lengths = loss_trg.ne(pad).float().sum(0).tolist()
+            else:
+                lengths = [len(loss_trg)] * len(idxs)
+            batch_scores = batch_scores.tolist()
+            for idx, score, length in zip(idxs, batch_scores, lengths):
+                scores[idx], normalized[idx] = score, score / max(length, 1)
+
+        return scores, normalized
+
+    def project_shortlist(self, dec_out, ids):
+        """
+        Compute output log-probabilities only over a subset of the target
+        vocabulary (normalized over the subset).
+
+        Parameters:
+        -----------
+        dec_out: torch.Tensor (batch x hid_dim)
+        ids: torch.LongTensor (shortlist_size), target vocabulary indices
+
+        Returns:
+        --------
+        torch.Tensor (batch x shortlist_size)
         """
-        Translate a single input sequence using greedy decoding.
+        *hidden, output, _ = self.project.children()
+        for layer in hidden:    # (optional projection for tied weights)
+            dec_out = layer(dec_out)
+        ids = Variable(ids, volatile=True)
+        weight, bias = output.weight, output.bias
+        if callable(weight):    # int8 layer (see u.quantize_for_inference)
+            weight, bias = weight().dequantize(), bias()
+        weight, bias = weight.index_select(0, ids), bias.index_select(0, ids)
+        return F.log_softmax(F.linear(dec_out, weight, bias))
+
+    def translate(self, src, max_decode_len=2, conds=None, return_atts=True,
+                  shortlist=None):
+        """
+        Translate a batch of input sequences using greedy decoding. Rows
+        that have produced <eos> are dropped from the decoding batch, so
+        that finished hypotheses don't keep paying for decoder steps.
 
         Parameters:
         -----------
 
         src: torch.LongTensor (seq_len x batch_size)
+        return_atts: bool, whether to collect the attention weights, which
+            is as costly as the decoding itself for long sources.
+        shortlist: None or Shortlist, if given the output softmax is
+            restricted to the shortlist computed for the source batch.
 
         Returns (scores, hyps, atts):
         --------
         scores: (batch_size)
-        hyps: (batch_size x seq_len)
-        atts: (batch_size x seq_len x source_seq_len)
+        hyps: (batch_size x seq_len), hypotheses are padded after <eos>
+        atts: (batch_size x seq_len x source_seq_len), None if not
+            `return_atts`
         """
         eos = self.src_dict.get_eos()
         bos = self.src_dict.get_bos()
+        pad = self.trg_dict.get_pad()
         seq_len, batch_size = src.size()
-
-        # output variables
-        scores, hyps, atts = 0, [], []
+        max_len = seq_len * max_decode_len
 
         # Encode
-        emb = self.src_embeddings(src)
-        enc_outs, enc_hidden = self.encoder(emb)
+        enc_outs, enc_hidden, enc_att, src_mask = self.encode(src, cache=True)
 
         # Decode
         # (handler conditions)
@@ -608,41 +1192,78 @@ class EncoderDecoder(nn.Module):
             conds = torch.cat(conds, 1)
 
         dec_hidden = self.decoder.init_hidden_for(enc_hidden)
-        dec_out, enc_att = None, None
-        if self.decoder.att_type == 'Bahdanau':
-            enc_att = self.decoder.attn.project_enc_outs(enc_outs)
+        dec_out = None
 
-        prev = src.data.new([bos]).expand(batch_size)
-        prev = Variable(prev, volatile=True)
-        mask = src.data.new(batch_size).zero_().float() + 1
+        if shortlist is not None:
+            shortlist_ids = shortlist.ids_for(src.data)
 
-        for _ in range(len(src) * max_decode_len):
-            prev = prev.unsqueeze(1)  # add seq_len dim
-            prev_emb = self.trg_embeddings(prev).squeeze(0)
+        # output variables (in input order)
+        scores = torch.zeros(batch_size)
+        hyps = src.data.new(max_len, batch_size).fill_(
+            pad if pad is not None else eos)
+        atts = None
+        if return_atts:
+            atts = enc_outs.data.new(max_len, batch_size, seq_len).zero_()
+
+        # map from rows in the decoding batch to rows in the input batch
+        active = src.data.new(list(range(batch_size)))
+        prev = Variable(src.data.new([bos]).expand(batch_size), volatile=True)
+
+        for step in range(max_len):
+            prev_emb = self.trg_embeddings(prev.unsqueeze(0)).squeeze(0)
             dec_out, dec_hidden, att_weights = self.decoder(
                 prev_emb, dec_hidden, enc_outs, prev_out=dec_out,
-                enc_att=enc_att)
-            # (batch x vocab_size)
-            logprobs = self.project(dec_out)
-            # (batch) argmax over logprobs
-            logprobs, prev = logprobs.max(1)
+                enc_att=enc_att, conds=conds, mask=src_mask,
+                full_weights=return_atts)
+            if shortlist is None:
+                # (batch x vocab_size)
+                logprobs = self.project(dec_out)
+                # (batch) argmax over logprobs
+                logprobs, prev = logprobs.max(1)
+            else:
+                # (batch x shortlist_size)
+                logprobs = self.project_shortlist(dec_out, shortlist_ids)
+                logprobs, prev = logprobs.max(1)
+                # map back to target vocabulary
+                prev = Variable(
+                    shortlist_ids.index_select(0, prev.data), volatile=True)
             # accumulate
-            scores += logprobs.data.cpu()
-            hyps.append(prev.data)
-            atts.append(att_weights.data)
-            # update mask
-            mask = mask * (prev.data != eos).float()
-
-            # terminate if all done
-            if mask.sum() == 0:
+            scores.index_add_(0, active.cpu(), logprobs.data.cpu())
+            hyps[step].index_copy_(0, active, prev.data)
+            if return_atts:
+                atts[step].index_copy_(0, active, att_weights.data)
+
+            # drop finished rows
+            keep = prev.data.ne(eos).nonzero()
+            if len(keep) == 0:  # terminate if all done
                 break
-
-        hyps = torch.stack(hyps).transpose(0, 1).tolist()
-        atts = torch.stack(atts).transpose(0, 1).tolist()
+            if len(keep) < len(active):
+                keep = keep.squeeze(1)
+                active = active.index_select(0, keep)
+                if src_mask is not None:
+                    src_mask = src_mask.index_select(0, keep)
+                keep = Variable(keep, volatile=True)
+                prev = prev.index_select(0, keep)
+                dec_out = dec_out.index_select(0, keep)
+                enc_outs = enc_outs.index_select(1, keep)
+                if enc_att is not None:
+                    enc_att = enc_att.index_select(1, keep)
+                if conds is not None:
+                    conds = conds.index_select(0, keep)
+                if self.cell.startswith('LSTM'):
+                    dec_hidden = (dec_hidden[0].index_select(1, keep),
+                                  dec_hidden[1].index_select(1, keep))
+                else:
+                    dec_hidden = dec_hidden.index_select(1, keep)
+
+        hyps = hyps[:step + 1].t().tolist()
+        if return_atts:
+            atts = atts[:step + 1].transpose(0, 1).tolist()
 
         return scores, hyps, atts
 
-    def translate_beam(self, src, max_decode_len=2, beam_width=5, conds=None):
+    def translate_beam(self, src, max_decode_len=2, beam_width=5, conds=None,
+                       shortlist=None):
         """
         Translate a single input sequence using beam search.
 
@@ -651,19 +1272,64 @@ class EncoderDecoder(nn.Module):
 
         src: torch.LongTensor (seq_len x 1)
         """
+        scores, hyps = self.translate_beam_batch(
+            src, max_decode_len=max_decode_len, beam_width=beam_width,
+            conds=conds, shortlist=shortlist)
+
+        return scores[0], hyps[0], None
+
+    def translate_beam_batch(self, src, max_decode_len=2, beam_width=5,
+                             conds=None, shortlist=None):
+        """
+        Translate a batch of input sequences using beam search. All sources
+        are encoded in a single pass and decoded together over
+        (batch * beam_width) rows, while each source keeps its own beam
+        (top-k, backpointers and <eos> handling). Decoding of a source stops
+        when its beam finishes or after `max_decode_len` times its length.
+
+        Parameters:
+        -----------
+
+        src: torch.LongTensor (seq_len x batch)
+        shortlist: None or Shortlist, if given the output softmax is
+            restricted to the shortlist computed for the source batch.
+
+        Returns (scores, hyps):
+        --------
+        scores: list of length batch of torch.Tensor (beam_width)
+        hyps: list of length batch of lists of beam_width hypotheses,
+            in the same order as the input sources.
+        """
         eos = self.src_dict.get_eos()
         bos = self.src_dict.get_bos()
-        gpu = src.is_cuda
+        pad = self.src_dict.get_pad()
+        seq_len, batch = src.size()
+        width, gpu = beam_width, src.is_cuda
 
-        # Encode
-        emb = self.src_embeddings(src)
-        enc_outs, enc_hidden = self.encoder(emb)
-        enc_outs = enc_outs.repeat(1, beam_width, 1)
+        # per-source decoding limits
+        if pad is not None:
+            lengths = src.data.ne(pad).long().sum(0).view(-1).tolist()
+        else:
+            lengths = [seq_len] * batch
+        max_lens = [length * max_decode_len for length in lengths]
+
+        # Encode (projecting the encoder outputs before expanding to beam)
+        enc_outs, enc_hidden, enc_att, mask = self.encode(src, cache=True)
+
+        # expand to beam: row (b * width + k) holds beam entry k of source b
+        beam_index = src.data.new(list(range(batch)))
+        beam_index = beam_index.unsqueeze(1).repeat(1, width).view(-1)
+        beam_index = Variable(beam_index, volatile=True)
+        enc_outs = enc_outs.index_select(1, beam_index)
+        if enc_att is not None:
+            enc_att = enc_att.index_select(1, beam_index)
+        if mask is not None:
+            mask = mask.index_select(0, beam_index.data)
         if self.cell.startswith('LSTM'):
-            enc_hidden = (enc_hidden[0].repeat(1, beam_width, 1),
-                          enc_hidden[1].repeat(1, beam_width, 1))
+            enc_hidden = (enc_hidden[0].index_select(1, beam_index),
+                          enc_hidden[1].index_select(1, beam_index))
         else:
-            enc_hidden = enc_hidden.repeat(1, beam_width, 1)
+            enc_hidden = enc_hidden.index_select(1, beam_index)
 
         # Decode
         # (handler conditions)
@@ -671,38 +1337,62 @@ class EncoderDecoder(nn.Module):
             if conds is None:
                 raise ValueError("Conditional decoder needs conds")
             conds = [emb(cond) for cond, emb in zip(conds, self.cond_embs)]
-            # (batch_size x total emb dim)
-            conds = torch.cat(conds, 1)
-            conds = conds.repeat(beam_width, 1)
+            # (batch_size * width x total emb dim)
+            conds = torch.cat(conds, 1).index_select(0, beam_index)
 
         dec_hidden = self.decoder.init_hidden_for(enc_hidden)
-        dec_out, enc_att = None, None
-        if self.decoder.att_type == 'Bahdanau':
-            enc_att = self.decoder.attn.project_enc_outs(enc_outs)
+        dec_out = None
+
+        shortlist_ids = None
+        if shortlist is not None:
+            shortlist_ids = shortlist.ids_for(src.data)
+            if len(shortlist_ids) < width:
+                raise ValueError("Shortlist is smaller than the beam")
+
+        beams = [Beam(width, bos, eos=eos, gpu=gpu) for _ in range(batch)]
 
-        beam = Beam(beam_width, bos, eos=eos, gpu=gpu)
+        def is_active(b):
+            return beams[b].active and len(beams[b]) < max_lens[b]
 
-        while beam.active and len(beam) < len(src) * max_decode_len:
-            # (width) -> (1 x width)
-            prev = beam.get_current_state().unsqueeze(0)
-            prev = Variable(prev, volatile=True)
+        while any(is_active(b) for b in range(batch)):
+            # (batch * width) -> (1 x batch * width)
+            prev = torch.cat([beam.get_current_state() for beam in beams])
+            prev = Variable(prev.unsqueeze(0), volatile=True)
             prev_emb = self.trg_embeddings(prev).squeeze(0)
 
             dec_out, dec_hidden, att_weights = self.decoder(
                 prev_emb, dec_hidden, enc_outs, prev_out=dec_out,
-                enc_att=enc_att, conds=conds)
-            # (width x vocab_size)
-            logprobs = self.project(dec_out)
-            beam.advance(logprobs.data)
-
-            # repackage according to source beam
-            dec_out = u.swap(dec_out, 0, beam.get_source_beam())
+                enc_att=enc_att, conds=conds, mask=mask)
+            if shortlist is None:
+                logprobs = self.project(dec_out).data
+            else:
+                # (batch * width x shortlist_size)
+                logprobs = self.project_shortlist(dec_out, shortlist_ids).data
+            # (batch x width x vocab_size or shortlist_size)
+            logprobs = logprobs.view(batch, width, -1)
+
+            source_beams = []
+            for b, beam in enumerate(beams):
+                if is_active(b):
+                    # beams map shortlist columns back to the vocabulary
+                    beam.advance(logprobs[b], ids=shortlist_ids)
+                    source_beam = beam.get_source_beam()
+                else:           # finished beams stay in place
+                    source_beam = beam_index.data.new(list(range(width)))
+                source_beams.append(source_beam + b * width)
+
+            # repackage according to source beams
+            source_beams = Variable(torch.cat(source_beams), volatile=True)
+            dec_out = u.swap(dec_out, 0, source_beams)
             if self.cell.startswith('LSTM'):
-                dec_hidden = (u.swap(dec_hidden[0], 1, beam.get_source_beam()),
-                              u.swap(dec_hidden[1], 1, beam.get_source_beam()))
+                dec_hidden = (u.swap(dec_hidden[0], 1, source_beams),
+                              u.swap(dec_hidden[1], 1, source_beams))
             else:
-                dec_hidden = u.swap(dec_hidden, 1, beam.get_source_beam())
+                dec_hidden = u.swap(dec_hidden, 1, source_beams)
 
-        scores, hyps = beam.decode(n=beam_width)
+        scores, hyps = [], []
+        for beam in beams:
+            beam_scores, beam_hyps = beam.decode(n=width)
+            scores.append(beam_scores), hyps.append(beam_hyps)
 
-        return scores, hyps, None
+        return scores, hyps
@@ -1,4 +1,5 @@
 
+import math
 import logging
 
 import numpy as np
@@ -9,8 +10,11 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 
 from seqmod import utils as u
+from seqmod.utils import shards
 from seqmod.modules import custom
 from seqmod.modules.custom import word_dropout, MaxOut
+from seqmod.modules.softmax import AdaptiveSoftmax, UnigramSampler
+from seqmod.modules.softmax import sampled_softmax_loss
 from seqmod.misc.beam_search import Beam
 
 
@@ -29,6 +33,53 @@ def strip_post_eos(sents, eos):
     return out
 
 
+def sample_candidates(logprobs, temperature=1., top_k=0, top_p=None,
+                      max_candidates=1000):
+    """
+    Sample a symbol per row from the output distribution. If `top_k` or
+    `top_p` are given, sampling is restricted to a (partially sorted) candidate
+    set and done with the Gumbel-max trick over the reduced logits, which
+    avoids exponentiating and normalizing over the full vocabulary.
+
+    Parameters:
+    -----------
+    logprobs: torch.Tensor (batch x vocab), output log-probabilities
+    temperature: float, temperature for the sampling distribution
+    top_k: int, only sample from the `top_k` most likely symbols. If `top_p`
+        is also given, `top_k` bounds the size of the partial sort.
+    top_p: None or float, only sample from the smallest set of most likely
+        symbols whose (untempered) cumulative probability exceeds `top_p`
+    max_candidates: int, size of the partial sort if only `top_p` is given,
+        so that per-step cost doesn't grow with the vocabulary. Nuclei
+        larger than this are truncated.
+
+    Returns: prev, scores
+    --------
+    prev: torch.LongTensor (batch), sampled symbols
+    scores: torch.Tensor (batch), exact log-probabilities of the samples
+    """
+    if not top_k and top_p is None:
+        prev = logprobs.div(temperature).exp_().multinomial(1)
+        return prev.squeeze(1), logprobs.gather(1, prev).squeeze(1)
+
+    batch, vocab = logprobs.size()
+    # (batch x k) candidates sorted in descending order
+    cands, cand_ids = logprobs.topk(
+        min(top_k or max_candidates, vocab), dim=1)
+    if top_p is not None:
+        probs = cands.exp()
+        # exclude candidates whose preceding mass already exceeds top_p,
+        # (the most likely symbol is always kept)
+        excluded = (probs.cumsum(1) - probs) >= top_p
+        cands = cands.masked_fill(excluded, -math.inf)
+    # gumbel-max: argmax(logits + g) with g = -log(-log(u)), u ~ U(0, 1)
+    gumbel = cands.new(*cands.size()).uniform_(1e-10, 1 - 1e-10)
+    gumbel = gumbel.log_().neg_().log_().neg_()
+    _, choice = (cands / temperature + gumbel).max(1, keepdim=True)
+    prev = cand_ids.gather(1, choice)
+    return prev.squeeze(1), logprobs.gather(1, prev).squeeze(1)
+
+
 def read_batch(m, seed_texts, temperature=1., gpu=False, **kwargs):
     """
     Computes the hidden states for a bunch of seeds in iterative fashion.
@@ -202,11 +253,13 @@ class Decoder(object):
 
     def sample(self, temperature=1., seed_texts=None, max_seq_len=25,
                batch_size=10, ignore_eos=False, bos=False, eos=False,
-               **kwargs):
+               top_k=0, top_p=None, **kwargs):
         """
         Generate a sequence multinomially sampling from the output
         distribution at each generation step. The output distribution
-        can be tweaked by the input parameter `temperature`.
+        can be tweaked by the input parameter `temperature`, and restricted
+        to the most likely symbols with `top_k` and/or `top_p` (nucleus).
+        See `sample_candidates`.
         """
         prev, hidden = self._seed(
             seed_texts, batch_size, bos, eos, temperature=temperature)
@@ -216,8 +269,10 @@ class Decoder(object):
 
         for _ in range(max_seq_len):
             outs, hidden, _ = self.model(prev, hidden=hidden, **kwargs)
-            prev = outs.div_(temperature).exp().multinomial(1).t()
-            score = u.select_cols(outs.data.cpu(), prev.squeeze().data.cpu())
+            prev, score = sample_candidates(
+                outs.data, temperature=temperature, top_k=top_k, top_p=top_p)
+            score = score.cpu()
+            prev = Variable(prev.unsqueeze(0), volatile=True)
             hyps.append(prev.squeeze().data.tolist())
 
             if self.eos is not None and not ignore_eos:
@@ -294,22 +349,43 @@ class AttentionalProjection(nn.Module):
 
     def forward(self, outs, emb):
         """
-        Runs attention for a given input sequence
+        Runs attention for a given input sequence. All steps are computed at
+        once: step t attends with hidden state at t-1 (same hid at t=0) over
+        the embeddings of the prefix up to t-1 (at least the first one), which
+        is enforced by masking the (batch x seq_len x seq_len) scores before
+        the softmax.
 
         Returns: output, weights
         --------
         output: torch.Tensor (seq_len x batch_size x hid_dim)
         weights: list of torch.Tensor(batch_size x 0:t-1) of length seq_len
         """
-        emb_att = self.attn.project_emb(emb)
-        output, weights = [], []
-        for idx, hid in enumerate(outs):
-            t = max(0, idx-1)  # use same hid at t=0
-            context, weight = self.attn(
-                outs[t], emb[:max(1, t)], emb_att=emb_att[:max(1, t)])
-            output.append(self.hid2hid(hid) + self.emb2hid(context))
-            weights.append(weight)
-        return torch.stack(output), weights
+        seq_len, batch_size, hid_dim = outs.size()
+        att_dim = self.attn.att_dim
+        # queries: hidden state at step t-1 (same hid at t=0)
+        queries = torch.cat([outs[:1], outs[:-1]], 0)
+        # (batch_size x seq_len x att_dim)
+        hid_att = self.attn.hid2att(queries.view(seq_len * batch_size, -1)) \
+                      .view(seq_len, batch_size, att_dim).transpose(0, 1)
+        emb_att = self.attn.project_emb(emb).transpose(0, 1)
+        # (batch_size x seq_len (queries) x seq_len (keys) x att_dim)
+        att = F.tanh(hid_att.unsqueeze(2) + emb_att.unsqueeze(1))
+        scores = (att.view(-1, att_dim) @ self.attn.att_v[:, None]) \
+            .view(batch_size, seq_len, seq_len)
+        # causal mask: step t only sees keys in [0, max(1, t-1))
+        steps = outs.data.new(seq_len).copy_(torch.arange(0, seq_len))
+        limit = (steps - 1).clamp_(min=1).unsqueeze(1).expand(seq_len, seq_len)
+        mask = steps.unsqueeze(0).expand(seq_len, seq_len).ge(limit)
+        scores.data.masked_fill_(
+            mask.unsqueeze(0).expand_as(scores.data), -math.inf)
+        weights = F.softmax(scores.view(-1, seq_len)) \
+                   .view(batch_size, seq_len, seq_len)
+        # (batch_size x seq_len x emb_dim) -> (seq_len x batch_size x emb_dim)
+        contexts = weights.bmm(emb.transpose(0, 1)).transpose(0, 1)
+        output = self.hid2hid(outs.view(seq_len * batch_size, hid_dim)) + \
+            self.emb2hid(contexts.contiguous().view(seq_len * batch_size, -1))
+        weights = [weights[:, t, :max(1, t - 1)] for t in range(seq_len)]
+        return output.view(seq_len, batch_size, -1), weights
 
 
 class DeepOut(nn.Module):
@@ -336,17 +412,23 @@ class DeepOut(nn.Module):
                 layer = MaxOut(in_dim, out_dim, maxouts)
             else:
                 layer = nn.Sequential(
-                    nn.Linear(in_dim, out_dim), getattr(nn, activation))
+                    nn.Linear(in_dim, out_dim), getattr(nn, activation)())
             self.add_module('deepout_%d' % idx, layer)
             self.layers.append(layer)
             in_dim = out_dim
 
     def forward(self, inp):
+        """
+        inp: torch.Tensor (... x in_dim), leading dimensions are flattened
+            so that each layer is a single GEMM
+        """
+        size = inp.size()
+        inp = inp.contiguous().view(-1, self.in_dim)
         for layer in self.layers:
             out = layer(inp)
             out = F.dropout(out, p=self.dropout, training=self.training)
             inp = out
-        return out
+        return out.view(*size[:-1], out.size(-1))
 
 
 class LM(nn.Module):
@@ -382,12 +464,43 @@ class LM(nn.Module):
     - deepout_act: str, activation function for the deepout module in camelcase
     - maxouts: int, only used if deepout_act is MaxOut (number of parts to use
         to compose the non-linearity function).
+    - softmax: str, one of 'full', 'adaptive', 'sampled'. Output layer to use
+        during training. 'adaptive' replaces the output projection by an
+        AdaptiveSoftmax over clusters given by `cutoffs` (see
+        softmax.frequency_cutoffs). 'sampled' keeps the full projection but
+        trains it with a sampled softmax over `num_sampled` classes drawn
+        from `freqs` (see softmax.unigram_freqs). Evaluation and generation
+        always use exact log-probabilities over the full vocabulary.
+    - cutoffs: list of ints, cluster cutoffs for the adaptive softmax.
+    - div_value: float, dimension reduction factor for the adaptive softmax
+        tail clusters (ignored when tying weights).
+    - num_sampled: int, number of sampled classes for the sampled softmax.
+    - freqs: None or list of floats (vocab), sampling weights for the sampled
+        softmax. Classes will be sampled uniformly if None.
+    - project_rank: None or int, factorize the output projection with a
+        bottleneck of this rank (see custom.LowRankLinear and
+        compress_projection). Only for untied full softmax projections.
+    - sparse: bool, whether the embeddings produce sparse gradients (see
+        misc.optimizer.sparse_parameters). Can't be used with tie_weights.
+    - compile: bool, whether to run the rnn compiled with TorchScript in
+        evaluation mode (see u.CompiledModule), which mostly pays off when
+        generating small batches step by step. Falls back to the eager rnn
+        if it can't be scripted.
     """
     def __init__(self, vocab, emb_dim, hid_dim, num_layers=1,
                  cell='GRU', bias=True, dropout=0.0, conds=None,
                  word_dropout=0.0, target_code=None, reserved_codes=(),
                  att_dim=None, tie_weights=False, train_init=False,
-                 deepout_layers=0, deepout_act='MaxOut', maxouts=2):
+                 deepout_layers=0, deepout_act='MaxOut', maxouts=2,
+                 softmax='full', cutoffs=None, div_value=4.,
+                 num_sampled=1024, freqs=None, sparse=False,
+                 project_rank=None, compile=False):
+
+        if sparse and tie_weights:
+            raise ValueError("Sparse embeddings can't be tied")
+        if project_rank and (tie_weights or softmax != 'full'):
+            raise ValueError("Low-rank projection requires full softmax "
+                             "and untied weights")
 
         if tie_weights and not emb_dim == hid_dim:
             logging.warn("When tying weights, output layer and embedding " +
@@ -410,6 +523,8 @@ class LM(nn.Module):
         self.maxouts = maxouts
         self.add_deepout = deepout_layers and deepout_layers > 0
         self.conds = conds
+        self.softmax = softmax
+        self.num_sampled = num_sampled
         self.hidden_state = {}  # for hidden state persistance during training
         super(LM, self).__init__()
 
@@ -417,9 +532,10 @@ class LM(nn.Module):
         self.word_dropout = word_dropout
         self.target_code = target_code
         self.reserved_codes = reserved_codes
+        self.droppable = custom.DroppableTable(vocab, reserved_codes)
 
         # Embeddings
-        self.embeddings = nn.Embedding(vocab, self.emb_dim)
+        self.embeddings = nn.Embedding(vocab, self.emb_dim, sparse=sparse)
         rnn_input_size = self.emb_dim
         if self.conds is not None:
             conds = []
@@ -442,6 +558,7 @@ class LM(nn.Module):
         self.rnn = cell(
             rnn_input_size, self.hid_dim,
             num_layers=num_layers, bias=bias, dropout=dropout)
+        self.compiled_rnn = u.CompiledModule() if compile else None
 
         # (optional) attention
         if self.add_attn:
@@ -465,7 +582,16 @@ class LM(nn.Module):
                 dropout=self.dropout)
 
         # Output projection
-        if self.tie_weights:
+        if softmax not in ('full', 'adaptive', 'sampled'):
+            raise ValueError("Unknown softmax [%s]" % softmax)
+        if softmax == 'adaptive':
+            if not cutoffs:
+                raise ValueError("Adaptive softmax requires cutoffs")
+            weight = self.embeddings.weight if self.tie_weights else None
+            self.project = AdaptiveSoftmax(
+                self.hid_dim, self.vocab, cutoffs,
+                div_value=div_value, weight=weight)
+        elif self.tie_weights:
             if self.emb_dim == self.hid_dim:
                 self.project = nn.Linear(self.hid_dim, self.vocab)
                 self.project.weight = self.embeddings.weight
@@ -474,9 +600,26 @@ class LM(nn.Module):
                 project.weight = self.embeddings.weight
                 self.project = nn.Sequential(
                     nn.Linear(self.hid_dim, self.emb_dim), project)
+        elif project_rank:
+            self.project = custom.LowRankLinear(
+                self.hid_dim, self.vocab, project_rank)
         else:
             self.project = nn.Linear(self.hid_dim, self.vocab)
 
+        if softmax == 'sampled':
+            if freqs is None:
+                freqs = [1.] * self.vocab
+            self.sampler = UnigramSampler(freqs)
+
+    def __setstate__(self, state):
+        # defaults for models pickled before these options were added
+        state.setdefault('softmax', 'full')
+        state.setdefault('compiled_rnn', None)
+        if 'droppable' not in state:
+            state['droppable'] = custom.DroppableTable(
+                state['vocab'], state['reserved_codes'])
+        super(LM, self).__setstate__(state)
+
     def parameters(self):
         for p in super(LM, self).parameters():
             if p.requires_grad is True:
@@ -489,6 +632,20 @@ class LM(nn.Module):
         for p in getattr(self, module).parameters():
             p.requires_grad = flag
 
+    def compress_projection(self, rank):
+        """
+        Replace a (trained) full output projection by its best rank `rank`
+        factorization (see custom.LowRankLinear.from_linear). The model can
+        be fine-tuned afterwards to recover part of the lost accuracy.
+        """
+        if self.softmax != 'full':
+            # sampled softmax reads the projection weight directly
+            raise ValueError("Only full softmax projections can be "
+                             "compressed, got [%s]" % self.softmax)
+        if type(self.project) is not nn.Linear:
+            raise ValueError("Only untied full projections can be compressed")
+        self.project = custom.LowRankLinear.from_linear(self.project, rank)
+
     def set_dropout(self, dropout):
         for m in self.children():
             if hasattr(m, 'dropout'):
@@ -519,7 +676,7 @@ class LM(nn.Module):
         else:
             return h_0
 
-    def forward(self, inp, hidden=None, conds=None, **kwargs):
+    def forward(self, inp, hidden=None, conds=None, project=True, **kwargs):
         """
         Parameters:
         -----------
@@ -528,6 +685,9 @@ class LM(nn.Module):
         conds: None or tuple of torch.Tensor (seq_len x batch_size) of length
             equal to the number of model conditions. `conditions` are required
             in case of a CLM.
+        project: bool, whether to project the output onto the vocabulary.
+            If False, outs will be (seq_len * batch_size x hid_dim), which
+            can be passed to `output_loss` or `logprobs` later.
 
         Returns:
         --------
@@ -540,7 +700,7 @@ class LM(nn.Module):
             raise ValueError("Conditional model expects conditions as input")
         inp = word_dropout(
             inp, self.target_code, p=self.word_dropout,
-            reserved_codes=self.reserved_codes, training=self.training)
+            droppable=self.droppable, training=self.training)
         emb = self.embeddings(inp)
         if conds is not None:
             conds = torch.cat(
@@ -550,7 +710,10 @@ class LM(nn.Module):
         if self.has_dropout and not self.cell.startswith('RHN'):
             emb = F.dropout(emb, p=self.dropout, training=self.training)
         hidden = hidden if hidden is not None else self.init_hidden_for(emb)
-        outs, hidden = self.rnn(emb, hidden)
+        rnn = self.rnn
+        if self.compiled_rnn is not None and not self.training:
+            rnn = self.compiled_rnn(self.rnn, emb)
+        outs, hidden = rnn(emb, hidden)
         if self.has_dropout:
             outs = F.dropout(outs, p=self.dropout, training=self.training)
         weights = None
@@ -560,31 +723,101 @@ class LM(nn.Module):
         outs = outs.view(seq_len * batch, hid_dim)
         if self.add_deepout:
             outs = self.deepout(outs)
-        outs = F.log_softmax(self.project(outs))
+        if project:
+            outs = self.logprobs(outs)
         return outs, hidden, weights
 
-    def loss(self, batch_data, test=False):
+    def logprobs(self, outs):
+        """
+        Compute exact log-probabilities over the vocabulary.
+
+        Parameters:
+        -----------
+        outs: torch.Tensor (batch x hid_dim), output of forward(project=False)
+
+        Returns:
+        --------
+        torch.Tensor (batch x vocab)
+        """
+        if self.softmax == 'adaptive':
+            return self.project.log_prob(outs)
+        return F.log_softmax(self.project(outs))
+
+    def output_loss(self, outs, targets, size_average=True):
+        """
+        Compute the negative log-likelihood of the targets using the output
+        layer selected by `softmax` (only during training, evaluation always
+        uses the full softmax in case of 'sampled').
+
+        Parameters:
+        -----------
+        outs: torch.Tensor (batch x hid_dim), output of forward(project=False)
+        targets: torch.LongTensor (batch)
+        """
+        if self.softmax == 'adaptive':
+            return self.project.loss(outs, targets, size_average=size_average)
+        if self.softmax == 'sampled' and self.training:
+            project = self.project
+            if isinstance(project, nn.Sequential):  # tied projection
+                outs, project = project[0](outs), project[1]
+            return sampled_softmax_loss(
+                outs, targets, project.weight, project.bias, self.sampler,
+                self.num_sampled, size_average=size_average)
+        return F.nll_loss(
+            self.logprobs(outs), targets, size_average=size_average)
+
+    def loss(self, batch_data, test=False, split=None):
+        """
+        Return batch-averaged loss and examples processed for speed monitoring
+
+        Parameters:
+        -----------
+        split: None or int, if given, the output projection and the loss
+            will be computed in shards of `split` timesteps, backpropagating
+            each shard separately, so that the memory needed by the output
+            layer is bounded by (split * batch_size x vocab) instead of
+            (seq_len * batch_size x vocab).
+        """
         # unpack data
         (source, targets), conds = batch_data, None
         if self.conds is not None:
             (source, *conds), (targets, *_) = source, targets
 
         hidden = self.hidden_state.get('hidden', None)
-        output, hidden, _ = self(source, hidden=hidden, conds=conds)
+        outs, hidden, _ = self(
+            source, hidden=hidden, conds=conds, project=False)
 
         self.hidden_state['hidden'] = u.repackage_hidden(hidden)
-        loss = F.nll_loss(output, targets.view(-1), size_average=True)
         num_examples = source.nelement()
 
-        if not test:
-            loss.backward()
-
-        return (loss.data[0], ), num_examples
+        if split is None:
+            loss = self.output_loss(outs, targets.view(-1), size_average=True)
+            if not test:
+                loss.backward()
+            return (loss.data[0], ), num_examples
+
+        seq_len, batch = targets.size()
+        hid_dim, loss = outs.size(1), 0
+        shard_data = {'out': outs.view(seq_len, batch, hid_dim),
+                      'trg': targets}
+
+        for shard in shards(shard_data, size=split, test=test):
+            #  {'out': Tensor(split x batch x hid_dim),
+            #   'trg': LongTensor(split x batch)}
+            shard_loss = self.output_loss(
+                shard['out'].view(-1, hid_dim), shard['trg'].view(-1),
+                size_average=False) / num_examples
+            if not test:
+                # accumulate gradient at the (detached) shard outputs
+                shard_loss.backward()
+            loss += shard_loss.data[0]
+
+        return (loss, ), num_examples
 
     def generate(self, d, conds=None, seed_texts=None, max_seq_len=25,
                  gpu=False, method='sample', temperature=1., width=5,
                  bos=False, eos=False, ignore_eos=False, batch_size=10,
-                 **kwargs):
+                 top_k=0, top_p=None, **kwargs):
         """
         Generate text using a specified method (argmax, sample, beam)
 
@@ -604,6 +837,12 @@ class LM(nn.Module):
             functions in Decoder for more info)
         temperature: float, temperature for multinomial sampling (only applies
             to method 'sample')
+        top_k: int, restrict sampling to the `top_k` most likely symbols at
+            each step (only applies to method 'sample')
+        top_p: None or float, restrict sampling to the nucleus of most likely
+            symbols with cumulative probability `top_p`, searched among the
+            `top_k` (or 1000) most likely symbols (only applies to method
+            'sample')
         width: int, beam size width (only applies to the 'beam' method)
         bos: bool, whether to prefix the seed with the bos_token. Only used if
             seed_texts is given and the dictionary has a bos_token.
@@ -640,7 +879,8 @@ class LM(nn.Module):
             scores, hyps = decoder.sample(
                 temperature=temperature, seed_texts=seed_texts, conds=conds,
                 batch_size=batch_size, max_seq_len=max_seq_len,
-                ignore_eos=ignore_eos, bos=bos, eos=eos, **kwargs)
+                ignore_eos=ignore_eos, bos=bos, eos=eos,
+                top_k=top_k, top_p=top_p, **kwargs)
         elif method == 'beam':
             scores, hyps = decoder.beam(
                 width=width, seed_texts=seed_texts, max_seq_len=max_seq_len,
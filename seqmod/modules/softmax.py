@@ -0,0 +1,242 @@
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.autograd import Variable
+
+
+def frequency_cutoffs(d, coverage=(0.8, 0.9, 0.95)):
+    """
+    Compute cluster cutoffs for an AdaptiveSoftmax from the symbol frequencies
+    in a fitted Dict. Dict vocabularies are sorted by frequency (after the
+    reserved symbols), so clusters correspond to contiguous index ranges.
+
+    Parameters:
+    -----------
+    d: Dict, fitted dictionary
+    coverage: iterable of floats in increasing order, proportion of the
+        corpus tokens covered by the symbols below each cutoff
+
+    Returns:
+    --------
+    list of ints, strictly increasing cutoffs in range (0, len(d))
+    """
+    counts = [d.counter.get(s, 0) for s in d.vocab]
+    total, acc, targets, cutoffs = sum(counts), 0, sorted(coverage), []
+    for idx, count in enumerate(counts):
+        acc += count
+        while targets and acc >= targets[0] * total:
+            targets.pop(0)
+            if 0 < idx + 1 < len(d) and (not cutoffs or cutoffs[-1] < idx + 1):
+                cutoffs.append(idx + 1)
+    return cutoffs
+
+
+def unigram_freqs(d, power=0.75):
+    """
+    Compute (smoothed) unigram sampling weights for a SampledSoftmax from
+    a fitted Dict, in vocabulary order.
+    """
+    return [(d.counter.get(s, 0) + 1) ** power for s in d.vocab]
+
+
+class AdaptiveSoftmax(nn.Module):
+    """
+    Adaptive softmax (https://arxiv.org/abs/1609.04309). Frequent symbols are
+    predicted directly by a head softmax, which also predicts the remaining
+    clusters. Symbols in a tail cluster are only scored for the targets that
+    fall into it, which saves most of the output layer computation during
+    training. It assumes that symbol indices are sorted by frequency
+    (see `frequency_cutoffs`).
+
+    Parameters:
+    -----------
+    in_dim: int, input dimension
+    vocab: int, vocabulary size
+    cutoffs: list of ints, upper bounds (exclusive) for the head and for all
+        but the last cluster (which extends until `vocab`).
+    div_value: float, factor to reduce the dimension of consecutive tail
+        clusters (ignored if weight is given).
+    weight: None or nn.Parameter (vocab x out_dim), shared output embedding
+        matrix (e.g. for tying input and output embeddings). Inputs will be
+        projected to `out_dim` in case it differs from `in_dim`.
+    """
+    def __init__(self, in_dim, vocab, cutoffs, div_value=4., weight=None):
+        cutoffs = list(cutoffs)
+        if not cutoffs or cutoffs != sorted(set(cutoffs)) or \
+           cutoffs[0] <= 0 or cutoffs[-1] >= vocab:
+            raise ValueError("cutoffs must be increasing and in (0, vocab)")
+        self.in_dim = in_dim
+        self.vocab = vocab
+        self.cutoffs = cutoffs + [vocab]
+        self.shortlist = cutoffs[0]
+        self.n_clusters = len(cutoffs)
+        self.tied = weight is not None
+        super(AdaptiveSoftmax, self).__init__()
+
+        if self.tied:
+            dims = [weight.size(1)] * (self.n_clusters + 1)
+            self.weight = weight
+        else:
+            dims = [in_dim] + [max(1, int(in_dim // (div_value ** (i + 1))))
+                               for i in range(self.n_clusters)]
+        self.bias = nn.Parameter(torch.zeros(vocab))
+        self.head_clusters = nn.Linear(in_dim, self.n_clusters)
+
+        self.projs = []
+        for i, dim in enumerate(dims):
+            proj = None
+            if dim != in_dim:
+                proj = nn.Linear(in_dim, dim, bias=False)
+                self.add_module('proj_{}'.format(i), proj)
+            self.projs.append(proj)
+            if not self.tied:
+                low, high = self._bounds(i)
+                weight = nn.Parameter(torch.Tensor(high - low, dim))
+                weight.data.uniform_(-0.05, 0.05)
+                self.register_parameter('weight_{}'.format(i), weight)
+
+    def _bounds(self, cluster):
+        if cluster == 0:
+            return 0, self.shortlist
+        return self.cutoffs[cluster - 1], self.cutoffs[cluster]
+
+    def _cluster_logits(self, inp, cluster):
+        low, high = self._bounds(cluster)
+        if self.projs[cluster] is not None:
+            inp = self.projs[cluster](inp)
+        if self.tied:
+            weight = self.weight[low:high]
+        else:
+            weight = getattr(self, 'weight_{}'.format(cluster))
+        return F.linear(inp, weight, self.bias[low:high])
+
+    def _head_logprobs(self, inp):
+        """
+        Returns: (batch x shortlist + n_clusters)
+        """
+        head = torch.cat(
+            [self._cluster_logits(inp, 0), self.head_clusters(inp)], 1)
+        return F.log_softmax(head)
+
+    def log_prob(self, inp):
+        """
+        Compute exact log-probabilities over the full vocabulary
+
+        Parameters:
+        -----------
+        inp: torch.Tensor (batch x in_dim)
+
+        Returns:
+        --------
+        torch.Tensor (batch x vocab)
+        """
+        head = self._head_logprobs(inp)
+        out = [head[:, :self.shortlist]]
+        for cluster in range(1, self.n_clusters + 1):
+            tail = F.log_softmax(self._cluster_logits(inp, cluster))
+            prior = head[:, self.shortlist + cluster - 1].unsqueeze(1)
+            out.append(tail + prior.expand_as(tail))
+        return torch.cat(out, 1)
+
+    def forward(self, inp):
+        return self.log_prob(inp)
+
+    def loss(self, inp, target, size_average=True):
+        """
+        Compute the negative log-likelihood of the targets, only evaluating
+        each tail cluster on the rows whose target belongs to it.
+
+        Parameters:
+        -----------
+        inp: torch.Tensor (batch x in_dim)
+        target: torch.LongTensor (batch)
+        """
+        head_target = target.data.clone()
+        loss = 0
+        for cluster in range(1, self.n_clusters + 1):
+            low, high = self._bounds(cluster)
+            mask = target.data.ge(low) * target.data.lt(high)
+            if mask.sum() == 0:
+                continue
+            head_target.masked_fill_(mask, self.shortlist + cluster - 1)
+            rows = Variable(mask.nonzero().squeeze(1))
+            tail = F.log_softmax(
+                self._cluster_logits(inp.index_select(0, rows), cluster))
+            loss += F.nll_loss(
+                tail, target.index_select(0, rows) - low, size_average=False)
+        loss += F.nll_loss(self._head_logprobs(inp), Variable(head_target),
+                           size_average=False)
+        if size_average:
+            loss = loss / target.size(0)
+        return loss
+
+
+class UnigramSampler(object):
+    """
+    Sample negative classes for a sampled softmax from a unigram distribution.
+
+    Parameters:
+    -----------
+    freqs: list or torch.Tensor (vocab), (unnormalized) sampling weights.
+    """
+    def __init__(self, freqs):
+        if not isinstance(freqs, torch.Tensor):
+            freqs = torch.Tensor(list(freqs))
+        self.probs = freqs / freqs.sum()
+        self.log_probs = self.probs.log()
+
+    def sample(self, num_sampled):
+        """
+        Returns: samples, log_expected
+        --------
+        samples: torch.LongTensor (num_sampled)
+        log_expected: torch.Tensor (num_sampled), log of the expected count
+            of each sample.
+        """
+        samples = torch.multinomial(self.probs, num_sampled, replacement=True)
+        return samples, self.log_expected(samples, num_sampled)
+
+    def log_expected(self, ids, num_sampled):
+        return self.log_probs.index_select(0, ids) + math.log(num_sampled)
+
+
+def sampled_softmax_loss(inp, target, weight, bias, sampler, num_sampled,
+                         size_average=True):
+    """
+    Sampled softmax loss (https://arxiv.org/abs/1412.2007) with logQ
+    correction and removal of accidental hits. Only the rows of the output
+    layer corresponding to the targets and the sampled classes are used.
+
+    Parameters:
+    -----------
+    inp: torch.Tensor (batch x in_dim)
+    target: torch.LongTensor (batch)
+    weight: nn.Parameter (vocab x in_dim), output layer weight
+    bias: nn.Parameter (vocab), output layer bias
+    sampler: UnigramSampler
+    num_sampled: int, number of negative classes shared across the batch
+    """
+    batch = target.size(0)
+    samples, log_q_samples = sampler.sample(num_sampled)
+    log_q_target = sampler.log_expected(target.data.cpu(), num_sampled)
+    if inp.is_cuda:
+        samples = samples.cuda()
+        log_q_samples = log_q_samples.cuda()
+        log_q_target = log_q_target.cuda()
+    ids = Variable(torch.cat([target.data, samples]))
+    w, b = weight.index_select(0, ids), bias.index_select(0, ids)
+    # (batch)
+    true_logits = (inp * w[:batch]).sum(1) + b[:batch] - Variable(log_q_target)
+    # (batch x num_sampled)
+    sampled_logits = inp @ w[batch:].t() + b[batch:].unsqueeze(0) \
+        - Variable(log_q_samples).unsqueeze(0)
+    # remove accidental hits
+    hits = target.data.unsqueeze(1).expand(batch, num_sampled) == \
+        samples.unsqueeze(0).expand(batch, num_sampled)
+    sampled_logits.data.masked_fill_(hits, -math.inf)
+    # true class is always in first position
+    logits = torch.cat([true_logits.unsqueeze(1), sampled_logits], 1)
+    zeros = Variable(target.data.new(batch).zero_())
+    return F.nll_loss(F.log_softmax(logits), zeros, size_average=size_average)
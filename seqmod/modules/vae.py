@@ -10,7 +10,9 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 
 import seqmod.utils as u
-from seqmod.modules.custom import word_dropout, StackedLSTM, StackedGRU
+from seqmod.modules.custom import word_dropout, DroppableTable
+from seqmod.modules.custom import LowRankLinear
+from seqmod.modules.custom import StackedLSTM, StackedGRU
 from seqmod.modules.encoder_decoder import Encoder
 
 
@@ -124,7 +126,11 @@ class SequenceVAE(nn.Module):
     def __init__(self, emb_dim, hid_dim, z_dim, src_dict, num_layers=1,
                  cell='LSTM', bidi=True, dropout=0.0, word_dropout=0.0,
                  project_init=False, add_z=False, tie_weights=False,
-                 inflection_point=5000):
+                 inflection_point=5000, sparse=False, project_rank=None):
+        if sparse and tie_weights:
+            raise ValueError("Sparse embeddings can't be tied")
+        if project_rank and tie_weights:
+            raise ValueError("Low-rank projection requires untied weights")
         self.hid_dim, self.num_layers = hid_dim, num_layers
         self.add_z = add_z
         self.src_dict = src_dict
@@ -144,10 +150,12 @@ class SequenceVAE(nn.Module):
         self.reserved_codes = (self.src_dict.get_bos(),
                                self.src_dict.get_eos(),
                                self.src_dict.get_pad())
+        self.droppable = DroppableTable(vocab_size, self.reserved_codes)
 
         # Embedding layer(s)
         self.embeddings = nn.Embedding(
-            vocab_size, emb_dim, padding_idx=self.src_dict.get_pad())
+            vocab_size, emb_dim, padding_idx=self.src_dict.get_pad(),
+            sparse=sparse)
 
         # Encoder
         self.encoder = EncoderVAE(
@@ -171,9 +179,18 @@ class SequenceVAE(nn.Module):
                 self.out_proj = nn.Sequential(tied_projection, projection)
             else:
                 self.out_proj = projection
+        elif project_rank:
+            self.out_proj = LowRankLinear(hid_dim, vocab_size, project_rank)
         else:
             self.out_proj = nn.Linear(hid_dim, vocab_size)
 
+    def __setstate__(self, state):
+        # models pickled before the word dropout table was added
+        if 'droppable' not in state:
+            state['droppable'] = DroppableTable(
+                len(state['src_dict']), state['reserved_codes'])
+        super(SequenceVAE, self).__setstate__(state)
+
     def is_cuda(self):
         return next(self.parameters()).is_cuda
 
@@ -194,6 +211,15 @@ class SequenceVAE(nn.Module):
         else:
             raise ValueError("Unknown weight type [%s]" % type(weight))
 
+    def compress_projection(self, rank):
+        """
+        Replace a (trained) untied output projection by its best rank `rank`
+        factorization (see custom.LowRankLinear.from_linear).
+        """
+        if type(self.out_proj) is not nn.Linear:
+            raise ValueError("Only untied projections can be compressed")
+        self.out_proj = LowRankLinear.from_linear(self.out_proj, rank)
+
     def project(self, dec_outs):
         """
         Parameters:
@@ -232,7 +258,7 @@ class SequenceVAE(nn.Module):
         # apply word dropout on the conditioning targets
         trg = word_dropout(
             trg, self.target_code, p=self.word_dropout,
-            reserved_codes=self.reserved_codes, training=self.training)
+            droppable=self.droppable, training=self.training)
         for emb_t in self.embeddings(trg).chunk(trg.size(0)):
             # rnn
             dec_out, hidden = self.decoder(emb_t.squeeze(0), hidden, z=z_cond)
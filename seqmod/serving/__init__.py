@@ -0,0 +1,2 @@
+from seqmod.serving.batcher import ContinuousBatcher, GenerationRequest
+from seqmod.serving.frontend import serve, serve_stdio, make_http_handler
@@ -0,0 +1,234 @@
+import asyncio
+import logging
+
+import torch
+from torch.autograd import Variable
+
+
+class GenerationRequest(object):
+    """
+    Single generation request waiting to be served by a ContinuousBatcher.
+
+    Parameters:
+    -----------
+
+    seed: None or list of ints, integer seed text (already transformed).
+    method: str, one of 'sample', 'argmax'.
+    temperature: float, temperature for multinomial sampling (only applies
+        to method 'sample').
+    max_seq_len: int, maximum number of symbols to be generated.
+    future: asyncio.Future that will hold the output (score, hyp).
+    """
+    def __init__(self, seed, method, temperature, max_seq_len, future):
+        if method not in ('sample', 'argmax'):
+            raise ValueError("Unknown generation method [%s]" % method)
+        if temperature <= 0:
+            raise ValueError("Temperature must be positive")
+        self.seed = seed
+        self.method = method
+        self.temperature = temperature
+        self.max_seq_len = max_seq_len
+        self.future = future
+        # generation state
+        self.score, self.hyp = 0., []
+
+
+class ContinuousBatcher(object):
+    """
+    Continuous batching generation server around a fitted LM.
+
+    Incoming requests are queued and admitted into a running batch as soon
+    as there is a free slot. Each decoding step advances all active requests
+    at once, and requests leave the batch as soon as they hit <eos> or their
+    own `max_seq_len`, freeing the slot for the next queued request. Hidden
+    state is kept per slot (rows of the batched hidden state) and each row
+    is decoded with its own method and temperature.
+
+    Parameters:
+    -----------
+
+    model: LM, fitted LM model to use for generation.
+    d: Dict, dictionary fitted on the LM's input vocabulary.
+    max_batch_size: int, maximum number of requests decoded at the same time.
+    gpu: bool, whether to run generation on the gpu.
+    """
+    def __init__(self, model, d, max_batch_size=32, gpu=False):
+        if model.training:
+            logging.warn("Generating in training modus!")
+        if model.conds is not None:
+            raise ValueError("Serving conditional models isn't supported")
+        self.model = model
+        self.d = d
+        self.max_batch_size = max_batch_size
+        self.gpu = gpu
+        self.eos = d.get_eos()
+        self.queue = asyncio.Queue()
+        # running batch state: list of requests (one per row), last
+        # generated symbols (1 x batch) and hidden state for all rows
+        self.active, self.prev, self.hidden = [], None, None
+        self.steps = 0          # number of batched decoding steps so far
+
+    # public API
+    async def generate(self, seed_text=None, method='sample',
+                       temperature=1., max_seq_len=25):
+        """
+        Queue a generation request and wait for its output.
+
+        Parameters:
+        -----------
+
+        seed_text: None or list of str, seed text to initialize the generator
+        method: str, one of 'sample', 'argmax'
+        temperature: float, (only applies to 'sample')
+        max_seq_len: int, maximum number of symbols to be generated
+
+        Returns: score, hyp
+        --------
+        score: float, length-normalized log-probability of the hypothesis
+        hyp: list of ints, generated hypothesis in integer form
+        """
+        seed = None
+        if seed_text is not None:
+            seed = [self.d.index(s) for s in seed_text]
+        future = asyncio.get_event_loop().create_future()
+        request = GenerationRequest(
+            seed, method, temperature, max_seq_len, future)
+        await self.queue.put(request)
+        return await future
+
+    async def run(self):
+        """
+        Serve requests forever. It should be scheduled as a task in the event
+        loop together with the front end producing the requests. If a
+        decoding step fails, the error is passed on to all requests in the
+        running batch and the server keeps serving the queue.
+        """
+        while True:
+            if not self.active:  # idle: wait for the next request
+                self._admit(await self.queue.get())
+            while len(self.active) < self.max_batch_size and \
+                    not self.queue.empty():
+                self._admit(self.queue.get_nowait())
+            try:
+                self.step()
+            except Exception as e:
+                self._fail(e)
+            # give the front end the chance to queue up new requests
+            await asyncio.sleep(0)
+
+    # batch handling
+    def _wrap(self, data):
+        data = Variable(data, volatile=True)
+        if self.gpu:
+            data = data.cuda()
+        return data
+
+    def _seed(self, request):
+        """
+        Compute the first input symbol and the initial hidden state
+        (num_layers x 1 x hid_dim) for a new request.
+        """
+        if request.seed:
+            seed, prev = request.seed[:-1], request.seed[-1]
+        elif self.eos is not None:
+            seed, prev = [], self.eos
+        else:
+            seed, prev = [], int(torch.rand(1)[0] * self.model.vocab)
+        prev = self._wrap(torch.LongTensor([[prev]]))
+        if seed:
+            inp = self._wrap(torch.LongTensor(seed).unsqueeze(1))
+            _, hidden, _ = self.model(inp)
+        else:
+            hidden = self.model.init_hidden_for(self.model.embeddings(prev))
+        return prev, hidden
+
+    def _cat_hidden(self, hidden, new):
+        if hidden is None:
+            return new
+        if self.model.cell.startswith('LSTM'):
+            return (torch.cat([hidden[0], new[0]], 1),
+                    torch.cat([hidden[1], new[1]], 1))
+        return torch.cat([hidden, new], 1)
+
+    def _select_hidden(self, hidden, index):
+        if self.model.cell.startswith('LSTM'):
+            return (hidden[0].index_select(1, index),
+                    hidden[1].index_select(1, index))
+        return hidden.index_select(1, index)
+
+    def _admit(self, request):
+        if request.future.cancelled():
+            return
+        try:
+            prev, hidden = self._seed(request)
+        except Exception as e:  # e.g. OOV seed without <unk>
+            request.future.set_exception(e)
+            return
+        self.active.append(request)
+        if self.prev is not None:
+            prev = torch.cat([self.prev, prev], 1)
+        self.prev = prev
+        self.hidden = self._cat_hidden(self.hidden, hidden)
+
+    def _release(self, finished):
+        """
+        Resolve finished requests and compact the batch to the active rows.
+        """
+        keep = []
+        for idx, request in enumerate(self.active):
+            if idx in finished:
+                if not request.future.cancelled():
+                    score = request.score / max(1, len(request.hyp))
+                    request.future.set_result((score, request.hyp))
+            else:
+                keep.append(idx)
+        if not keep:
+            self.active, self.prev, self.hidden = [], None, None
+            return
+        index = self.prev.data.new(keep)
+        self.active = [self.active[idx] for idx in keep]
+        self.prev = self.prev.index_select(1, self._wrap(index))
+        self.hidden = self._select_hidden(self.hidden, self._wrap(index))
+
+    def _fail(self, error):
+        """
+        Resolve all active requests with `error` and reset the batch.
+        """
+        logging.exception("Decoding step failed")
+        for request in self.active:
+            if not request.future.done():
+                request.future.set_exception(error)
+        self.active, self.prev, self.hidden = [], None, None
+
+    def step(self):
+        """
+        Run a single decoding step over all active requests.
+        """
+        self.steps += 1
+        # (batch x vocab)
+        outs, self.hidden, _ = self.model(self.prev, hidden=self.hidden)
+        logprobs = outs.data
+        # argmax rows
+        _, argmax = logprobs.max(1)
+        # sample rows with per-row temperature (batch x 1)
+        temps = logprobs.new([r.temperature for r in self.active]).unsqueeze(1)
+        tempered = logprobs.div(temps.expand_as(logprobs))
+        # shift by the row max so that low temperatures don't underflow
+        tempered = tempered - tempered.max(1, keepdim=True)[0] \
+                                      .expand_as(tempered)
+        sampled = tempered.exp_().multinomial(1).squeeze(1)
+        is_sample = logprobs.new(
+            [r.method == 'sample' for r in self.active]).long()
+        prev = is_sample * sampled + (1 - is_sample) * argmax.view(-1)
+        scores = logprobs.gather(1, prev.unsqueeze(1)).squeeze(1).cpu()
+
+        finished = set()
+        for idx, (request, sym) in enumerate(zip(self.active, prev.tolist())):
+            request.hyp.append(sym)
+            request.score += scores[idx]
+            if sym == self.eos or len(request.hyp) >= request.max_seq_len:
+                finished.add(idx)
+
+        self.prev = self._wrap(prev.unsqueeze(0))
+        if finished:
+            self._release(finished)
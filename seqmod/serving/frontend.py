@@ -0,0 +1,116 @@
+import sys
+import json
+import asyncio
+
+
+def _parse_request(payload):
+    """
+    Turn a json request into keyword arguments for ContinuousBatcher.generate
+
+    {"seed": "optional seed text", "method": "sample", "temperature": 1.0,
+     "max_seq_len": 25}
+    """
+    seed = payload.get('seed')
+    if isinstance(seed, str):
+        seed = seed.split()
+    return {'seed_text': seed,
+            'method': payload.get('method', 'sample'),
+            'temperature': float(payload.get('temperature', 1.)),
+            'max_seq_len': int(payload.get('max_seq_len', 25))}
+
+
+async def _handle(batcher, payload):
+    try:
+        score, hyp = await batcher.generate(**_parse_request(payload))
+    except Exception as e:
+        return {'id': payload.get('id'), 'error': str(e)}
+    return {'id': payload.get('id'), 'score': score,
+            'text': ' '.join(batcher.d.vocab[i] for i in hyp)}
+
+
+async def serve_stdio(batcher, inp=sys.stdin, out=sys.stdout):
+    """
+    Read json requests (one per line) from `inp` and write json responses
+    (one per line) to `out` as soon as they are ready. Responses might come
+    in different order than requests, use the "id" field to match them.
+    """
+    loop = asyncio.get_event_loop()
+    pending = set()
+
+    async def respond(payload):
+        out.write(json.dumps(await _handle(batcher, payload)) + '\n')
+        out.flush()
+
+    while True:
+        line = await loop.run_in_executor(None, inp.readline)
+        if not line:            # EOF
+            break
+        line = line.strip()
+        if not line:
+            continue
+        pending.add(asyncio.ensure_future(respond(json.loads(line))))
+        pending = {task for task in pending if not task.done()}
+
+    if pending:
+        await asyncio.wait(pending)
+
+
+def make_http_handler(batcher):
+    """
+    Minimal HTTP/1.1 front end accepting POST requests with a json body
+    (see _parse_request) on any path. One request per connection.
+    """
+    async def handler(reader, writer):
+        status, response = '200 OK', None
+        try:
+            headers = {}
+            request_line = await reader.readline()
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, _, value = line.decode().partition(':')
+                headers[key.strip().lower()] = value.strip()
+            if not request_line.startswith(b'POST'):
+                status, response = '405 Method Not Allowed', {'error': 'POST'}
+            else:
+                length = int(headers.get('content-length', 0))
+                body = await reader.readexactly(length)
+                payload = json.loads(body.decode())
+                response = await _handle(batcher, payload)
+                if 'error' in response:
+                    status = '400 Bad Request'
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            status, response = '400 Bad Request', {'error': str(e)}
+        body = json.dumps(response).encode()
+        writer.write(('HTTP/1.1 {}\r\n'
+                      'Content-Type: application/json\r\n'
+                      'Content-Length: {}\r\n'
+                      'Connection: close\r\n\r\n').format(
+                          status, len(body)).encode() + body)
+        await writer.drain()
+        writer.close()
+
+    return handler
+
+
+def serve(batcher, mode='stdio', host='localhost', port=8080):
+    """
+    Run the batcher together with a front end until interrupted (http) or
+    until the input is exhausted (stdio).
+    """
+    loop = asyncio.get_event_loop()
+    server = asyncio.ensure_future(batcher.run())
+    try:
+        if mode == 'stdio':
+            loop.run_until_complete(serve_stdio(batcher))
+        elif mode == 'http':
+            loop.run_until_complete(asyncio.start_server(
+                make_http_handler(batcher), host, port))
+            loop.run_forever()
+        else:
+            raise ValueError("Unknown serving mode [%s]" % mode)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.cancel()
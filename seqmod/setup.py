@@ -8,8 +8,9 @@ setup(
     version='0.2',
     package_dir={'seqmod.modules': 'modules',
                  'seqmod.misc': 'misc',
+                 'seqmod.serving': 'serving',
                  'seqmod': './'},
-    packages=['seqmod', 'seqmod.modules', 'seqmod.misc'],
+    packages=['seqmod', 'seqmod.modules', 'seqmod.misc', 'seqmod.serving'],
     description='Pytorch implementations of sequence modellers for language',
     author='Enrique Manjavacas',
     author_email='enrique.manjavacas@gmail.com',
@@ -0,0 +1,252 @@
+"""
+Translate a corpus with a trained EncoderDecoder, one sentence per line.
+
+    python -m seqmod.translate model.pt --input src.txt --output out.txt \
+        --beam_width 5 --batch_size 64 --workers 4
+
+Input is streamed in windows of sentences, which are sorted by length and
+split into batches to minimize padding. Output lines are written in the
+original order as soon as a window is done. With several workers, windows
+are translated in parallel by a pool of processes, each holding a copy of
+the model.
+"""
+
+import sys
+import time
+import itertools
+import multiprocessing as mp
+
+import torch
+from torch.autograd import Variable
+
+from seqmod.misc.dataset import pad_pack_batch
+from seqmod.misc.shortlist import Shortlist
+from seqmod import utils as u
+
+
+def load_translation_model(path):
+    """
+    Load a model saved with u.save_model or u.save_checkpoint
+    """
+    model = u.load_model(path)
+    if isinstance(model, dict):
+        model = model['model']
+    model.eval()
+    return model
+
+
+class Translator(object):
+    """
+    Batched translation of sentence windows with a trained EncoderDecoder.
+
+    Parameters:
+    -----------
+    model: EncoderDecoder
+    batch_size: int, number of sentences per decoding batch
+    beam_width: int, beam search is used if larger than 1, greedy otherwise
+    max_decode_len: int, decode at most max_decode_len times source length
+    level: str, one of ('word', 'char'), tokenization level of the input
+    gpu: bool
+    shortlist: None or str, path to a Shortlist to restrict the softmax
+    """
+    def __init__(self, model, batch_size=64, beam_width=1, max_decode_len=2,
+                 level='word', gpu=False, shortlist=None):
+        if level not in ('word', 'char'):
+            raise ValueError('level must be "word" or "char"')
+        self.model = model
+        self.batch_size = batch_size
+        self.beam_width = beam_width
+        self.max_decode_len = max_decode_len
+        self.level = level
+        self.gpu = gpu
+        self.src_dict, self.trg_dict = model.src_dict, model.trg_dict
+        self.eos = self.trg_dict.get_eos()
+        self.pad = self.trg_dict.get_pad()
+        self.shortlist = None
+        if shortlist is not None:
+            self.shortlist = Shortlist.from_disk(shortlist)
+
+    def tokenize(self, line):
+        line = line.strip()
+        return line.split() if self.level == 'word' else list(line)
+
+    def detokenize(self, tokens):
+        return (' ' if self.level == 'word' else '').join(tokens)
+
+    def _strip(self, hyp):
+        out = []
+        for c in hyp:
+            if c == self.eos:
+                break
+            if c != self.pad:
+                out.append(self.trg_dict.vocab[c])
+        return out
+
+    def translate_batch(self, examples):
+        """
+        Parameters:
+        -----------
+        examples: list of lists of ints, transformed source sentences
+
+        Returns: list of lists of output tokens, in input order
+        """
+        src = pad_pack_batch(examples, self.src_dict.get_pad())
+        src = Variable(src, volatile=True)
+        if self.gpu:
+            src = src.cuda()
+        if self.beam_width > 1:
+            _, hyps = self.model.translate_beam_batch(
+                src, max_decode_len=self.max_decode_len,
+                beam_width=self.beam_width, shortlist=self.shortlist)
+            hyps = [beam_hyps[0] for beam_hyps in hyps]  # keep best
+        else:
+            _, hyps, _ = self.model.translate(
+                src, max_decode_len=self.max_decode_len, return_atts=False,
+                shortlist=self.shortlist)
+        return [self._strip(hyp) for hyp in hyps]
+
+    def translate_window(self, lines):
+        """
+        Translate a window of input lines, batching sentences of similar
+        length together.
+
+        Returns: list of (translation, num_src_tokens, num_trg_tokens)
+        --------
+            in the same order as the input lines
+        """
+        sents = [self.tokenize(line) for line in lines]
+        examples = list(self.src_dict.transform(sents))
+        order = sorted(range(len(examples)), key=lambda i: len(examples[i]),
+                       reverse=True)
+        out = [None] * len(examples)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            hyps = self.translate_batch([examples[i] for i in batch])
+            for idx, hyp in zip(batch, hyps):
+                out[idx] = self.detokenize(hyp), len(sents[idx]), len(hyp)
+        return out
+
+
+def windows(inp, size):
+    """
+    Split a stream of lines into lists of at most `size` lines
+    """
+    inp = iter(inp)
+    while True:
+        window = list(itertools.islice(inp, size))
+        if not window:
+            return
+        yield window
+
+
+# Worker process state
+_translator = None
+
+
+def _init_worker(path, threads, kwargs):
+    global _translator
+    torch.set_num_threads(threads)
+    _translator = Translator(load_translation_model(path), **kwargs)
+
+
+def _translate_window(window):
+    return _translator.translate_window(window)
+
+
+def translate_stream(path, inp, out, window_size=5000, workers=1,
+                     report=sys.stderr, **kwargs):
+    """
+    Translate all lines in `inp` writing them to `out` in the same order.
+
+    Parameters:
+    -----------
+    path: str, path to a saved EncoderDecoder
+    inp: iterable of lines
+    out: file-like object
+    window_size: int, number of sentences that are sorted by length together
+    workers: int, number of processes translating windows in parallel
+    kwargs: passed to Translator
+
+    Returns: dict with sentences, src_tokens, trg_tokens and seconds
+    """
+    if kwargs.get('gpu') and workers > 1:
+        raise ValueError("Multiple workers are only supported on CPU")
+
+    threads = max(1, mp.cpu_count() // workers)
+    pool = None
+    if workers > 1:
+        pool = mp.Pool(workers, _init_worker, (path, threads, kwargs))
+        results = pool.imap(_translate_window, windows(inp, window_size))
+    else:
+        _init_worker(path, torch.get_num_threads(), kwargs)
+        if kwargs.get('gpu'):
+            _translator.model.cuda()
+        results = map(_translate_window, windows(inp, window_size))
+
+    start = time.time()
+    stats = {'sentences': 0, 'src_tokens': 0, 'trg_tokens': 0}
+    try:
+        for result in results:
+            for translation, src_tokens, trg_tokens in result:
+                out.write(translation + '\n')
+                stats['sentences'] += 1
+                stats['src_tokens'] += src_tokens
+                stats['trg_tokens'] += trg_tokens
+            out.flush()
+            if report is not None:
+                report_stats(stats, time.time() - start, report)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    stats['seconds'] = time.time() - start
+    return stats
+
+
+def report_stats(stats, seconds, report):
+    seconds = max(seconds, 1e-6)
+    report.write(
+        '{sentences} sentences; {:.2f} sents/sec; {:.2f} src tokens/sec; '
+        '{:.2f} trg tokens/sec\n'.format(
+            stats['sentences'] / seconds, stats['src_tokens'] / seconds,
+            stats['trg_tokens'] / seconds, **stats))
+    report.flush()
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Translate a file with a trained EncoderDecoder')
+    parser.add_argument('model', help='model saved by u.save_model or '
+                        'checkpoint saved by u.save_checkpoint')
+    parser.add_argument('--input', help='input file (defaults to stdin)')
+    parser.add_argument('--output', help='output file (defaults to stdout)')
+    parser.add_argument('--level', default='word', help='word or char')
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--beam_width', default=1, type=int)
+    parser.add_argument('--max_decode_len', default=2, type=int)
+    parser.add_argument('--window_size', default=5000, type=int)
+    parser.add_argument('--workers', default=1, type=int)
+    parser.add_argument('--shortlist', help='shortlist built with '
+                        'scripts/build_shortlist.py')
+    parser.add_argument('--gpu', action='store_true')
+    args = parser.parse_args()
+
+    inp = open(args.input) if args.input else sys.stdin
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        translate_stream(
+            args.model, inp, out, window_size=args.window_size,
+            workers=args.workers, batch_size=args.batch_size,
+            beam_width=args.beam_width, max_decode_len=args.max_decode_len,
+            level=args.level, gpu=args.gpu, shortlist=args.shortlist)
+    finally:
+        if args.input:
+            inp.close()
+        if args.output:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 
 import os
 import math
+import logging
 import random; random.seed(1001)
 from collections import OrderedDict
 
@@ -91,6 +92,49 @@ def merge_states(state_dict1, state_dict2, merge_map):
     return state_dict
 
 
+def detach_vars(data):
+    """Split variables from the tree to allow for memory efficient computation
+    of softmax losses over a whole sequence."""
+    for k, v in data.items():
+        if v.requires_grad:
+            v = Variable(v.data, requires_grad=True, volatile=False)
+        yield k, v
+
+
+def _split_shards(data, size):
+    splits = ((key, torch.split(v, size)) for key, v in data.items())
+    keys, splits = zip(*splits)
+    for split in zip(*splits):
+        yield dict(zip(keys, split))
+
+
+def shards(data, size=25, test=False):
+    """
+    Generator over variables that will be involved in a costly loss computation
+    such as the softmax. It yields dictionaries of the same form as the input,
+    where the variables have been splitted in smaller shards and detach from
+    the graph. It expects the consumer to back propagate through them in shards
+    of given a size. After all shards are consumed, the generator will take
+    care of backprop further from the input using the accumulated gradients.
+    In test mode, shards are yielded without detaching or backprop, so that
+    evaluation memory is bounded in the same way.
+    """
+    # Inspired by www.github.com/OpenNMT/OpenNMT-py/blob/master/onmt/Loss.py
+    if test:
+        yield from _split_shards(data, size)
+        return
+
+    detached = dict(detach_vars(data))
+    yield from _split_shards(detached, size)  # go and accumulate some loss
+
+    inputs, grads = [], []
+    for key, var in detached.items():
+        if var.grad is not None:
+            inputs.append(data[key]), grads.append(var.grad.data)
+
+    torch.autograd.backward(inputs, grads, retain_graph=True)
+
+
 def repackage_bidi(h_or_c):
     """
     In a bidirectional RNN output is (output, (h_n, c_n))
@@ -279,6 +323,135 @@ def initialize_model(model, overwrite_custom=True, **init_ops):
                 m.custom_init()
 
 
+def _untie_linear_weights(model):
+    """
+    Give nn.Linear layers that share their weight with an nn.Embedding
+    (tied output projections) their own copy of it.
+    """
+    embeddings = {id(m.weight) for m in model.modules()
+                  if isinstance(m, torch.nn.Embedding)}
+    for m in model.modules():
+        if isinstance(m, torch.nn.Linear) and id(m.weight) in embeddings:
+            m.weight = torch.nn.Parameter(m.weight.data.clone())
+
+
+def _fake_quantize(t, bits=8):
+    """
+    Round a 2D weight to `bits` integer levels per row (symmetric)
+    """
+    qmax = 2 ** (bits - 1) - 1
+    scale = t.abs().max(1, keepdim=True)[0].clamp(min=1e-8) / qmax
+    return (t / scale).round().clamp(-qmax, qmax) * scale
+
+
+def _quantizable_modules(model, layers):
+    """
+    Names of modules of type `layers` in the model, skipping the children
+    of modules that read their weights directly (`quantize_linears = False`)
+    """
+    names, skip = [], []
+    for name, m in model.named_modules():
+        if any(name.startswith(prefix) for prefix in skip):
+            continue
+        if getattr(m, 'quantize_linears', True) is False:
+            skip.append(name + '.')
+        elif type(m) in layers:  # not subclasses (e.g. NormalizedGRUCell)
+            names.append(name)
+    return names
+
+
+def quantize_for_inference(model):
+    """
+    Return a copy of the model for CPU inference with int8 weights in all
+    nn.Linear (including output projections), nn.LSTM, nn.GRU, nn.LSTMCell
+    and nn.GRUCell layers. Activations are quantized dynamically. Output
+    projections tied to the embeddings get their own quantized copy of the
+    weight, so the input embeddings stay in full precision. Layers inside
+    modules that use their weights directly (e.g. the fused RHN gates) are
+    left in full precision.
+
+    If the installed torch doesn't provide `torch.quantization`, weights are
+    rounded to int8 levels in float storage instead. This gives the same
+    accuracy trade-off without the speed-up.
+
+    Parameters:
+    -----------
+    model: LM, EncoderDecoder or SequenceVAE (the model itself is left
+        untouched)
+
+    Returns: quantized copy of the model on the cpu in evaluation mode
+    """
+    import copy
+    model = copy.deepcopy(model).cpu()
+    model.eval()
+    _untie_linear_weights(model)
+
+    layers = (torch.nn.Linear, torch.nn.LSTM, torch.nn.GRU,
+              torch.nn.LSTMCell, torch.nn.GRUCell)
+    names = _quantizable_modules(model, layers)
+    quantization = getattr(torch, 'quantization', None)
+    if hasattr(quantization, 'quantize_dynamic'):
+        qconfig = quantization.default_dynamic_qconfig
+        return quantization.quantize_dynamic(
+            model, {name: qconfig for name in names}, dtype=torch.qint8)
+
+    logging.warn("Dynamic quantization isn't available, "
+                 "rounding weights to int8 levels without speed-up")
+    modules = dict(model.named_modules())
+    for name in names:
+        for p_name, p in modules[name].named_parameters():
+            if not is_bias(p_name):
+                p.data.copy_(_fake_quantize(p.data))
+    return model
+
+
+def compile_module(module):
+    """
+    Compile a module with TorchScript to cut the Python overhead of modules
+    that are called once per step (e.g. decoder cells during batch=1
+    decoding). The compiled module shares its parameters with `module`.
+    Falls back to the module itself if the installed torch has no
+    `torch.jit.script` or the module can't be scripted (e.g. RHN cells).
+    """
+    script = getattr(getattr(torch, 'jit', None), 'script', None)
+    if script is None:
+        logging.warn("TorchScript isn't available, using eager %s" %
+                     type(module).__name__)
+        return module
+    try:
+        return script(module)
+    except Exception as e:
+        logging.warn("Couldn't script %s, using eager module (%s)" %
+                     (type(module).__name__, e))
+        return module
+
+
+class CompiledModule(object):
+    """
+    Lazily compiled version of a module (see compile_module), cached on the
+    device of the last input it was requested for. Models keep it as a
+    plain attribute next to the eager module, so that it stays out of their
+    state_dict and pickles. Meant for inference: the module is compiled
+    in the mode it is in when first requested.
+    """
+    def __init__(self):
+        self.compiled, self.device = None, None
+
+    def __call__(self, module, inp):
+        """
+        module: nn.Module, eager module to compile
+        inp: torch.Tensor, input the compiled module will be used for
+        """
+        device = inp.get_device() if inp.is_cuda else -1
+        if self.compiled is None or self.device != device:
+            self.compiled, self.device = compile_module(module), device
+        return self.compiled
+
+    def __getstate__(self):
+        # script modules can't be pickled
+        return dict(self.__dict__, compiled=None, device=None)
+
+
 def has_trainable_parameters(module):
     """
     Determines whether a given module has any trainable parameters at all
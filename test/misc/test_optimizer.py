@@ -0,0 +1,56 @@
+
+import unittest
+
+import torch
+import torch.nn as nn
+from torch.autograd import Variable
+
+from seqmod.misc.optimizer import Optimizer, clip_grad_norm
+from seqmod.misc.optimizer import sparse_parameters
+
+
+class Model(nn.Module):
+    def __init__(self, sparse):
+        super(Model, self).__init__()
+        self.embeddings = nn.Embedding(10, 4, sparse=sparse)
+        self.linear = nn.Linear(4, 1)
+
+    def forward(self, inp):
+        return self.linear(self.embeddings(inp)).sum()
+
+
+class TestSparseOptimizer(unittest.TestCase):
+    def setUp(self):
+        self.dense, self.sparse = Model(False), Model(True)
+        self.sparse.load_state_dict(self.dense.state_dict())
+        # repeated indices produce duplicate entries in sparse gradients
+        inp = Variable(torch.LongTensor([[1, 2, 2], [3, 1, 1]]))
+        for model in (self.dense, self.sparse):
+            model(inp).backward()
+
+    def test_sparse_parameters(self):
+        self.assertEqual(sparse_parameters(self.dense), [])
+        self.assertEqual(sparse_parameters(self.sparse),
+                         [self.sparse.embeddings.weight])
+
+    def test_clip_grad_norm(self):
+        dense_norm = clip_grad_norm(self.dense.parameters(), 0.1)
+        sparse_norm = clip_grad_norm(self.sparse.parameters(), 0.1)
+        self.assertAlmostEqual(dense_norm, sparse_norm, places=4)
+        dense_grad = self.dense.embeddings.weight.grad.data
+        sparse_grad = self.sparse.embeddings.weight.grad.data.to_dense()
+        self.assertTrue(((dense_grad - sparse_grad).abs() < 1e-5).all())
+
+    def test_groups(self):
+        optimizer = Optimizer(
+            self.sparse.parameters(), 'Adam', lr=0.01,
+            sparse_params=sparse_parameters(self.sparse))
+        self.assertEqual(optimizer.sparse_params,
+                         [self.sparse.embeddings.weight])
+        self.assertEqual(len(optimizer.params), 2)
+        before = self.sparse.embeddings.weight.data.clone()
+        optimizer.step()
+        after = self.sparse.embeddings.weight.data
+        # only rows in the batch are updated
+        changed = (before - after).abs().sum(1).gt(0).nonzero().view(-1)
+        self.assertEqual(sorted(changed.tolist()), [1, 2, 3])
@@ -0,0 +1,42 @@
+
+import unittest
+
+import torch
+
+from seqmod.misc.dataset import Dict
+from seqmod.misc.shortlist import Shortlist
+from seqmod import utils as u
+
+
+src = [s.split() for s in ["el gato negro", "el perro negro", "un gato",
+                           "un perro blanco", "el gato blanco"]]
+trg = [s.split() for s in ["the black cat", "the black dog", "a cat",
+                           "a white dog", "the white cat"]]
+
+
+class TestShortlist(unittest.TestCase):
+    def setUp(self):
+        self.src_dict = Dict(pad_token=u.PAD, eos_token=u.EOS,
+                             bos_token=u.BOS).fit(src)
+        self.trg_dict = Dict(pad_token=u.PAD, eos_token=u.EOS,
+                             bos_token=u.BOS).fit(trg)
+        self.shortlist = Shortlist.fit(
+            src, trg, self.src_dict, self.trg_dict, top_n=1,
+            num_candidates=1, min_count=2)
+
+    def test_candidates(self):
+        gato = self.src_dict.index('gato')
+        self.assertEqual(self.shortlist.candidates[gato],
+                         [self.trg_dict.index('cat')])
+
+    def test_ids_for(self):
+        batch = torch.LongTensor([[self.src_dict.index('perro')],
+                                  [self.src_dict.index('blanco')]])
+        ids = self.shortlist.ids_for(batch).tolist()
+        self.assertEqual(ids, sorted(set(ids)))
+        # reserved symbols are always included
+        for s in self.trg_dict.reserved:
+            self.assertIn(self.trg_dict.index(s), ids)
+        self.assertIn(self.trg_dict.index('dog'), ids)
+        self.assertIn(self.trg_dict.index('white'), ids)
+        self.assertNotIn(self.trg_dict.index('cat'), ids)
@@ -0,0 +1 @@
+from test.modules import *
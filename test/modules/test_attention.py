@@ -0,0 +1,62 @@
+import unittest
+
+import torch
+from torch.autograd import Variable
+
+from seqmod.modules import attention
+
+
+class TestSequenceAttention(unittest.TestCase):
+    """
+    Attending for all decoder steps at once must match step-wise attention
+    """
+    def setUp(self):
+        self.trg_len, self.seq_len, self.batch, self.dim = 5, 7, 3, 6
+        self.dec_outs = Variable(
+            torch.randn(self.trg_len, self.batch, self.dim))
+        self.enc_outs = Variable(
+            torch.randn(self.seq_len, self.batch, self.dim))
+        # pad the last two source positions of the first example
+        self.mask = torch.zeros(self.batch, self.seq_len).byte()
+        self.mask[0, -2:] = 1
+
+    def check_parity(self, module, **kwargs):
+        outs, weights = module(
+            self.dec_outs, self.enc_outs, mask=self.mask, **kwargs)
+        for t, dec_out in enumerate(self.dec_outs):
+            out, weight = module(
+                dec_out, self.enc_outs, mask=self.mask, **kwargs)
+            self.assertTrue(((outs[t] - out).abs().data < 1e-5).all())
+            self.assertTrue(((weights[t] - weight).abs().data < 1e-5).all())
+        # no attention on padding
+        self.assertTrue((weights.data[:, 0, -2:] == 0).all())
+
+    def test_global(self):
+        self.check_parity(attention.GlobalAttention(self.dim))
+
+    def test_bahdanau(self):
+        self.check_parity(attention.BahdanauAttention(4, self.dim))
+
+    def test_local(self):
+        module = attention.LocalAttention(self.dim, window=2)
+        self.check_parity(module, full_weights=True)
+        outs, weights = module(
+            self.dec_outs, self.enc_outs, mask=self.mask, full_weights=True)
+        # at most 2 * window + 1 attended positions per step
+        self.assertTrue((weights.data.gt(0).sum(2) <= 5).all())
+        # by default, window weights are returned with their positions
+        window_outs, (window, pos) = module(
+            self.dec_outs, self.enc_outs, mask=self.mask)
+        self.assertEqual(window.size(), (self.trg_len, self.batch, 5))
+        self.assertTrue(((outs - window_outs).abs().data < 1e-5).all())
+        scattered = module.scatter_weights(window, pos, self.seq_len)
+        self.assertTrue(((weights - scattered).abs().data < 1e-5).all())
+
+    def test_local_non_contiguous(self):
+        # time-major indexing of the encoder outputs
+        module = attention.LocalAttention(self.dim, window=2)
+        enc_outs = Variable(torch.randn(self.batch, self.seq_len, self.dim))
+        outs, _ = module(self.dec_outs, enc_outs.transpose(0, 1))
+        expected, _ = module(
+            self.dec_outs, enc_outs.transpose(0, 1).contiguous())
+        self.assertTrue(((outs - expected).abs().data < 1e-5).all())
@@ -0,0 +1,251 @@
+import unittest
+
+import torch
+from torch.autograd import Variable
+
+from seqmod.modules import custom
+
+
+class TestRHNFused(unittest.TestCase):
+    """
+    Fused RHN variants must reproduce the output of the modules they
+    were converted from (without dropout so that masks don't interfere)
+    """
+    seq_len, batch, in_dim, hid_dim, depth = 6, 4, 5, 7, 3
+
+    def check_parity(self, rhn, fused_cls, **kwargs):
+        fused = fused_cls.from_rhn(rhn, **kwargs)
+        inp = Variable(torch.randn(self.seq_len, self.batch, self.in_dim))
+        hidden = Variable(torch.randn(1, self.batch, self.hid_dim))
+        outs, h_t = rhn(inp, hidden)
+        fused_outs, fused_h_t = fused(inp, hidden)
+        self.assertEqual(outs.size(), fused_outs.size())
+        self.assertTrue(((outs - fused_outs).abs().data < 1e-5).all())
+        self.assertTrue(((h_t - fused_h_t).abs().data < 1e-5).all())
+
+    def make(self, cls, tied_noise):
+        return cls(self.in_dim, self.hid_dim, num_layers=self.depth,
+                   tied_noise=tied_noise, input_dropout=0.0,
+                   hidden_dropout=0.0)
+
+    def test_rhn(self):
+        for tied_noise in (True, False):
+            for precompute_inputs in (True, False):
+                self.check_parity(
+                    self.make(custom.RHN, tied_noise), custom.RHNFused,
+                    precompute_inputs=precompute_inputs)
+
+    def test_rhn_coupled(self):
+        for tied_noise in (True, False):
+            for precompute_inputs in (True, False):
+                self.check_parity(
+                    self.make(custom.RHNCoupled, tied_noise),
+                    custom.RHNCoupledFused,
+                    precompute_inputs=precompute_inputs)
+
+
+class TestElementwiseRNN(unittest.TestCase):
+    seq_len, batch, in_dim, hid_dim = 6, 4, 5, 7
+
+    def test_recurrence(self):
+        f = Variable(torch.rand(self.seq_len, self.batch, self.hid_dim))
+        z = Variable(torch.randn(self.seq_len, self.batch, self.hid_dim))
+        c_t = Variable(torch.randn(self.batch, self.hid_dim))
+        c = custom.QRNN.recurrence(f, z, c_t)
+        for t in range(self.seq_len):
+            c_t = f[t] * c_t + (1 - f[t]) * z[t]
+            self.assertTrue(((c[t] - c_t).abs().data < 1e-5).all())
+
+    def check_shapes(self, cls):
+        inp = Variable(torch.randn(self.seq_len, self.batch, self.in_dim))
+        for bidi in (False, True):
+            num_dirs = 2 if bidi else 1
+            rnn = cls(self.in_dim, self.hid_dim, num_layers=2,
+                      bidirectional=bidi)
+            outs, hidden = rnn(inp)
+            self.assertEqual(
+                outs.size(),
+                (self.seq_len, self.batch, self.hid_dim * num_dirs))
+            self.assertEqual(
+                hidden.size(), (2 * num_dirs, self.batch, self.hid_dim))
+            # hidden can be fed back
+            rnn(inp, hidden)
+
+    def check_padding(self, cls):
+        # a padded example matches the same example run alone
+        inp = Variable(torch.randn(self.seq_len, self.batch, self.in_dim))
+        lengths = torch.LongTensor([self.seq_len, 3, 1, 5])
+        rnn = cls(self.in_dim, self.hid_dim, num_layers=2,
+                  bidirectional=True)
+        outs, hidden = rnn(inp, lengths=lengths)
+        for b, length in enumerate(lengths.tolist()):
+            alone, alone_hidden = rnn(inp[:length, b:b+1])
+            self.assertTrue(
+                ((outs[:length, b:b+1] - alone).abs().data < 1e-5).all())
+            self.assertTrue((outs[length:, b].data == 0).all())
+            self.assertTrue(
+                ((hidden[:, b:b+1] - alone_hidden).abs().data < 1e-5).all())
+
+    def test_qrnn(self):
+        self.check_shapes(custom.QRNN)
+        self.check_padding(custom.QRNN)
+
+    def test_sru(self):
+        self.check_shapes(custom.SRU)
+        self.check_padding(custom.SRU)
+
+
+def reference_normalized_gru_cell(cell, x, h):
+    """
+    Gate-by-gate computation of the layer-normalized GRU step with per
+    example statistics (not the misaligned statistics of the original
+    cell, see NormalizedGRUCell)
+    """
+    def norm(x, g, b, scale):
+        out = x - x.mean(1, keepdim=True).expand_as(x)
+        if scale:
+            out = out / (x.std(1, keepdim=True).expand_as(x) + cell.eps)
+        return g.expand_as(x) * out + b.expand_as(x)
+
+    H = cell.hidden_size
+    gates = []
+    for weight, g, b, inp, scale in [
+            (cell.weight_ih, cell.gamma_ih, cell.bias_ih, x, True),
+            (cell.weight_hh, cell.gamma_hh, cell.bias_hh, h, False)]:
+        for start, size in [(0, 2 * H), (2 * H, H)]:
+            gates.append(norm(
+                torch.mm(inp, weight.narrow(0, start, size).t()),
+                g.narrow(0, start, size), b.narrow(0, start, size), scale))
+    ih_rz, ih_n, hh_rz, hh_n = gates
+    rz = torch.sigmoid(ih_rz + hh_rz)
+    r, z = rz.narrow(1, 0, H), rz.narrow(1, H, H)
+    n = torch.tanh(ih_n + r * hh_n)
+    return (1 - z) * n + z * h
+
+
+@unittest.skipUnless(hasattr(torch, 'jit'), "TorchScript isn't available")
+class TestScriptedStacked(unittest.TestCase):
+    def test_parity(self):
+        # stacked cells script (with and without dropout) in eval mode
+        for stacked in (custom.StackedLSTM, custom.StackedGRU):
+            for dropout in (0.0, 0.3):
+                module = stacked(2, 4, 6, dropout=dropout).eval()
+                scripted = torch.jit.script(module)
+                inp = Variable(torch.randn(3, 4))
+                hidden = Variable(torch.randn(2, 3, 6))
+                if stacked is custom.StackedLSTM:
+                    hidden = (hidden, hidden * 0.5)
+                out, _ = module(inp, hidden)
+                scripted_out, _ = scripted(inp, hidden)
+                self.assertTrue(((out - scripted_out).abs() < 1e-5).all())
+
+
+class TestNormalizedGRU(unittest.TestCase):
+    seq_len, batch, in_dim, hid_dim, num_layers = 6, 4, 5, 7, 2
+
+    def setUp(self):
+        self.rnn = custom.NormalizedGRU(
+            self.in_dim, self.hid_dim, self.num_layers)
+        for p in self.rnn.parameters():
+            p.data.uniform_(-0.5, 0.5)
+        self.inp = Variable(
+            torch.randn(self.seq_len, self.batch, self.in_dim))
+        self.h_0 = Variable(
+            torch.randn(self.num_layers, self.batch, self.hid_dim))
+
+    def test_cell(self):
+        cell = self.rnn.layers[0]
+        h = self.h_0[0]
+        out, expected = cell(self.inp[0], h), \
+            reference_normalized_gru_cell(cell, self.inp[0], h)
+        self.assertTrue(((out - expected).abs().data < 1e-5).all())
+
+    def test_batch_independence(self):
+        # unlike the original cell, an example's output doesn't depend on
+        # the rest of the batch
+        cell = self.rnn.layers[0]
+        out = cell(self.inp[0], self.h_0[0])
+        for b in range(self.batch):
+            alone = cell(self.inp[0][b:b+1], self.h_0[0][b:b+1])
+            self.assertTrue(((out[b:b+1] - alone).abs().data < 1e-5).all())
+
+    def test_sequence(self):
+        outs, h_n = self.rnn(self.inp, self.h_0)
+        # time-major, step by step through the stacked cells
+        h_t, expected = self.h_0, []
+        for x_t in self.inp:
+            out, h_t = custom.StackedNormalizedGRU.forward(
+                self.rnn, x_t, h_t)
+            expected.append(out)
+        expected = torch.stack(expected)
+        self.assertEqual(outs.size(), expected.size())
+        self.assertTrue(((outs - expected).abs().data < 1e-5).all())
+        self.assertTrue(((h_n - h_t).abs().data < 1e-5).all())
+
+
+class TestWordDropout(unittest.TestCase):
+    def setUp(self):
+        self.vocab, self.reserved, self.unk = 10, (0, 2), 1
+        self.inp = Variable(torch.LongTensor(20, 5).random_(self.vocab))
+
+    def test_droppable_table(self):
+        table = custom.droppable_table(self.vocab, self.reserved + (None,))
+        self.assertEqual(table.tolist(), [0, 1, 0] + [1] * (self.vocab - 3))
+
+    def test_reserved(self):
+        droppable = custom.droppable_table(self.vocab, self.reserved)
+        for kwargs in ({'droppable': droppable},
+                       {'reserved_codes': self.reserved}):
+            out = custom.word_dropout(
+                self.inp, self.unk, p=1.0, **kwargs).data
+            reserved = (self.inp.data == 0) | (self.inp.data == 2)
+            # all symbols but the reserved ones are dropped
+            self.assertTrue((out[reserved] == self.inp.data[reserved]).all())
+            self.assertTrue((out[reserved == 0] == self.unk).all())
+
+    def test_droppable_cache(self):
+        droppable = custom.DroppableTable(self.vocab, self.reserved)
+        table = droppable(self.inp.data)
+        self.assertIs(droppable(self.inp.data), table)    # built once
+        self.assertEqual(table.tolist(), [0, 1, 0] + [1] * (self.vocab - 3))
+        # non-contiguous input
+        out = custom.word_dropout(
+            self.inp.t(), self.unk, p=1.0, droppable=droppable).data
+        reserved = (self.inp.data.t() == 0) | (self.inp.data.t() == 2)
+        self.assertTrue((out[reserved == 0] == self.unk).all())
+
+    def test_eval(self):
+        out = custom.word_dropout(
+            self.inp, self.unk, p=1.0, training=False,
+            reserved_codes=self.reserved)
+        self.assertTrue((out.data == self.inp.data).all())
+
+
+class TestMaxOut(unittest.TestCase):
+    def test_nd(self):
+        maxout = custom.MaxOut(5, 3, 2)
+        inp = Variable(torch.randn(4, 6, 5))
+        out = maxout(inp)
+        self.assertEqual(out.size(), (4, 6, 3))
+        for t, inp_t in enumerate(inp):
+            self.assertTrue(((out[t] - maxout(inp_t)).abs().data
+                             < 1e-5).all())
+
+
+class TestLowRankLinear(unittest.TestCase):
+    def test_from_linear(self):
+        in_dim, out_dim, rank = 6, 8, 3
+        linear = torch.nn.Linear(in_dim, out_dim)
+        # make the weight exactly rank 3
+        linear.weight.data.copy_(
+            torch.randn(out_dim, rank) @ torch.randn(rank, in_dim))
+        low_rank = custom.LowRankLinear.from_linear(linear, rank)
+        self.assertEqual(low_rank.down.weight.size(), (rank, in_dim))
+        self.assertEqual(low_rank.up.weight.size(), (out_dim, rank))
+        inp = Variable(torch.randn(4, in_dim))
+        self.assertTrue(((linear(inp) - low_rank(inp)).abs().data
+                         < 1e-4).all())
+
+    def test_rank(self):
+        with self.assertRaises(ValueError):
+            custom.LowRankLinear.from_linear(torch.nn.Linear(4, 6), 4)
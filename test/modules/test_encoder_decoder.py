@@ -0,0 +1,364 @@
+import pickle
+import unittest
+
+import torch
+from torch.autograd import Variable
+
+from seqmod.modules.encoder_decoder import \
+    pair_batches, Encoder, ConvEncoder, EncoderDecoder
+from seqmod.modules.custom import StackedLSTM, StackedGRU
+from seqmod.misc.dataset import Dict
+from seqmod.misc.shortlist import Shortlist
+from seqmod import utils as u
+
+
+def make_model(num_layers=1, **kwargs):
+    """
+    Small untrained EncoderDecoder in evaluation mode
+    """
+    words = ['w%d' % i for i in range(20)]
+    d = Dict(pad_token=u.PAD, eos_token=u.EOS, bos_token=u.BOS).fit([words])
+    torch.manual_seed(1001)
+    model = EncoderDecoder(num_layers, 6, 8, 8, d, **kwargs)
+    u.initialize_model(model)
+    model.eval()
+    return model
+
+
+def make_batch(model, sents):
+    """
+    Transform and pad a list of sentences into a (seq_len x batch) source
+    """
+    src = list(model.src_dict.transform(sents))
+    pad, max_len = model.src_dict.get_pad(), max(len(s) for s in src)
+    src = [s + [pad] * (max_len - len(s)) for s in src]
+    return Variable(torch.LongTensor(src).t().contiguous(), volatile=True)
+
+
+class TestPairBatches(unittest.TestCase):
+    def setUp(self):
+        self.pairs = [([1, 2, 3], [1, 5, 6, 2]),
+                      ([1, 4], [1, 7, 2]),
+                      ([1, 2, 3], [1, 8, 2]),
+                      ([1, 2, 3], [1, 9, 9, 9, 9, 2])]
+
+    def test_coverage(self):
+        idxs = [idx for _, _, batch_idxs in pair_batches(self.pairs, 12)
+                for idx in batch_idxs]
+        self.assertEqual(sorted(idxs), list(range(len(self.pairs))))
+
+    def test_shared_sources(self):
+        for sources, rows, idxs in pair_batches(self.pairs, 100):
+            # each source is only encoded once
+            self.assertEqual(len(sources), len(set(map(tuple, sources))))
+            for row, idx in zip(rows, idxs):
+                self.assertEqual(sources[row], self.pairs[idx][0])
+
+    def test_budget(self):
+        for sources, rows, idxs in pair_batches(self.pairs, 12):
+            max_len = max(len(self.pairs[idx][1]) for idx in idxs)
+            self.assertTrue(len(idxs) == 1 or max_len * len(idxs) <= 12)
+
+
+class TestEncoder(unittest.TestCase):
+    def test_custom_cell_padding(self):
+        # bidirectional custom cells skip padding like packed nn.RNN cells
+        inp = Variable(torch.randn(7, 3, 4))
+        lengths = torch.LongTensor([7, 4, 2])
+        for cell in ('QRNN', 'SRU'):
+            encoder = Encoder(4, 6, 2, cell, bidi=True)
+            outs, hidden = encoder(inp, lengths=lengths)
+            alone, alone_hidden = encoder(inp[:4, 1:2])
+            self.assertTrue(((outs[:4, 1:2] - alone).abs().data < 1e-5).all())
+            self.assertTrue(
+                ((hidden[:, 1:2] - alone_hidden).abs().data < 1e-5).all())
+
+
+class TestConvEncoder(unittest.TestCase):
+    seq_len, batch, emb_dim, hid_dim, num_layers = 7, 3, 4, 6, 2
+
+    def setUp(self):
+        self.encoder = ConvEncoder(
+            self.emb_dim, self.hid_dim, self.num_layers, 'LSTM')
+        self.encoder.eval()
+        self.inp = Variable(
+            torch.randn(self.seq_len, self.batch, self.emb_dim))
+
+    def test_shapes(self):
+        outs, (h_t, c_t) = self.encoder(self.inp)
+        self.assertEqual(outs.size(),
+                         (self.seq_len, self.batch, self.hid_dim))
+        for hidden in (h_t, c_t):
+            self.assertEqual(hidden.size(),
+                             (self.num_layers, self.batch, self.hid_dim))
+
+    def test_padding(self):
+        # outputs of a padded example match those of the example alone
+        length = 4
+        lengths = torch.LongTensor([self.seq_len, length, self.seq_len])
+        outs, (h_t, _) = self.encoder(self.inp, lengths=lengths)
+        alone, (alone_h_t, _) = self.encoder(self.inp[:length, 1:2])
+        self.assertTrue(
+            ((outs[:length, 1:2] - alone).abs().data < 1e-5).all())
+        self.assertTrue((outs[length:, 1].data == 0).all())
+        self.assertTrue(((h_t[:, 1:2] - alone_h_t).abs().data < 1e-5).all())
+
+    def test_max_len(self):
+        model = make_model(encoder='conv', max_src_len=self.seq_len - 1)
+        self.assertEqual(model.encoder.positions.num_embeddings,
+                         self.seq_len - 1)
+        inp = Variable(torch.randn(self.seq_len, self.batch, 6))  # emb_dim
+        with self.assertRaises(ValueError):
+            model.encoder(inp)
+
+
+class TestBeamBatch(unittest.TestCase):
+    sents = [['w1', 'w2', 'w3', 'w4'], ['w5', 'w6'], ['w7', 'w8', 'w9']]
+
+    def test_matches_translate_beam(self):
+        # batched (padded) beam search matches each source decoded alone
+        for att_type in ('Global', 'Bahdanau'):
+            model = make_model(att_type=att_type)
+            scores, hyps = model.translate_beam_batch(
+                make_batch(model, self.sents), beam_width=3)
+            for idx, sent in enumerate(self.sents):
+                score, hyp, _ = model.translate_beam(
+                    make_batch(model, [sent]), beam_width=3)
+                self.assertEqual(hyps[idx], hyp)
+                self.assertTrue(((scores[idx] - score).abs() < 1e-5).all())
+
+
+class TestShortlistBeam(unittest.TestCase):
+    sents = [['w1', 'w2', 'w3', 'w4'], ['w5', 'w6'], ['w7', 'w8', 'w9']]
+
+    def test_matches_masked_vocabulary(self):
+        model = make_model()
+        src = make_batch(model, self.sents)
+        shortlist = Shortlist(model.trg_dict, top_n=8)
+        scores, hyps = model.translate_beam_batch(
+            src, beam_width=3, shortlist=shortlist)
+        # same search as the full softmax with the rest of the vocabulary
+        # masked out through the output bias
+        ids = set(shortlist.ids_for(src.data).tolist())
+        excluded = [i for i in range(len(model.trg_dict)) if i not in ids]
+        model.project[0].bias.data.index_fill_(
+            0, torch.LongTensor(excluded), -1e4)
+        expected_scores, expected_hyps = model.translate_beam_batch(
+            src, beam_width=3)
+        self.assertEqual(hyps, expected_hyps)
+        for score, expected in zip(scores, expected_scores):
+            self.assertTrue(((score - expected).abs() < 1e-4).all())
+        for hyp in hyps:
+            self.assertTrue(all(int(i) in ids for h in hyp for i in h))
+
+
+class TestPacking(unittest.TestCase):
+    sents = [['w1', 'w2', 'w3', 'w4'], ['w5', 'w6']]
+
+    def assertMatchesAlone(self, model, idx, check_hidden=True):
+        src = make_batch(model, self.sents)
+        enc_outs, enc_hidden, _, _ = model.encode(src)
+        alone_outs, alone_hidden, _, _ = model.encode(
+            make_batch(model, [self.sents[idx]]))
+        length = alone_outs.size(0)
+        diff = enc_outs[:length, idx:idx+1] - alone_outs
+        self.assertTrue((diff.abs().data < 1e-5).all())
+        if check_hidden:
+            for h, alone_h in zip(enc_hidden, alone_hidden):
+                diff = h[:, idx:idx+1] - alone_h
+                self.assertTrue((diff.abs().data < 1e-5).all())
+
+    def test_packed(self):
+        # padding is skipped in both directions (outputs & last hidden)
+        for cell in ('LSTM', 'GRU'):
+            model = make_model(cell=cell)
+            self.assertMatchesAlone(model, 1)
+            src = make_batch(model, self.sents)
+            enc_outs, _, _, _ = model.encode(src)
+            self.assertTrue((enc_outs[-2:, 1].data == 0).all())
+
+    def test_unpacked(self):
+        # without lengths, forward outputs before the padding still match
+        model = make_model(bidi=False)
+        lengths, mask = model.source_mask(make_batch(model, self.sents))
+        self.assertEqual(lengths.tolist(), [6, 4])
+        model.source_mask = lambda src: (None, mask)
+        self.assertMatchesAlone(model, 1, check_hidden=False)
+
+    def test_empty_source(self):
+        # an all-padding column is encoded as a single padding token
+        model = make_model()
+        src = make_batch(model, self.sents)
+        src.data[:, 1] = model.src_dict.get_pad()
+        lengths, mask = model.source_mask(src)
+        self.assertEqual(lengths.tolist(), [6, 1])
+        self.assertEqual(mask[1].tolist(), [0, 1, 1, 1, 1, 1])
+        scores, hyps, _ = model.translate(src)
+        self.assertEqual(len(hyps), 2)
+        self.assertFalse((scores != scores).any())  # no nan
+
+
+class TestStackedDecoderCheckpoint(unittest.TestCase):
+    def test_load_old_state_dict(self):
+        # checkpoints with a StackedLSTM/StackedGRU decoder rnn still load
+        for cell, stacked in (('LSTM', StackedLSTM), ('GRU', StackedGRU)):
+            model = make_model(num_layers=2, cell=cell, add_prev=False)
+            old = stacked(2, 6, 8)
+            state_dict = {k: v for k, v in model.state_dict().items()
+                          if not k.startswith('decoder.rnn_step.')}
+            for k, v in old.state_dict().items():
+                state_dict['decoder.rnn_step.' + k] = v
+            model.load_state_dict(state_dict)   # strict
+            # both rnns compute the same step
+            inp = Variable(torch.randn(3, 6), volatile=True)
+            hidden = Variable(torch.randn(2, 3, 8), volatile=True)
+            if cell == 'LSTM':
+                hidden = (hidden, hidden * 0.5)
+            out, _ = old(inp, hidden)
+            fused_out, _ = model.decoder.rnn_step(inp.unsqueeze(0), hidden)
+            diff = out - fused_out.squeeze(0)
+            self.assertTrue((diff.abs().data < 1e-5).all())
+
+    def test_unpickle_old_model(self):
+        # models pickled with a StackedLSTM/StackedGRU decoder rnn still run
+        for cell, stacked in (('LSTM', StackedLSTM), ('GRU', StackedGRU)):
+            model = make_model(num_layers=2, cell=cell, add_prev=False)
+            model.decoder.rnn_step = stacked(2, 6, 8)
+            u.initialize_model(model)
+            model = pickle.loads(pickle.dumps(model))
+            self.assertFalse(model.decoder.fused)
+            src = make_batch(model, [['w1', 'w2', 'w3'], ['w4', 'w5']])
+            scores, hyps, _ = model.translate(src)
+            self.assertEqual(len(hyps), 2)
+            model.train()
+            batch = Variable(src.data), Variable(src.data.clone())
+            (loss, ), _ = model.loss(batch)
+            self.assertEqual(loss, loss)  # no nan
+
+
+class TestCompile(unittest.TestCase):
+    sents = [['w1', 'w2', 'w3', 'w4'], ['w5', 'w6'], ['w7', 'w8', 'w9']]
+
+    def test_parity(self):
+        # fused (nn.LSTM/GRU) and stacked (input feeding) decoder rnns
+        for cell in ('LSTM', 'GRU'):
+            for add_prev in (False, True):
+                kwargs = {'num_layers': 2, 'cell': cell, 'add_prev': add_prev}
+                model = make_model(**kwargs)
+                compiled = make_model(compile=True, **kwargs)
+                compiled.load_state_dict(model.state_dict())
+                src = make_batch(model, self.sents)
+                scores, hyps, _ = model.translate(src)
+                compiled_scores, compiled_hyps, _ = compiled.translate(src)
+                self.assertEqual(hyps, compiled_hyps)
+                diff = (scores - compiled_scores).abs()
+                self.assertTrue((diff < 1e-5).all())
+                # the compiled rnn isn't pickled
+                compiled = pickle.loads(pickle.dumps(compiled))
+                self.assertEqual(compiled.translate(src)[1], hyps)
+
+
+class TestPickle(unittest.TestCase):
+    def test_droppable(self):
+        # models pickled before the word dropout table was added
+        model = make_model(word_dropout=0.5)
+        del model.droppable
+        model = pickle.loads(pickle.dumps(model))
+        self.assertEqual(model.droppable.reserved_codes, model.reserved_codes)
+        model.train()
+        src = make_batch(model, [['w1', 'w2', 'w3'], ['w4', 'w5']])
+        batch = Variable(src.data), Variable(src.data.clone())
+        (loss, ), _ = model.loss(batch)
+        self.assertEqual(loss, loss)  # no nan
+
+
+class TestGreedyTranslate(unittest.TestCase):
+    sents = [['w1', 'w2', 'w3'], ['w4', 'w5', 'w6'], ['w7', 'w8', 'w9']]
+
+    def test_contract(self):
+        model = make_model()
+        eos, pad = model.trg_dict.get_eos(), model.trg_dict.get_pad()
+        # make <eos> likely so that rows finish at different steps
+        model.project[0].bias.data[eos] += 2
+        scores, hyps, atts = model.translate(make_batch(model, self.sents))
+        self.assertEqual(len(atts), len(self.sents))
+        for idx, sent in enumerate(self.sents):
+            hyp = hyps[idx]
+            if eos in hyp:
+                # padded after <eos>
+                stop = hyp.index(eos) + 1
+                self.assertEqual(hyp[stop:], [pad] * (len(hyp) - stop))
+                hyp = hyp[:stop]
+            # scores stop at <eos>: same as the source decoded alone
+            score, alone, _ = model.translate(make_batch(model, [sent]))
+            self.assertEqual(hyp, alone[0])
+            self.assertAlmostEqual(scores[idx], score[0], places=4)
+
+
+class TestEncoderCache(unittest.TestCase):
+    sents = [['w1', 'w2', 'w3', 'w4'], ['w5', 'w6'], ['w7', 'w8', 'w9']]
+
+    def setUp(self):
+        self.model = make_model(att_type='Bahdanau')
+        self.encoded = []       # number of sentences encoded per call
+        encode = self.model._encode
+
+        def counting_encode(src):
+            self.encoded.append(src.size(1))
+            return encode(src)
+
+        self.model._encode = counting_encode
+
+    def run_entry_points(self):
+        model, sents = self.model, self.sents
+        greedy = model.translate(make_batch(model, sents))
+        # same sentences in a different batch (and with different padding)
+        beam = model.translate_beam_batch(
+            make_batch(model, sents[1:] + sents[:1]), beam_width=2)
+        src = list(model.src_dict.transform(sents))
+        pairs = [(s, s) for s in src]
+        scores = model.score_pairs(pairs)
+        return greedy, beam, scores
+
+    def test_hits(self):
+        expected = self.run_entry_points()
+        self.assertEqual(self.encoded, [3, 3, 3])
+
+        self.model.enable_encoder_cache()
+        self.encoded = []
+        greedy, beam, scores = self.run_entry_points()
+        # only the first pass encodes
+        self.assertEqual(self.encoded, [3])
+        self.assertEqual(greedy[1], expected[0][1])
+        self.assertTrue(((greedy[0] - expected[0][0]).abs() < 1e-5).all())
+        self.assertEqual(beam[1], expected[1][1])
+        for score, expected_score in zip(scores[0], expected[2][0]):
+            self.assertAlmostEqual(score, expected_score, places=4)
+
+        # a new sentence is encoded alone
+        self.encoded = []
+        self.model.translate(make_batch(self.model, self.sents + [['w10']]))
+        self.assertEqual(self.encoded, [1])
+
+    def test_cleared_on_load_state_dict(self):
+        self.model.enable_encoder_cache()
+        src = make_batch(self.model, self.sents)
+        self.model.translate(src)
+        # hot-swap the weights: the sources are encoded again
+        other = make_model(att_type='Bahdanau')
+        other.encoder.rnn.weight_ih_l0.data.normal_()
+        self.model.load_state_dict(other.state_dict())
+        self.encoded = []
+        scores, hyps, _ = self.model.translate(src)
+        self.assertEqual(self.encoded, [3])
+        expected_scores, expected_hyps, _ = other.translate(src)
+        self.assertEqual(hyps, expected_hyps)
+        self.assertTrue(((scores - expected_scores).abs() < 1e-5).all())
+
+    def test_no_cache_outside_entry_points(self):
+        self.model.enable_encoder_cache()
+        src = make_batch(self.model, self.sents)
+        self.model.encode(src)
+        self.model.encode(src)
+        self.assertEqual(self.encoded, [3, 3])
+        self.assertEqual(len(self.model.encoder_cache), 0)
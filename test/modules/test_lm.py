@@ -0,0 +1,193 @@
+import pickle
+import unittest
+
+import torch
+from torch.autograd import Variable
+import torch.nn.functional as F
+
+from seqmod.modules import lm
+
+
+def attentional_projection_loop(module, outs, emb):
+    """
+    Reference per-step implementation of AttentionalProjection.forward
+    """
+    attn, output = module.attn, []
+    for idx, hid in enumerate(outs):
+        t = max(0, idx - 1)
+        prefix = emb[:max(1, t)]
+        prefix_att = attn.project_emb(prefix)
+        att = F.tanh(prefix_att + attn.hid2att(outs[t])[None, :, :])
+        weights = F.softmax(
+            (att.transpose(0, 1) @ attn.att_v[:, None]).squeeze(2))
+        context = weights.unsqueeze(1).bmm(prefix.transpose(0, 1)).squeeze(1)
+        output.append(module.hid2hid(hid) + module.emb2hid(context))
+    return torch.stack(output)
+
+
+class TestAttentionalProjection(unittest.TestCase):
+    def test_parity(self):
+        seq_len, batch, att_dim, hid_dim, emb_dim = 7, 3, 5, 6, 4
+        module = lm.AttentionalProjection(att_dim, hid_dim, emb_dim)
+        outs = Variable(torch.randn(seq_len, batch, hid_dim))
+        emb = Variable(torch.randn(seq_len, batch, emb_dim))
+        output, weights = module(outs, emb)
+        expected = attentional_projection_loop(module, outs, emb)
+        self.assertEqual(output.size(), expected.size())
+        self.assertTrue(((output - expected).abs().data < 1e-5).all())
+        self.assertEqual([w.size(1) for w in weights],
+                         [max(1, t - 1) for t in range(seq_len)])
+
+
+class TestDeepOut(unittest.TestCase):
+    def test_nd(self):
+        for activation in ('MaxOut', 'ReLU'):
+            deepout = lm.DeepOut(5, (4, 3), activation)
+            inp = Variable(torch.randn(4, 6, 5))
+            out = deepout(inp)
+            self.assertEqual(out.size(), (4, 6, 3))
+            for t, inp_t in enumerate(inp):
+                self.assertTrue(((out[t] - deepout(inp_t)).abs().data
+                                 < 1e-5).all())
+
+
+class TestSampleCandidates(unittest.TestCase):
+    def setUp(self):
+        probs = torch.FloatTensor([[0.5, 0.25, 0.15, 0.1]])
+        self.logprobs = probs.log().repeat(20000, 1)
+
+    def frequencies(self, prev):
+        counts = torch.zeros(self.logprobs.size(1))
+        for sym in prev.tolist():
+            counts[sym] += 1
+        return counts / len(prev)
+
+    def test_scores(self):
+        # returned scores are the untempered log-probabilities of the samples
+        for kwargs in ({}, {'top_k': 2}, {'top_p': 0.6},
+                       {'top_k': 3, 'top_p': 0.9}):
+            prev, scores = lm.sample_candidates(
+                self.logprobs, temperature=0.5, **kwargs)
+            expected = self.logprobs.gather(1, prev.unsqueeze(1)).squeeze(1)
+            self.assertTrue(((scores - expected).abs() < 1e-6).all())
+
+    def test_top_k(self):
+        prev, _ = lm.sample_candidates(self.logprobs, top_k=2)
+        self.assertTrue((prev < 2).all())
+        freqs = self.frequencies(prev)
+        # renormalized over the top 2: 2/3, 1/3
+        self.assertAlmostEqual(freqs[0], 2 / 3, delta=0.02)
+
+    def test_top_p(self):
+        # the nucleus for 0.6 is {0, 1}: 0.5 alone doesn't reach 0.6
+        prev, _ = lm.sample_candidates(self.logprobs, top_p=0.6)
+        self.assertEqual(set(prev.tolist()), {0, 1})
+        # top_p bounded by max_candidates
+        prev, _ = lm.sample_candidates(
+            self.logprobs, top_p=0.99, max_candidates=3)
+        self.assertEqual(set(prev.tolist()), {0, 1, 2})
+
+    def test_gumbel(self):
+        # without truncation the gumbel draw follows the distribution
+        prev, _ = lm.sample_candidates(self.logprobs, top_k=4)
+        freqs = self.frequencies(prev)
+        expected = self.logprobs[0].exp()
+        self.assertTrue(((freqs - expected).abs() < 0.02).all())
+
+
+class TestStateDict(unittest.TestCase):
+    def test_no_droppable_key(self):
+        # the word dropout table isn't saved (old checkpoints load strictly)
+        model = lm.LM(10, 4, 6, word_dropout=0.2, reserved_codes=(0,))
+        state_dict = model.state_dict()
+        self.assertNotIn('droppable', state_dict)
+        lm.LM(10, 4, 6, word_dropout=0.2).load_state_dict(state_dict)
+
+
+class TestPickle(unittest.TestCase):
+    def old_model(self, *attrs, **kwargs):
+        # unpickle a model saved before `attrs` were added
+        model = lm.LM(10, 4, 6, **kwargs)
+        for attr in attrs:
+            delattr(model, attr)
+        return pickle.loads(pickle.dumps(model))
+
+    def test_softmax(self):
+        model = self.old_model('softmax')
+        self.assertEqual(model.softmax, 'full')
+        model.eval()
+        inp = Variable(torch.LongTensor(3, 2).random_(10), volatile=True)
+        outs, _, _ = model(inp)
+        self.assertEqual(outs.size(), (6, 10))
+
+    def test_droppable(self):
+        model = self.old_model(
+            'droppable', word_dropout=0.5, target_code=1, reserved_codes=(0,))
+        self.assertEqual(model.droppable.reserved_codes, (0,))
+        inp = Variable(torch.LongTensor(3, 2).random_(10))
+        outs, _, _ = model(inp)
+        self.assertEqual(outs.size(), (6, 10))
+
+
+class TestCompile(unittest.TestCase):
+    def test_parity(self):
+        for cell in ('LSTM', 'GRU'):
+            model = lm.LM(10, 4, 6, num_layers=2, cell=cell)
+            compiled = lm.LM(10, 4, 6, num_layers=2, cell=cell, compile=True)
+            compiled.load_state_dict(model.state_dict())
+            model.eval(), compiled.eval()
+            inp = Variable(torch.LongTensor(5, 3).random_(10), volatile=True)
+            outs, _, _ = model(inp)
+            compiled_outs, _, _ = compiled(inp)
+            self.assertTrue(((outs - compiled_outs).abs().data < 1e-5).all())
+            # the compiled rnn stays out of the state_dict and pickles
+            self.assertEqual(set(compiled.state_dict()),
+                             set(model.state_dict()))
+            compiled = pickle.loads(pickle.dumps(compiled))
+            compiled_outs, _, _ = compiled(inp)
+            self.assertTrue(((outs - compiled_outs).abs().data < 1e-5).all())
+
+
+class TestCompressProjection(unittest.TestCase):
+    def test_compress(self):
+        model = lm.LM(10, 4, 6)
+        model.compress_projection(2)
+        self.assertEqual(model.project.down.weight.size(), (2, 6))
+        for kwargs in ({'softmax': 'sampled', 'num_sampled': 5},
+                       {'softmax': 'adaptive', 'cutoffs': [5]},
+                       {'tie_weights': True, 'emb_dim': 6}):
+            model = lm.LM(10, kwargs.pop('emb_dim', 4), 6, **kwargs)
+            with self.assertRaises(ValueError):
+                model.compress_projection(2)
+
+
+class TestShardedLoss(unittest.TestCase):
+    def setUp(self):
+        seq_len, batch, vocab = 7, 3, 10
+        self.model = lm.LM(vocab, 4, 6, num_layers=1, cell='LSTM')
+        source = torch.LongTensor(seq_len, batch).random_(vocab)
+        targets = torch.LongTensor(seq_len, batch).random_(vocab)
+        self.batch = Variable(source), Variable(targets)
+
+    def run_loss(self, split, test=False):
+        self.model.zero_grad()
+        self.model.hidden_state = {}
+        (loss, ), _ = self.model.loss(self.batch, test=test, split=split)
+        grads = [p.grad.data.clone() for p in self.model.parameters()
+                 if p.grad is not None]
+        return loss, grads
+
+    def test_parity(self):
+        loss, grads = self.run_loss(None)
+        sharded_loss, sharded_grads = self.run_loss(2)
+        self.assertAlmostEqual(loss, sharded_loss, places=5)
+        self.assertEqual(len(grads), len(sharded_grads))
+        for grad, sharded_grad in zip(grads, sharded_grads):
+            self.assertTrue(((grad - sharded_grad).abs() < 1e-5).all())
+
+    def test_parity_test_mode(self):
+        self.model.eval()
+        loss, _ = self.run_loss(None, test=True)
+        sharded_loss, grads = self.run_loss(2, test=True)
+        self.assertAlmostEqual(loss, sharded_loss, places=5)
+        self.assertEqual(grads, [])
@@ -0,0 +1,53 @@
+import unittest
+
+import torch
+from torch.autograd import Variable
+import torch.nn.functional as F
+
+from seqmod.modules import softmax
+
+
+class TestAdaptiveSoftmax(unittest.TestCase):
+    def setUp(self):
+        self.in_dim, self.vocab, self.batch = 10, 50, 16
+        self.cutoffs = [5, 20, 35]
+        self.inp = Variable(torch.randn(self.batch, self.in_dim))
+        self.target = Variable(
+            (torch.rand(self.batch) * self.vocab).long())
+
+    def _check(self, asm):
+        logprobs = asm.log_prob(self.inp)
+        self.assertEqual(logprobs.size(), (self.batch, self.vocab))
+        # normalized distribution over the full vocabulary
+        total = logprobs.exp().sum(1).data
+        self.assertTrue(((total - 1).abs() < 1e-5).all())
+        # clustered loss equals full softmax loss
+        full = F.nll_loss(logprobs, self.target, size_average=True)
+        loss = asm.loss(self.inp, self.target, size_average=True)
+        self.assertAlmostEqual(full.data[0], loss.data[0], places=4)
+
+    def test_untied(self):
+        self._check(softmax.AdaptiveSoftmax(
+            self.in_dim, self.vocab, self.cutoffs))
+
+    def test_tied(self):
+        weight = torch.nn.Parameter(torch.randn(self.vocab, 8))
+        asm = softmax.AdaptiveSoftmax(
+            self.in_dim, self.vocab, self.cutoffs, weight=weight)
+        self.assertIs(asm.weight, weight)
+        self._check(asm)
+
+
+class TestSampledSoftmax(unittest.TestCase):
+    def test_loss(self):
+        in_dim, vocab, batch = 10, 50, 16
+        weight = Variable(torch.randn(vocab, in_dim), requires_grad=True)
+        bias = Variable(torch.zeros(vocab), requires_grad=True)
+        inp = Variable(torch.randn(batch, in_dim))
+        target = Variable((torch.rand(batch) * vocab).long())
+        sampler = softmax.UnigramSampler([1.] * vocab)
+        loss = softmax.sampled_softmax_loss(
+            inp, target, weight, bias, sampler, 20)
+        loss.backward()
+        self.assertTrue(loss.data[0] > 0)
+        self.assertEqual(weight.grad.size(), weight.size())
@@ -0,0 +1,86 @@
+
+import asyncio
+import unittest
+
+from seqmod.modules.lm import LM
+from seqmod.misc.dataset import Dict
+from seqmod.serving import ContinuousBatcher
+from seqmod import utils as u
+
+
+def serve(batcher, make_requests):
+    """
+    Run the batcher until all requests made by `make_requests` are resolved
+    """
+    loop = asyncio.get_event_loop()
+    task = loop.create_task(batcher.run())
+    try:
+        return loop.run_until_complete(asyncio.gather(
+            *make_requests(batcher), return_exceptions=True))
+    finally:
+        task.cancel()
+
+
+class TestContinuousBatcher(unittest.TestCase):
+    def setUp(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        words = ['w%d' % i for i in range(20)]
+        self.d = Dict(eos_token=u.EOS, force_unk=True).fit([words])
+        self.eos = self.d.get_eos()
+        self.model = LM(len(self.d), 8, 12, cell='GRU')
+        u.initialize_model(self.model)
+        self.model.eval()
+        self.seed = ['w1', 'w2', 'w3']
+
+    def tearDown(self):
+        asyncio.get_event_loop().close()
+
+    def set_eos_bias(self, value):
+        self.model.project.bias.data[self.eos] = value
+
+    def test_matches_generate(self):
+        self.set_eos_bias(-100)   # no early <eos>
+        scores, hyps = self.model.generate(
+            self.d, seed_texts=[self.seed], method='argmax', max_seq_len=6,
+            batch_size=1)
+        batcher = ContinuousBatcher(self.model, self.d, max_batch_size=4)
+        results = serve(batcher, lambda b: [
+            b.generate(self.seed, method='argmax', max_seq_len=6)
+            for _ in range(3)])
+        for score, hyp in results:
+            self.assertEqual(hyp, list(hyps[0]))
+            self.assertAlmostEqual(score * len(hyp), scores[0], places=3)
+
+    def test_admission_at_eos(self):
+        self.set_eos_bias(100)    # every request stops after one step
+        batcher = ContinuousBatcher(self.model, self.d, max_batch_size=1)
+        results = serve(batcher, lambda b: [
+            b.generate(self.seed, method='argmax', max_seq_len=10)
+            for _ in range(3)])
+        self.assertEqual([hyp for _, hyp in results], [[self.eos]] * 3)
+        # each request was admitted into the slot freed by the previous one
+        self.assertEqual(batcher.steps, 3)
+
+    def test_temperature(self):
+        self.set_eos_bias(-100)
+        batcher = ContinuousBatcher(self.model, self.d, max_batch_size=4)
+        argmax, cold, hot = serve(batcher, lambda b: [
+            b.generate(self.seed, method='argmax', max_seq_len=6),
+            b.generate(self.seed, temperature=1e-4, max_seq_len=6),
+            b.generate(self.seed, temperature=100., max_seq_len=6)])
+        # a near-zero temperature row samples the argmax, regardless of
+        # the temperature of the other rows in the batch
+        self.assertEqual(cold[1], argmax[1])
+        self.assertTrue(1 <= len(hot[1]) <= 6)
+
+    def test_step_failure(self):
+        batcher = ContinuousBatcher(self.model, self.d, max_batch_size=4)
+
+        def step():
+            raise RuntimeError("step failed")
+        batcher.step = step
+        results = serve(batcher, lambda b: [
+            b.generate(self.seed, max_seq_len=6) for _ in range(2)])
+        for result in results:
+            self.assertIsInstance(result, RuntimeError)
+        self.assertEqual(batcher.active, [])
@@ -0,0 +1,44 @@
+import unittest
+
+import torch
+
+from seqmod.modules.encoder_decoder import EncoderDecoder
+from seqmod.misc.dataset import Dict
+from seqmod.translate import Translator, windows
+from seqmod import utils as u
+
+
+class TestWindows(unittest.TestCase):
+    def test_windows(self):
+        lines = ['line %d' % i for i in range(7)]
+        self.assertEqual(list(windows(lines, 3)),
+                         [lines[0:3], lines[3:6], lines[6:]])
+        self.assertEqual(list(windows(iter(lines), 7)), [lines])
+        self.assertEqual(list(windows([], 3)), [])
+
+
+class TestTranslator(unittest.TestCase):
+    def setUp(self):
+        words = ['w%d' % i for i in range(20)]
+        d = Dict(pad_token=u.PAD, eos_token=u.EOS, bos_token=u.BOS)
+        d.fit([words])
+        torch.manual_seed(1001)
+        self.model = EncoderDecoder(1, 6, 8, 8, d)
+        u.initialize_model(self.model)
+        self.model.eval()
+        self.lines = ['w1 w2', 'w3 w4 w5 w6 w7', 'w8', 'w9 w10 w11']
+
+    def test_order(self):
+        # output lines follow the input order despite sorting by length
+        for beam_width, batch_size in ((1, 1), (2, 2)):
+            translator = Translator(
+                self.model, batch_size=batch_size, beam_width=beam_width)
+            out = translator.translate_window(self.lines)
+            self.assertEqual(len(out), len(self.lines))
+            for line, (translation, src_tokens, trg_tokens) in zip(
+                    self.lines, out):
+                self.assertEqual(src_tokens, len(line.split()))
+                example = list(self.model.src_dict.transform([line.split()]))
+                hyp, = translator.translate_batch(example)
+                self.assertEqual(translation, ' '.join(hyp))
+                self.assertEqual(trg_tokens, len(hyp))
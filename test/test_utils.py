@@ -0,0 +1,56 @@
+import unittest
+
+import torch
+import torch.nn as nn
+from torch.autograd import Variable
+
+from seqmod.modules.lm import LM
+from seqmod.modules.encoder_decoder import EncoderDecoder
+from seqmod.misc.dataset import Dict
+from seqmod import utils as u
+
+
+class TestQuantizeForInference(unittest.TestCase):
+    def setUp(self):
+        words = ['w%d' % i for i in range(20)]
+        self.d = Dict(pad_token=u.PAD, eos_token=u.EOS, bos_token=u.BOS)
+        self.d.fit([words])
+
+    def test_lm_generate(self):
+        model = LM(len(self.d), 8, 8, cell='LSTM', tie_weights=True)
+        u.initialize_model(model)
+        quantized = u.quantize_for_inference(model)
+        scores, hyps = quantized.generate(
+            self.d, seed_texts=[['w1', 'w2']], method='argmax',
+            max_seq_len=5, batch_size=1)
+        self.assertEqual(len(hyps), 1)
+        # only the copy is untied
+        self.assertIs(model.project.weight, model.embeddings.weight)
+
+    def test_encoder_decoder_translate(self):
+        for add_prev in (False, True):   # nn.LSTM or nn.LSTMCell decoder
+            model = EncoderDecoder(
+                1, 8, 8, 8, self.d, tie_weights=True, add_prev=add_prev)
+            u.initialize_model(model)
+            quantized = u.quantize_for_inference(model)
+            src = list(self.d.transform([['w1', 'w2', 'w3']]))
+            src = Variable(torch.LongTensor(src).t(), volatile=True)
+            scores, hyps, _ = quantized.translate(src)
+            self.assertEqual(len(hyps), 1)
+            project = model.project[0]
+            self.assertIs(project.weight, model.trg_embeddings.weight)
+            # the embeddings of the copy stay in full precision
+            self.assertTrue((quantized.trg_embeddings.weight.data ==
+                             model.trg_embeddings.weight.data).all())
+
+    def test_layers(self):
+        layers = (nn.Linear, nn.LSTM, nn.GRU, nn.LSTMCell, nn.GRUCell)
+        model = EncoderDecoder(1, 8, 8, 8, self.d, add_prev=True)
+        names = u._quantizable_modules(model, layers)
+        self.assertIn('decoder.rnn_step.layers.0', names)   # LSTMCell
+        self.assertIn('encoder.rnn', names)
+        # linears of fused RHN gates are read through their weights
+        model = LM(len(self.d), 8, 8, cell='RHNFused')
+        names = u._quantizable_modules(model, layers)
+        self.assertFalse(any(name.startswith('rnn.') for name in names))
+        self.assertIn('project', names)